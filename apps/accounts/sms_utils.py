@@ -2,17 +2,22 @@
 # -*- coding: utf-8 -*-
 # vim: ai ts=4 sts=4 et sw=4
 from django.conf import settings
-from twilio.rest import TwilioRestClient
+from ..outbox.models import OutboundSMS
+from ..outbox.sms import get_transport
 
 
 def send_sms_twilio(twilio_body, twilio_to,
                     twilio_from=settings.TWILIO_DEFAULT_FROM):
-    client = TwilioRestClient(settings.TWILIO_SID, settings.TWILIO_AUTH_TOKEN)
+    """
+    Queue the message for the outbox worker when OUTBOX_QUEUE_SMS is on, or
+    send it now through this process's transport. Returns the OutboundSMS,
+    or the provider's id for the message.
+    """
+    if settings.OUTBOX_QUEUE_SMS:
+        return OutboundSMS.objects.create(to=twilio_to, from_number=twilio_from,
+                                          body=twilio_body)
 
-
-    message = client.sms.messages.create(to=twilio_to,
-                                     from_=twilio_from,
-                                     body=twilio_body)
+    sid = get_transport().send(twilio_to, twilio_from, twilio_body)
 
     print "Twilio sent ["+str(twilio_body)+"] to "+str(twilio_to)
-    return message
\ No newline at end of file
+    return sid
@@ -1,6 +1,23 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 from models import ( DomainBoundCertificate, TrustAnchorCertificate,
-                    CertificateRevocationList, AnchorCertificateRevocationList)
+                    CertificateRevocationList, AnchorCertificateRevocationList,
+                    IssuanceJob, IssuedCertificate, CRLPublication,
+                    verify_certificates, revoke_certificates)
+
+
+def verify_selected(modeladmin, request, queryset):
+    verified = verify_certificates(queryset.select_related())
+    modeladmin.message_user(request, "%s certificates verified." % (len(verified)))
+verify_selected.short_description = "Verify selected certificates"
+
+
+def revoke_selected(modeladmin, request, queryset):
+    revoked, failed = revoke_certificates(queryset.select_related())
+    modeladmin.message_user(request, "%s certificates revoked." % (len(revoked)))
+    for c, error in failed:
+        modeladmin.message_user(request, "%s was not revoked: %s" % (c, error),
+                                messages.ERROR)
+revoke_selected.short_description = "Revoke selected certificates"
 
 
 class DomainBoundCertificateAdmin(admin.ModelAdmin):
@@ -11,6 +28,8 @@ class DomainBoundCertificateAdmin(admin.ModelAdmin):
     search_fields = ('domain','status', 'verified','serial_number',
                      'organization', 'creation_date', 'expiration_date')
     
+    actions = [verify_selected, revoke_selected]
+    
 admin.site.register(DomainBoundCertificate, DomainBoundCertificateAdmin)
 
 
@@ -22,6 +41,8 @@ class TrustAnchorCertificateAdmin(admin.ModelAdmin):
     search_fields = ('domain', 'status','verified', 'serial_number',
                      'organization', 'creation_date', 'expiration_date')
     
+    actions = [verify_selected, revoke_selected]
+    
 admin.site.register(TrustAnchorCertificate, TrustAnchorCertificateAdmin)
 
 
@@ -41,3 +62,35 @@ class AnchorCertificateRevocationListAdmin(admin.ModelAdmin):
     search_fields =('url', 'creation_date', 'creation_datetime')
     
 admin.site.register(AnchorCertificateRevocationList, AnchorCertificateRevocationListAdmin)
+
+
+class CRLPublicationAdmin(admin.ModelAdmin):
+    
+    list_display = ('kind', 'crl_number', 'base_crl_number', 'trust_anchor',
+                    'url', 'this_update', 'next_update')
+    
+    list_filter = ('kind',)
+    
+admin.site.register(CRLPublication, CRLPublicationAdmin)
+
+
+class IssuanceJobAdmin(admin.ModelAdmin):
+    
+    list_display = ('kind', 'object_id', 'status', 'attempts',
+                    'creation_datetime', 'finished_datetime')
+    
+    list_filter = ('kind', 'status')
+    
+admin.site.register(IssuanceJob, IssuanceJobAdmin)
+
+
+class IssuedCertificateAdmin(admin.ModelAdmin):
+    
+    list_display = ('serial', 'status', 'subject', 'issuer',
+                    'expiration_datetime', 'revocation_datetime')
+    
+    list_filter = ('status',)
+    
+    search_fields = ('serial', 'subject')
+    
+admin.site.register(IssuedCertificate, IssuedCertificateAdmin)
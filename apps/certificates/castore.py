@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+The CA state store: every certificate a CA has issued or revoked, in one
+table indexed by issuer, serial and status.
+
+openssl ca keeps this in a flat index file that it reads and rewrites in
+full on every -revoke and every -gencrl. With CA_STATE_STORE on, issuance
+records each certificate here as well, and revocation and CRL generation
+use only this table. The index files are still appended to on issuance so
+openssl can keep issuing from them, but they no longer see revocations.
+
+An issuer is named by the path of its index database, as written in the
+config openssl ca reads, so existing index files import one to one:
+
+    python manage.py runscript import_index --script-args /opt/ca/conf/index
+"""
+
+from django.conf import settings
+from django.db import models, transaction
+import datetime
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+
+
+INDEX_STATUS_CHOICES = (('V', 'valid'),
+                        ('R', 'revoked'),
+                        ('E', 'expired'))
+
+INDEX_TIME_FORMAT = "%y%m%d%H%M%SZ"
+
+# openssl ca -crl_reason names.
+REASONS = {"unspecified":           x509.ReasonFlags.unspecified,
+           "keyCompromise":         x509.ReasonFlags.key_compromise,
+           "CACompromise":          x509.ReasonFlags.ca_compromise,
+           "affiliationChanged":    x509.ReasonFlags.affiliation_changed,
+           "superseded":            x509.ReasonFlags.superseded,
+           "cessationOfOperation":  x509.ReasonFlags.cessation_of_operation,
+           "certificateHold":       x509.ReasonFlags.certificate_hold,
+           "removeFromCRL":         x509.ReasonFlags.remove_from_crl}
+
+
+class IssuedCertificate(models.Model):
+    issuer              = models.CharField(max_length=255,
+                            help_text="The index database of the issuing CA.")
+    serial              = models.CharField(max_length=64, db_index=True)
+    status              = models.CharField(max_length=1, default="V",
+                                           choices=INDEX_STATUS_CHOICES)
+    expiration_datetime = models.DateTimeField()
+    revocation_datetime = models.DateTimeField(null=True, blank=True)
+    revocation_reason   = models.CharField(max_length=32, default="",
+                                           blank=True)
+    subject             = models.CharField(max_length=512)
+
+    def __unicode__(self):
+        return '%s %s Status=%s' % (self.issuer, self.serial, self.status)
+
+    class Meta:
+        app_label = "certificates"
+        unique_together = (('issuer', 'serial'),)
+        index_together = [['issuer', 'status'], ['issuer', 'subject']]
+
+    def index_line(self):
+        """This record as a line of an openssl index file."""
+        revoked = ""
+        if self.revocation_datetime:
+            revoked = self.revocation_datetime.strftime(INDEX_TIME_FORMAT)
+            if self.revocation_reason:
+                revoked += "," + self.revocation_reason
+        return "%s\t%s\t%s\t%s\tunknown\t%s\n" % (self.status,
+                    self.expiration_datetime.strftime(INDEX_TIME_FORMAT),
+                    revoked, self.serial, self.subject)
+
+
+def store_enabled():
+    return getattr(settings, "CA_STATE_STORE", False)
+
+
+def deltas_enabled():
+    """Delta CRLs are built from the store, so they need it on as well."""
+    return store_enabled() and getattr(settings, "CA_DELTA_CRLS", False)
+
+
+def conf_database(conf):
+    """The issuer name for a parsed openssl config."""
+    return conf[conf["ca"]["default_ca"]]["database"]
+
+
+def parse_index_time(value):
+    # Index files hold UTCTime; certificates past 2049 use GeneralizedTime.
+    if len(value) == 15:
+        return datetime.datetime.strptime(value, "%Y%m%d%H%M%SZ")
+    return datetime.datetime.strptime(value, INDEX_TIME_FORMAT)
+
+
+def parse_index_line(line):
+    status, expires, revoked, serial, filename, subject = \
+                                        line.rstrip("\n").split("\t")
+    revocation_datetime, reason = None, ""
+    if revoked:
+        revoked, sep, reason = revoked.partition(",")
+        revocation_datetime = parse_index_time(revoked)
+    return {"status":               status,
+            "expiration_datetime":  parse_index_time(expires),
+            "revocation_datetime":  revocation_datetime,
+            "revocation_reason":    reason,
+            "serial":               serial,
+            "subject":              subject}
+
+
+def import_index(path, issuer=None, batch_size=100):
+    """
+    Load an openssl index file, replacing whatever the store held for its
+    issuer. Returns the number of records imported.
+    """
+    issuer = issuer or path
+    count = 0
+    with transaction.commit_on_success():
+        IssuedCertificate.objects.filter(issuer=issuer).delete()
+        batch = []
+        for line in open(path, "r"):
+            if not line.strip():
+                continue
+            batch.append(IssuedCertificate(issuer=issuer,
+                                           **parse_index_line(line)))
+            if len(batch) == batch_size:
+                IssuedCertificate.objects.bulk_create(batch)
+                count += len(batch)
+                batch = []
+        IssuedCertificate.objects.bulk_create(batch)
+        count += len(batch)
+    return count
+
+
+def relax_index_attr(database):
+    """
+    Turn off openssl's own unique_subject check for an index file. Its index
+    no longer records revocations, so the check is made with subject_in_use()
+    instead.
+    """
+    attr = database + ".attr"
+    wanted = "unique_subject = no\n"
+    try:
+        with open(attr, "r") as f:
+            if f.read() == wanted:
+                return
+    except IOError:
+        pass
+    with open(attr, "w") as f:
+        f.write(wanted)
+
+
+def subject_in_use(issuer, subject):
+    """openssl's unique_subject check: is there a valid certificate for it?"""
+    return IssuedCertificate.objects.filter(issuer=issuer, subject=subject,
+                                            status="V").exists()
+
+
+def record_issued(issuer, serial, subject, expiration_datetime):
+    return IssuedCertificate.objects.create(issuer=issuer, serial=serial,
+                                subject=subject,
+                                expiration_datetime=expiration_datetime)
+
+
+def revoke(issuer, serial, subject, expiration_datetime, reason="",
+           when=None):
+    """
+    Mark a certificate revoked. Like openssl ca -revoke, a certificate the
+    issuer has no record of is added as revoked. Returns False if it was
+    already revoked.
+    """
+    when = when or datetime.datetime.utcnow()
+    if IssuedCertificate.objects.filter(issuer=issuer, serial=serial,
+                                        status="V").update(
+                                            status="R",
+                                            revocation_datetime=when,
+                                            revocation_reason=reason):
+        return True
+    if IssuedCertificate.objects.filter(issuer=issuer, serial=serial).exists():
+        return False
+    IssuedCertificate.objects.create(issuer=issuer, serial=serial,
+                                     subject=subject, status="R",
+                                     expiration_datetime=expiration_datetime,
+                                     revocation_datetime=when,
+                                     revocation_reason=reason)
+    return True
+
+
+def revoked_certificates(issuer, since=None):
+    """
+    RevokedCertificate objects for every certificate issuer revoked, or
+    only those revoked at or after since.
+    """
+    records = IssuedCertificate.objects.filter(issuer=issuer, status="R")
+    if since:
+        records = records.filter(revocation_datetime__gte=since)
+    revoked = []
+    for serial, when, reason in records.values_list(
+                'serial', 'revocation_datetime', 'revocation_reason'
+                ).order_by('revocation_datetime').iterator():
+        builder = x509.RevokedCertificateBuilder().serial_number(
+                                    int(serial, 16)).revocation_date(when)
+        if reason in REASONS:
+            builder = builder.add_extension(x509.CRLReason(REASONS[reason]),
+                                            critical=False)
+        revoked.append(builder.build(default_backend()))
+    return revoked
+
+
+def load_key_pair(cert_path, key_path, passphrase=None):
+    """A PEM certificate and its PEM private key, as cryptography objects."""
+    with open(cert_path, "rb") as f:
+        cert = x509.load_pem_x509_certificate(f.read(), default_backend())
+    with open(key_path, "rb") as f:
+        key = serialization.load_pem_private_key(f.read(), passphrase,
+                                                 default_backend())
+    return cert, key
+
+
+def load_issuer(conf, passphrase=None):
+    """The issuer certificate and private key named in conf."""
+    ca = conf[conf["ca"]["default_ca"]]
+    return load_key_pair(ca["certificate"], ca["private_key"], passphrase)
+
+
+def sign_crl(conf, revoked, now, next_update, extensions=(), passphrase=None):
+    ca = conf[conf["ca"]["default_ca"]]
+    cert, key = load_issuer(conf, passphrase)
+    # Passing the whole list at once: add_revoked_certificate() copies it on
+    # every call.
+    builder = x509.CertificateRevocationListBuilder(
+                issuer_name = cert.subject,
+                last_update = now,
+                next_update = next_update,
+                revoked_certificates = revoked)
+    for extension, critical in extensions:
+        builder = builder.add_extension(extension, critical)
+    algorithm = getattr(hashes, ca.get("default_md", "sha256").upper())()
+    crl = builder.sign(key, algorithm, default_backend())
+    return crl.public_bytes(serialization.Encoding.PEM)
+
+
+def build_crl(conf, passphrase=None, now=None, crl_number=None,
+              freshest_url=None):
+    """
+    The in-process equivalent of `openssl ca -gencrl -config conf`, read from
+    the store instead of the index file. Returns the CRL as PEM.
+
+    With crl_number it is a numbered, complete CRL that can serve as the
+    base of delta CRLs; freshest_url is where the current delta is found.
+    """
+    ca = conf[conf["ca"]["default_ca"]]
+    now = now or datetime.datetime.utcnow()
+    next_update = now + datetime.timedelta(
+                                days=int(ca.get("default_crl_days", 30)))
+    extensions = []
+    if crl_number is not None:
+        extensions.append((x509.CRLNumber(crl_number), False))
+    if freshest_url:
+        extensions.append((x509.FreshestCRL([x509.DistributionPoint(
+                    [x509.UniformResourceIdentifier(unicode(freshest_url))],
+                    None, None, None)]), False))
+    return sign_crl(conf, revoked_certificates(conf_database(conf)), now,
+                    next_update, extensions, passphrase)
+
+
+def build_delta_crl(conf, crl_number, base_crl_number, since,
+                    passphrase=None, now=None, seconds=None):
+    """
+    A delta CRL (RFC 5280 5.2.4) numbered crl_number, listing what was
+    revoked since the base CRL numbered base_crl_number was built. It is
+    valid for seconds, CA_DELTA_CRL_SECONDS by default. Returns PEM.
+    """
+    now = now or datetime.datetime.utcnow()
+    seconds = seconds or settings.CA_DELTA_CRL_SECONDS
+    extensions = [(x509.CRLNumber(crl_number), False),
+                  (x509.DeltaCRLIndicator(base_crl_number), True)]
+    return sign_crl(conf, revoked_certificates(conf_database(conf), since),
+                    now, now + datetime.timedelta(seconds=seconds),
+                    extensions, passphrase)
+
+
+def write_crl(conf, path, passphrase=None):
+    pem = build_crl(conf, passphrase)
+    f = open(path, "wb")
+    f.write(pem)
+    f.close()
+    return path
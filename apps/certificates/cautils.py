@@ -4,7 +4,7 @@
 
 from django.conf import settings
 from django.utils.datastructures import SortedDict
-import os, sys, uuid, json, re
+import os, sys, uuid, json, errno, tempfile
 from shutil import copyfile, copytree, rmtree
 from subprocess import call
 import pdb
@@ -12,7 +12,119 @@ from sha import sha256_from_filepath
 from cStringIO import StringIO
 import subprocess
 from datetime import datetime
-from fileutils import SimpleS3
+from storage import get_storage
+from chaincache import chain_cache
+from engine import (issue_endpoint_certificate, parse_conf, database_lock,
+                    subject_oneline, policy_subject, duplicate_subject_error)
+import castore
+from serials import next_serial, format_serial
+from stubs import render_stub
+from keypool import get_key, pool_enabled
+from OpenSSL import crypto
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+
+
+def key_args(rsakey, privkeyname, cwd):
+    """
+    The openssl req arguments for the private key, run in cwd. With the key
+    pool on, a pooled key is written to privkeyname and used; otherwise
+    openssl generates one.
+    """
+    if pool_enabled():
+        # Readable by us alone, whatever the umask and the work dir's mode.
+        fd = os.open(os.path.join(cwd, privkeyname),
+                     os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+        os.write(fd, crypto.dump_privatekey(crypto.FILETYPE_PEM,
+                                            get_key(rsakey)))
+        os.close(fd)
+        return ["-key", privkeyname]
+    return ["-newkey", "rsa:" + str(rsakey), "-nodes", "-keyout", privkeyname]
+
+
+def make_work_dir(kind):
+    """
+    A new, empty directory under CA_INPROCESS_DIR/kind for one request's
+    intermediate files. The issuance functions never chdir into it; every
+    subprocess gets it as cwd and every Python path is built from it.
+    """
+    parent = os.path.join(settings.CA_INPROCESS_DIR, kind)
+    try:
+        os.makedirs(parent)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    dirpath = tempfile.mkdtemp(dir=parent)
+    # The mode mkdir gave it when issuance ran under umask 0000.
+    os.chmod(dirpath, 0777)
+    return dirpath
+
+
+def write_serial_file(dirpath):
+    """
+    Allocate the next serial and write it to a serial file of this request's
+    own, which the rendered config names as |SERIAL_FILE|. openssl ca then
+    never touches the shared serial file. Returns (serial, path).
+    """
+    serial = format_serial(next_serial())
+    path = os.path.join(dirpath, "serial")
+    f = open(path, "w")
+    f.write(serial + "\n")
+    f.close()
+    return serial, path
+
+
+def read_conf(conf_path):
+    f = open(conf_path, "r")
+    conf = parse_conf(f.read())
+    f.close()
+    return conf
+
+
+def load_certificate_file(path):
+    f = open(path, "r")
+    cert = crypto.load_certificate(crypto.FILETYPE_PEM, f.read())
+    f.close()
+    return cert
+
+
+def certificate_record(cert):
+    """(serial, subject, expiration) of a crypto.X509, as the store keeps them."""
+    return (format_serial(cert.get_serial_number()),
+            subject_oneline(cert.get_subject()),
+            castore.parse_index_time(cert.get_notAfter()))
+
+
+def openssl_ca_sign(conf, args, cwd, cert_path, subject_values):
+    """
+    Run openssl ca to sign a request, holding the lock on the index database
+    named in conf. With the CA state store on, the unique_subject check is
+    made against the store and the new certificate is recorded there.
+    Returns openssl's output, which callers check for failures.
+    """
+    with database_lock(conf):
+        if castore.store_enabled():
+            database = castore.conf_database(conf)
+            subject = policy_subject(conf, subject_values)
+            if castore.subject_in_use(database, subject):
+                return str(duplicate_subject_error(subject))
+            castore.relax_index_attr(database)
+        p = subprocess.Popen(args, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, cwd=cwd)
+        error, signoutput = p.communicate()
+        if castore.store_enabled() and p.returncode == 0:
+            serial, subject, expires = certificate_record(
+                                            load_certificate_file(cert_path))
+            castore.record_issued(database, serial, subject, expires)
+    return signoutput
+
+
+def revoke_in_store(conf_path, cert_path):
+    """The CA state store equivalent of openssl ca -config conf -revoke cert."""
+    serial, subject, expires = certificate_record(load_certificate_file(cert_path))
+    castore.revoke(castore.conf_database(read_conf(conf_path)), serial,
+                   subject, expires)
+    return "Revoked Certificate %s" % (serial)
 
 
 def write_verification_message(serial_number, common_name, status,
@@ -38,25 +150,12 @@ def extract(raw_string, start_marker, end_marker):
     return raw_string[start:end]
 
 def chain_keys_in_list(outpath, filenames):
-    certslist_str = ""
-    with open(outpath, 'w') as outfile:
-        for fname in filenames:
-            with open(fname) as infile:
-                outfile.write(infile.read())
-
-    f = open(outpath, 'r')
-    certslist_str = f.read()
-    f.close()
-
-    list_of_certs = re.findall('-----BEGIN CERTIFICATE-----$\n(.*?)\n^-----END CERTIFICATE-----',
-               certslist_str, re.DOTALL|re.MULTILINE)
-    
-    #print "LIST O CERTS", list_of_certs
-    newcerts =[]
-    for c in list_of_certs:
-        nc = c.replace('\n','')
-        newcerts.append(nc)
-    return newcerts
+    """
+    Write the certificates in filenames, in order, to outpath as one PEM
+    chain and return their base64 DER, for an x5c list. The files are
+    read once and kept in chain_cache; outpath is written only if changed.
+    """
+    return chain_cache.write_chain(outpath, filenames)
 
 
 
@@ -75,17 +174,54 @@ def write_x5c_message(name, x5ckeys):
 
 
 
-def build_crl():
-    password = "pass:" + settings.PRIVATE_PASSWORD
-    crl_file = os.path.join(settings.CA_CRL_DIR, settings.CRL_FILENAME)
-    call(["openssl", "ca", "-config",  settings.CA_MAIN_CONF ,  "-gencrl", "-out",
-          crl_file, "-passin", password])
-    
-    if settings.USE_S3:
-        s=SimpleS3()
-        key = "crl/" + settings.CRL_FILENAME
-        url = s.store_in_s3(key, crl_file,
-                        bucket=settings.CRL_BUCKET, public=True)
+def crl_path():
+    return os.path.join(settings.CA_CRL_DIR, settings.CRL_FILENAME)
+
+
+def anchor_crl_path(trust_anchor):
+    return os.path.join(trust_anchor.completed_dir_path,
+                        "%s.crl" % (trust_anchor.dns))
+
+
+def anchor_crl_conf(trust_anchor):
+    return os.path.join(trust_anchor.completed_dir_path,
+                        "%s-crl-stub.cnf" % (trust_anchor.dns))
+
+
+def delta_crl_path(path):
+    """Where the delta CRLs that follow the CRL at path are written."""
+    stem, ext = os.path.splitext(path)
+    return stem + "-delta" + ext
+
+
+def crl_key(path):
+    return "crl/" + os.path.basename(path)
+
+
+def crl_url(path):
+    """The public URL of a CRL written to path, once publish_crl() has run."""
+    s = get_storage()
+    if s:
+        return s.url(settings.CRL_BUCKET, crl_key(path))
+    return "http://%s/%s" % (settings.CRL_BUCKET, crl_key(path))
+
+
+def crl_next_update(path):
+    """The nextUpdate of the PEM CRL at path, as a naive UTC datetime."""
+    with open(path, "rb") as f:
+        crl = x509.load_pem_x509_crl(f.read(), default_backend())
+    return crl.next_update
+
+
+def publish_crl(path):
+    """
+    Store the CRL at path in CRL_BUCKET under crl/. Returns its URL, the
+    path itself when publishing is off, or "Failed".
+    """
+    url = path
+    s = get_storage()
+    if s:
+        url = s.store(crl_key(path), path, settings.CRL_BUCKET, public=True)
     if url:
         print "Completed upload @ %s. Archive URL = %s" % (datetime.now(), url)
     else:
@@ -95,25 +231,78 @@ def build_crl():
     return url
 
 
+def build_crl():
+    password = "pass:" + settings.PRIVATE_PASSWORD
+    crl_file = crl_path()
+    if castore.store_enabled():
+        castore.write_crl(read_conf(settings.CA_MAIN_CONF), crl_file,
+                          settings.PRIVATE_PASSWORD)
+    else:
+        call(["openssl", "ca", "-config",  settings.CA_MAIN_CONF ,  "-gencrl", "-out",
+              crl_file, "-passin", password])
+    
+    return publish_crl(crl_file)
+
+
+def sign_anchor_crl(trust_anchor):
+    """
+    Generate the CRL of trust_anchor in its completed directory and return
+    its path. Raises CalledProcessError if openssl fails.
+    """
+    path = anchor_crl_path(trust_anchor)
+    crl_conf = anchor_crl_conf(trust_anchor)
+    if castore.store_enabled():
+        castore.write_crl(read_conf(crl_conf), path)
+    else:
+        subprocess.check_call(["openssl", "ca", "-config",  crl_conf,
+                               "-gencrl", "-out", path,])
+    return path
+
+
 def build_anchor_crl(trust_anchor):
-    config_file = "%s-crl-stub.cnf" % (trust_anchor.dns)
-    crl_file = "%s.crl" % (trust_anchor.dns)
-    crl_path = os.path.join(trust_anchor.completed_dir_path, crl_file)
-    crl_conf = os.path.join(trust_anchor.completed_dir_path, config_file)
-    call(["openssl", "ca", "-config",  crl_conf,  "-gencrl", "-out", crl_path,])
-    
-    if settings.USE_S3:
-        s=SimpleS3()
-        key = "crl/" + crl_file
-        url = s.store_in_s3(key, crl_path,
-                        bucket=settings.CRL_BUCKET, public=True)
-    if url:
-        print "Completed upload @ %s. Archive URL = %s" % (datetime.now(), url)
+    return publish_crl(sign_anchor_crl(trust_anchor))
+
+
+def sign_numbered_crls(trust_anchor, kind, crl_number, base=None):
+    """
+    Build numbered CRLs from the CA state store for trust_anchor, or the CA
+    when it is None. For kind "base" that is a complete CRL, written where
+    the full CRL always was, and an empty delta CRL following it; for
+    "delta", a delta CRL on base, the (crl_number, this_update) of the
+    current base CRL. Returns a list of (fields, path), fields being those
+    of the CRLPublication row to record once path is published.
+    """
+    if trust_anchor is None:
+        conf = read_conf(settings.CA_MAIN_CONF)
+        path = crl_path()
+        passphrase = settings.PRIVATE_PASSWORD
     else:
-        print "Upload failed @ %s"
-        url= "Failed"
-        
-    return url
+        conf = read_conf(anchor_crl_conf(trust_anchor))
+        path = anchor_crl_path(trust_anchor)
+        passphrase = None
+    delta_path = delta_crl_path(path)
+    now = datetime.utcnow()
+    crls = []
+    if kind == "base":
+        pem = castore.build_crl(conf, passphrase, now, crl_number,
+                                freshest_url=crl_url(delta_path))
+        crls.append(({"kind": "base", "crl_number": crl_number}, path, pem))
+        base = (crl_number, now)
+        crl_number += 1
+    pem = castore.build_delta_crl(conf, crl_number, base[0], base[1],
+                                  passphrase, now)
+    crls.append(({"kind": "delta", "crl_number": crl_number,
+                  "base_crl_number": base[0]}, delta_path, pem))
+
+    result = []
+    for fields, p, pem in crls:
+        f = open(p, "wb")
+        f.write(pem)
+        f.close()
+        fields["this_update"] = now
+        fields["next_update"] = crl_next_update(p)
+        result.append((fields, p))
+    return result
 
 
 def revoke(cert):
@@ -122,7 +311,10 @@ def revoke(cert):
     password = "pass:" + settings.PRIVATE_PASSWORD 
     fn = cert.serial_number + ".pem"
     fn = os.path.join(settings.CA_SIGNED_DIR, fn)
-    error, output = subprocess.Popen(["openssl", "ca",
+    if castore.store_enabled():
+        output = revoke_in_store(settings.CA_MAIN_CONF, fn)
+    else:
+        error, output = subprocess.Popen(["openssl", "ca",
                                       "-config", settings.CA_MAIN_CONF,
                                       "-revoke" , fn,
                                       "-passin", password ],
@@ -142,7 +334,10 @@ def revoke_from_anchor(cert):
     config_file = "%s/%sdomain-bound-stub.cnf" % (cert.completed_dir_path,
                                                   cert.dns,)
 
-    error, output = subprocess.Popen(["openssl", "ca", "-config", config_file,
+    if castore.store_enabled():
+        output = revoke_in_store(config_file, fn)
+    else:
+        error, output = subprocess.Popen(["openssl", "ca", "-config", config_file,
                                       "-revoke" , fn],
                                         stdout=subprocess.PIPE,
                                         stderr= subprocess.PIPE
@@ -177,7 +372,6 @@ def create_trust_anchor_certificate(common_name     = "example.com",
                 "completed_dir_path":                 ""}
     
     
-    dirname = str(uuid.uuid4())[0:5]
     tname =  dns
     keysize = "rsa:" + str(rsakey)
     csrname = tname + ".csr"
@@ -203,120 +397,54 @@ def create_trust_anchor_certificate(common_name     = "example.com",
            '/CN='           + common_name + \
            '/O='            + organization
     
-    os.chdir("/opt/ca/inprocess/anchors")
-    os.umask(0000)
-    os.mkdir(dirname)
-    os.chdir(dirname)
+    dirpath = make_work_dir("anchors")
     
     #Create the signing request. ----------------------------------------------
     error, output  = subprocess.Popen(["openssl", "req", "-subj", subj , "-out", csrname,
-                             "-new", "-newkey", keysize, "-nodes", "-keyout",
-                             privkeyname],
+                             "-new"] + key_args(rsakey, privkeyname, dirpath),
                             stdout = subprocess.PIPE,
                             stderr= subprocess.PIPE,
+                            cwd = dirpath,
                             ).communicate()
     print output
     
     
     #get the next serial number ------------------------------------------------
-    fp = open("/opt/ca/conf/serial", "r")
-    serial = str(fp.read())
-    fp.close()
-    
-    
-    # Copy a stub config file to our directory----------------------------------
-    copyfile(os.path.join(settings.CA_CONF_DIR, "trust-anchor-stub.cnf"), conf_stub_file_name)
-    
-    # Prepare strings for sed, that will be used to fillout our stub into a usable config file.
-    
-    #Prepare sed strings
-    seddns = "s/|DNS|/%s/g" % (dns)
-    seddays = "s/|DAYS|/%s/g" % (expires)
-    sedserial = "s#|SERIAL|#%s#g" % (serial[:-1])
-    sedcountry = "s#|COUNTRY|#%s#g" % (country)
-    sedstate= "s#|STATE|#%s#g" % (state)
-    sedcity = "s#|CITY|#%s#g" % (city)
-    sedcommon_name =  "s#|COMMON_NAME|#%s#g" % (common_name)
-    sedorganization = "s#|ORGANIZATION|#%s#g" % (organization)
-    sedemail = "s#|EMAIL_ADDRESS|#%s#g" % (email)
-    
-    
-    #Apply the sed operations --------------------------------------------------- 
-    error, output = subprocess.Popen(["sed", "-i", "-e", seddns,  conf_stub_file_name],
-                                stdout=subprocess.PIPE,
-                                stderr= subprocess.PIPE
-                                ).communicate()
-    error, output = subprocess.Popen(["sed", "-i", "-e", seddays, conf_stub_file_name],
-                                stdout=subprocess.PIPE,
-                                stderr= subprocess.PIPE
-                                ).communicate()    
-    error, output = subprocess.Popen(["sed", "-i", "-e", sedserial, conf_stub_file_name],
-                                stdout=subprocess.PIPE,
-                                stderr= subprocess.PIPE
-                                ).communicate()  
-    error, output = subprocess.Popen(["sed", "-i", "-e", sedcountry,
-                                      conf_stub_file_name],
-                                        stdout=subprocess.PIPE,
-                                        stderr= subprocess.PIPE
-                                        ).communicate()
-    
-    error, output = subprocess.Popen(["sed", "-i", "-e", sedstate,
-                                      conf_stub_file_name],
-                                        stdout=subprocess.PIPE,
-                                        stderr= subprocess.PIPE
-                                        ).communicate()
-
-    error, output = subprocess.Popen(["sed", "-i", "-e", sedcity,
-                                      conf_stub_file_name],
-                                        stdout=subprocess.PIPE,
-                                        stderr= subprocess.PIPE
-                                        ).communicate()
-
-    error, output = subprocess.Popen(["sed", "-i", "-e", sedcommon_name,
-                                      conf_stub_file_name],
-                                        stdout=subprocess.PIPE,
-                                        stderr= subprocess.PIPE
-                                        ).communicate()
-    error, output = subprocess.Popen(["sed", "-i", "-e", sedorganization,
-                                      conf_stub_file_name],
-                                        stdout=subprocess.PIPE,
-                                        stderr= subprocess.PIPE
-                                        ).communicate()
-    
-    error, output = subprocess.Popen(["sed", "-i", "-e", sedemail,
-                                      conf_stub_file_name],
-                                        stdout=subprocess.PIPE,
-                                        stderr= subprocess.PIPE
-                                        ).communicate()
-    
-    
+    serial, serial_file = write_serial_file(dirpath)
+    
+    # Fill out our stub into a usable config file.
+    conf = render_stub("trust-anchor-stub.cnf",
+                os.path.join(dirpath, conf_stub_file_name),
+                DNS             = dns,
+                DAYS            = expires,
+                SERIAL          = serial,
+                SERIAL_FILE     = serial_file,
+                COUNTRY         = country,
+                STATE           = state,
+                CITY            = city,
+                COMMON_NAME     = common_name,
+                ORGANIZATION    = organization,
+                EMAIL_ADDRESS   = email)
     
+    password = "pass:" + settings.PRIVATE_PASSWORD #TODO Find a more secure way to do this
     
     # Build the certificate from the signing request.
-    
-    
-    
-    
-    
-    
-    
-    password = "pass:" + settings.PRIVATE_PASSWORD #TODO Find a more secure way to do this
-    #
-    error, signoutput = subprocess.Popen(["openssl", "ca", "-batch", "-config",
+    signoutput = openssl_ca_sign(parse_conf(conf),
+                            ["openssl", "ca", "-batch", "-config",
                              conf_stub_file_name, "-in", csrname, "-out",
                              public_cert_name, "-passin", password],
-                             stdout=subprocess.PIPE,
-                             stderr= subprocess.PIPE
-                            ).communicate()
+                            dirpath, os.path.join(dirpath, public_cert_name),
+                            {"C": country, "ST": state, "L": city,
+                             "O": organization, "CN": common_name,
+                             "emailAddress": email})
 
     #print "CERT SIGN OUT", signoutput
     
     #if the previous step fails, then 
-    if str(output.lower()).__contains__("failed to update database"):
+    if str(signoutput.lower()).__contains__("failed to update database"):
         print "PUBLIC CERT NAME:", public_cert_name, "FAILED!!!!"
         result["status"]                            = "failed"
         result["notes"] = signoutput
-        os.chdir(settings.BASE_DIR) 
         return result
         
     
@@ -325,7 +453,8 @@ def create_trust_anchor_certificate(common_name     = "example.com",
     output,error = subprocess.Popen(["openssl", "x509", "-in",
                                       public_cert_name, "-serial","-noout",],
                              stdout=subprocess.PIPE,
-                             stderr= subprocess.PIPE
+                             stderr= subprocess.PIPE,
+                             cwd = dirpath,
                             ).communicate()
     
     try:
@@ -334,7 +463,6 @@ def create_trust_anchor_certificate(common_name     = "example.com",
     except(IndexError):
         result["status"] = "failed"
         result["notes"] = output
-        os.chdir(settings.BASE_DIR) 
         return result
         
     
@@ -344,7 +472,8 @@ def create_trust_anchor_certificate(common_name     = "example.com",
     output,error = subprocess.Popen(["openssl", "x509", "-in",
                                       public_cert_name, "-fingerprint","-noout",],
                              stdout=subprocess.PIPE,
-                             stderr= subprocess.PIPE
+                             stderr= subprocess.PIPE,
+                             cwd = dirpath,
                             ).communicate()
     
     
@@ -360,7 +489,8 @@ def create_trust_anchor_certificate(common_name     = "example.com",
                                       public_cert_name, "-out",
                                       public_cert_name_der],
                              stdout=subprocess.PIPE,
-                             stderr= subprocess.PIPE
+                             stderr= subprocess.PIPE,
+                             cwd = dirpath,
                             ).communicate()
     
 
@@ -370,7 +500,8 @@ def create_trust_anchor_certificate(common_name     = "example.com",
                                       "-in", public_cert_name, "-out",
                                       public_cert_name_der],
                                         stdout=subprocess.PIPE,
-                                        stderr= subprocess.PIPE
+                                        stderr= subprocess.PIPE,
+                                        cwd = dirpath,
                                         ).communicate()
     
 
@@ -380,16 +511,19 @@ def create_trust_anchor_certificate(common_name     = "example.com",
                                       "-inform", "pem", "-outform", "der",
                                       "-nocrypt",],
                              stdout=subprocess.PIPE,
-                             stderr= subprocess.PIPE
+                             stderr= subprocess.PIPE,
+                             cwd = dirpath,
                             ).communicate()
     
     
     #create the sha1 digest of the DER.
-    sha256_digest = sha256_from_filepath(public_cert_name_der)
+    sha256_digest = sha256_from_filepath(os.path.join(dirpath,
+                                                      public_cert_name_der))
   
     #Create an empty index file
-    if not os.path.exists('index'):
-        open('index', 'w').close()
+    index_path = os.path.join(dirpath, 'index')
+    if not os.path.exists(index_path):
+        open(index_path, 'w').close()
        
 
     #Since the anchor creation process completed, then build out the perm dirs
@@ -404,13 +538,13 @@ def create_trust_anchor_certificate(common_name     = "example.com",
 
     if os.path.exists(completed_this_anchor_dir):
         rmtree(completed_this_anchor_dir)
-    copytree(".", completed_this_anchor_dir)
+    copytree(dirpath, completed_this_anchor_dir)
         
-    os.chdir(completed_this_anchor_dir)
     error, output = subprocess.Popen(["zip", anchor_zip_download_file_name,
                                       public_cert_name, public_cert_name_der],
                                     stdout=subprocess.PIPE,
-                                    stderr= subprocess.PIPE
+                                    stderr= subprocess.PIPE,
+                                    cwd = completed_this_anchor_dir,
                                     ).communicate()
     
     #Private Key Path for PEM
@@ -432,8 +566,6 @@ def create_trust_anchor_certificate(common_name     = "example.com",
     
     
     
-    # Get back to the directory we started.
-    os.chdir(settings.BASE_DIR) 
 
     return result
     
@@ -454,6 +586,22 @@ def create_endpoint_certificate(common_name     = "foo.bar.org",
                                     public_key_path  = "",
                                     completed_anchor_dir = ""):
     
+    if getattr(settings, "CA_ISSUANCE_ENGINE", "openssl") == "inprocess":
+        return issue_endpoint_certificate(common_name = common_name,
+                                    email           = email,
+                                    dns             = dns,
+                                    anchor_dns      = anchor_dns,
+                                    expires         = expires,
+                                    organization    = organization,
+                                    city            = city,
+                                    state           = state,
+                                    country         = country,
+                                    rsakey          = rsakey,
+                                    user            = user,
+                                    private_key_path = private_key_path,
+                                    public_key_path  = public_key_path,
+                                    completed_anchor_dir = completed_anchor_dir)
+    
     result = {  "sha256_digest":                      "",
                 "anchor_zip_download_file_name":      "",
                 "status":                             "failed",
@@ -464,7 +612,6 @@ def create_endpoint_certificate(common_name     = "foo.bar.org",
                 "notes":                              "Certificate generation in process.",
                 "completed_dir_path":                 ""}
     
-    dirname = str(uuid.uuid4())[0:5]
     tname =  dns
     keysize = "rsa:" + str(rsakey)
     csrname = tname + ".csr"
@@ -493,10 +640,7 @@ def create_endpoint_certificate(common_name     = "foo.bar.org",
            '/CN='           + common_name + \
            '/O='            + organization 
     
-    dirpath = os.path.join(settings.CA_INPROCESS_DIR, "domain-bound", dirname)
-    os.umask(0000)
-    os.mkdir(dirpath)
-    os.chdir(dirpath)
+    dirpath = make_work_dir("domain-bound")
      
     #print "Temp DIRECTORY is:",  dirpath
     #print "Temp DIRECTORY is:",  completed_this_domain_bound_dir
@@ -507,142 +651,53 @@ def create_endpoint_certificate(common_name     = "foo.bar.org",
         email_bound=True
     
     # Create the signing request.
-    call(["openssl", "req", "-subj", subj , "-out", csrname, "-new", "-newkey",
-          keysize, "-nodes", "-keyout", privkeyname]) 
+    call(["openssl", "req", "-subj", subj , "-out", csrname, "-new"] + \
+         key_args(rsakey, privkeyname, dirpath), cwd = dirpath)
     
-    # Copy a stub config file to our directory
+    # Fill out a stub config file in our directory
     if email.__contains__("@"):
-        copyfile(os.path.join(settings.CA_CONF_DIR,"email-bound-stub.cnf"),
-                    conf_stub_file_name)
+        stub_name = "email-bound-stub.cnf"
     else:
-        copyfile(os.path.join(settings.CA_CONF_DIR,"domain-bound-stub.cnf"),
-                    conf_stub_file_name)
-    
+        stub_name = "domain-bound-stub.cnf"
     
     #get the next serial number
-    fp = open("/opt/ca/conf/serial", "r")
-    serial = str(fp.read())
-    fp.close()
-    
-    # Modify the stub file
-    seddns = "s/|DNS|/%s/g" % (dns)
-    sedanchordns = "s/|ANCHORDNS|/%s/g" % (anchor_dns)
-    
-    sedcompletedanchordir = "s#|COMPLETED_ANCHOR_DIR|#%s#g" % (completed_anchor_dir)
-    seddays = "s/|DAYS|/%s/g" % (expires)
-    sedpublickey = "s#|CERTIFICATE|#%s#g" % (public_key_path)
-    sedprivatekey = "s#|PRIVATE_KEY|#%s#g" % (private_key_path)
-    sedserial = "s#|SERIAL|#%s#g" % (serial[:-1])
-    sedcountry = "s#|COUNTRY|#%s#g" % (country)
-    sedstate= "s#|STATE|#%s#g" % (state)
-    sedcity = "s#|CITY|#%s#g" % (city)
-    sedcommon_name =  "s#|COMMON_NAME|#%s#g" % (common_name)
-    sedorganization = "s#|ORGANIZATION|#%s#g" % (organization)
-    sedemail = "s#|EMAIL_ADDRESS|#%s#g" % (email)
-
-
-
-    error, output = subprocess.Popen(["sed", "-i", "-e", sedcompletedanchordir,
-                                      conf_stub_file_name],
-                                        stdout=subprocess.PIPE,
-                                        stderr= subprocess.PIPE
-                                        ).communicate()
-
-
-    error, output = subprocess.Popen(["sed", "-i", "-e", seddns,
-                                      conf_stub_file_name],
-                                        stdout=subprocess.PIPE,
-                                        stderr= subprocess.PIPE
-                                        ).communicate()
-    
-    error, output = subprocess.Popen(["sed", "-i", "-e", sedanchordns,
-                                      conf_stub_file_name],
-                                        stdout=subprocess.PIPE,
-                                        stderr= subprocess.PIPE
-                                        ).communicate()
-    
-    
-    
-    error, output = subprocess.Popen(["sed", "-i", "-e",
-                                      seddays, conf_stub_file_name],
-                                        stdout=subprocess.PIPE,
-                                        stderr= subprocess.PIPE
-                                        ).communicate()
-    
-    error, output = subprocess.Popen(["sed", "-i", "-e",
-                                      sedpublickey, conf_stub_file_name],
-                                        stdout=subprocess.PIPE,
-                                        stderr= subprocess.PIPE
-                                        ).communicate()
-    
-    error, output = subprocess.Popen(["sed", "-i", "-e",
-                                      sedprivatekey, conf_stub_file_name],
-                                        stdout=subprocess.PIPE,
-                                        stderr= subprocess.PIPE
-                                        ).communicate()
-
-    error, output = subprocess.Popen(["sed", "-i", "-e", sedserial, conf_stub_file_name],
-                                stdout=subprocess.PIPE,
-                                stderr= subprocess.PIPE
-                                ).communicate()      
-
-    
-    
-    error, output = subprocess.Popen(["sed", "-i", "-e", sedcountry,
-                                      conf_stub_file_name],
-                                        stdout=subprocess.PIPE,
-                                        stderr= subprocess.PIPE
-                                        ).communicate()
-    
-    error, output = subprocess.Popen(["sed", "-i", "-e", sedstate,
-                                      conf_stub_file_name],
-                                        stdout=subprocess.PIPE,
-                                        stderr= subprocess.PIPE
-                                        ).communicate()
-
-    error, output = subprocess.Popen(["sed", "-i", "-e", sedcity,
-                                      conf_stub_file_name],
-                                        stdout=subprocess.PIPE,
-                                        stderr= subprocess.PIPE
-                                        ).communicate()
-
-    error, output = subprocess.Popen(["sed", "-i", "-e", sedcommon_name,
-                                      conf_stub_file_name],
-                                        stdout=subprocess.PIPE,
-                                        stderr= subprocess.PIPE
-                                        ).communicate()
-    error, output = subprocess.Popen(["sed", "-i", "-e", sedorganization,
-                                      conf_stub_file_name],
-                                        stdout=subprocess.PIPE,
-                                        stderr= subprocess.PIPE
-                                        ).communicate()
-    
-    error, output = subprocess.Popen(["sed", "-i", "-e", sedemail,
-                                      conf_stub_file_name],
-                                        stdout=subprocess.PIPE,
-                                        stderr= subprocess.PIPE
-                                        ).communicate()
-    
+    serial, serial_file = write_serial_file(dirpath)
+    
+    conf = render_stub(stub_name, os.path.join(dirpath, conf_stub_file_name),
+                COMPLETED_ANCHOR_DIR = completed_anchor_dir,
+                DNS             = dns,
+                ANCHORDNS       = anchor_dns,
+                DAYS            = expires,
+                CERTIFICATE     = public_key_path,
+                PRIVATE_KEY     = private_key_path,
+                SERIAL          = serial,
+                SERIAL_FILE     = serial_file,
+                COUNTRY         = country,
+                STATE           = state,
+                CITY            = city,
+                COMMON_NAME     = common_name,
+                ORGANIZATION    = organization,
+                EMAIL_ADDRESS   = email)
     
     # Build the certificate from the signing request.
-    
-    error, signoutput = subprocess.Popen(["openssl", "ca", "-batch", "-config",
+    signoutput = openssl_ca_sign(parse_conf(conf),
+                            ["openssl", "ca", "-batch", "-config",
                              conf_stub_file_name, "-in", csrname, "-out",
                              public_cert_name],
-                             stdout=subprocess.PIPE,
-                             stderr= subprocess.PIPE
-                            ).communicate()
+                            dirpath, os.path.join(dirpath, public_cert_name),
+                            {"C": country, "ST": state, "L": city,
+                             "O": organization, "CN": common_name,
+                             "emailAddress": email})
   
-    print "Signing ----------------", output
+    print "Signing ----------------", signoutput
     
     #if the previous step fails, then 
-    if str(output.lower()).__contains__("failed to update database") or \
-       str(output).__contains__("unable to load CA private key"):
+    if str(signoutput.lower()).__contains__("failed to update database") or \
+       str(signoutput).__contains__("unable to load CA private key"):
         print "PUBLIC CERT NAME:", public_cert_name, "FAILED!!!!"
 
         result["status"] = "failed"
         result["notes"]  = signoutput
-        os.chdir(settings.BASE_DIR) 
         return result
         
     
@@ -651,7 +706,8 @@ def create_endpoint_certificate(common_name     = "foo.bar.org",
     output,error = subprocess.Popen(["openssl", "x509", "-in",
                                       public_cert_name, "-serial","-noout",],
                              stdout=subprocess.PIPE,
-                             stderr= subprocess.PIPE
+                             stderr= subprocess.PIPE,
+                             cwd = dirpath,
                             ).communicate()
     
     
@@ -661,7 +717,6 @@ def create_endpoint_certificate(common_name     = "foo.bar.org",
     except (IndexError):
         result["status"] = "failed"
         result["notes"]  = signoutput
-        os.chdir(settings.BASE_DIR) 
         return result
     
     
@@ -671,7 +726,8 @@ def create_endpoint_certificate(common_name     = "foo.bar.org",
     output,error = subprocess.Popen(["openssl", "x509", "-in",
                                       public_cert_name, "-fingerprint","-noout",],
                              stdout=subprocess.PIPE,
-                             stderr= subprocess.PIPE
+                             stderr= subprocess.PIPE,
+                             cwd = dirpath,
                             ).communicate()
     
 
@@ -686,7 +742,8 @@ def create_endpoint_certificate(common_name     = "foo.bar.org",
                                      public_cert_name, "-out",
                                      public_cert_name_der],
                              stdout=subprocess.PIPE,
-                             stderr= subprocess.PIPE
+                             stderr= subprocess.PIPE,
+                             cwd = dirpath,
                             ).communicate()
     
     #print "convert the private key in pem format to PCKS8 DER formatted private key file"
@@ -696,7 +753,8 @@ def create_endpoint_certificate(common_name     = "foo.bar.org",
                                      "-inform", "pem", "-outform", "der",
                                      "-nocrypt",],
                              stdout=subprocess.PIPE,
-                             stderr= subprocess.PIPE
+                             stderr= subprocess.PIPE,
+                             cwd = dirpath,
                             ).communicate()
 
     
@@ -715,14 +773,16 @@ def create_endpoint_certificate(common_name     = "foo.bar.org",
                                      privkeyname, "-in", public_cert_name,
                                      "-out", p12name, "-passout", "pass:"],
                              stdout=subprocess.PIPE,
-                             stderr= subprocess.PIPE
+                             stderr= subprocess.PIPE,
+                             cwd = dirpath,
                             ).communicate()
     #print output, error
     
 
     
     #create the sha1 digest of the DER.
-    sha256_digest = sha256_from_filepath(public_cert_name_der)
+    sha256_digest = sha256_from_filepath(os.path.join(dirpath,
+                                                      public_cert_name_der))
   
 
     #Since the anchor creation process completed, then built out the perm dirs
@@ -736,9 +796,8 @@ def create_endpoint_certificate(common_name     = "foo.bar.org",
     if os.path.exists(completed_this_endpoint):
         rmtree(completed_this_endpoint)
         
-    copytree(".", completed_this_endpoint)
+    copytree(dirpath, completed_this_endpoint)
         
-    os.chdir(completed_this_endpoint)
     
     crl_conf = os.path.join(completed_anchor_dir, "crl.cnf" )
     
@@ -746,7 +805,8 @@ def create_endpoint_certificate(common_name     = "foo.bar.org",
     #if a crl.cnf does not exist, then create it.
     if not os.path.exists(crl_conf):
         print conf_stub_file_name
-        copyfile(conf_stub_file_name, crl_conf)
+        copyfile(os.path.join(completed_this_endpoint, conf_stub_file_name),
+                 crl_conf)
         
     
     
@@ -757,7 +817,8 @@ def create_endpoint_certificate(common_name     = "foo.bar.org",
                                       privkeyname, PCKS8privkeyname, p12name
                                       ],
                                     stdout=subprocess.PIPE,
-                                    stderr= subprocess.PIPE
+                                    stderr= subprocess.PIPE,
+                                    cwd = completed_this_endpoint,
                                     ).communicate()
     
     #Private Key Path for PEM
@@ -777,8 +838,6 @@ def create_endpoint_certificate(common_name     = "foo.bar.org",
                    "completed_dir_path" :completed_this_endpoint
                    })
     
-    # Get back to the directory we started.
-    os.chdir(settings.BASE_DIR) 
 
     return result
 
@@ -818,7 +877,6 @@ def create_crl_conf(common_name     = "foo.bar.org",
     
     result = {"status": "failed"}
     
-    dirname = str(uuid.uuid4())[0:5]
     tname =  dns
     keysize = "rsa:" + str(rsakey)
     completed_user_dir = os.path.join(settings.CA_COMPLETED_DIR, user )
@@ -833,114 +891,23 @@ def create_crl_conf(common_name     = "foo.bar.org",
     
     conf_stub_file_name = tname  + "-crl-stub.cnf"
     conf_stub_file_path = os.path.join(completed_anchor_dir, conf_stub_file_name)
-    os.chdir(completed_anchor_dir)
-     
-    
-    #copy over the stub
-    copyfile(os.path.join(settings.CA_CONF_DIR,"crl-stub.cnf"),
-             os.path.join(completed_anchor_dir, conf_stub_file_name))
-    
-    
-    #get the next serial number
-    ##p = open("/opt/ca/conf/serial", "r")
-    #serial = str(fp.read())
-    #fp.close()
-    
-    # Modify the stub file --------------------------------------------
-    seddns = "s/|DNS|/%s/g" % (dns)
-    sedanchordns = "s/|ANCHORDNS|/%s/g" % (anchor_dns)
-    #prepare sed strings -----------------
-    sedcompletedanchordir = "s#|COMPLETED_ANCHOR_DIR|#%s#g" % (completed_anchor_dir)
-    seddays = "s/|DAYS|/%s/g" % (expires)
-    sedpublickey = "s#|CERTIFICATE|#%s#g" % (public_key_path)
-    sedprivatekey = "s#|PRIVATE_KEY|#%s#g" % (private_key_path)
-    sedcountry = "s#|COUNTRY|#%s#g" % (country)
-    sedstate= "s#|STATE|#%s#g" % (state)
-    sedcity = "s#|CITY|#%s#g" % (city)
-    sedcommon_name =  "s#|COMMON_NAME|#%s#g" % (common_name)
-    sedorganization = "s#|ORGANIZATION|#%s#g" % (organization)
-    sedemail = "s#|EMAIL_ADDRESS|#%s#g" % (email)
-
-
-    #use sed to modify the file.
-    error, output = subprocess.Popen(["sed", "-i", "-e", sedcompletedanchordir,
-                                      conf_stub_file_path],
-                                        stdout=subprocess.PIPE,
-                                        stderr= subprocess.PIPE
-                                        ).communicate()
-    error, output = subprocess.Popen(["sed", "-i", "-e", seddns,
-                                      conf_stub_file_path],
-                                        stdout=subprocess.PIPE,
-                                        stderr= subprocess.PIPE
-                                        ).communicate()
-    
-    error, output = subprocess.Popen(["sed", "-i", "-e", sedanchordns,
-                                      conf_stub_file_path],
-                                        stdout=subprocess.PIPE,
-                                        stderr= subprocess.PIPE
-                                        ).communicate()
-
-    
-    error, output = subprocess.Popen(["sed", "-i", "-e",
-                                      seddays, conf_stub_file_path],
-                                        stdout=subprocess.PIPE,
-                                        stderr= subprocess.PIPE
-                                        ).communicate()
-    
-    error, output = subprocess.Popen(["sed", "-i", "-e",
-                                      sedpublickey, conf_stub_file_path],
-                                        stdout=subprocess.PIPE,
-                                        stderr= subprocess.PIPE
-                                        ).communicate()
-    
-    error, output = subprocess.Popen(["sed", "-i", "-e",
-                                      sedprivatekey, conf_stub_file_path],
-                                        stdout=subprocess.PIPE,
-                                        stderr= subprocess.PIPE
-                                        ).communicate()
-
      
-    error, output = subprocess.Popen(["sed", "-i", "-e", sedcountry,
-                                      conf_stub_file_path],
-                                        stdout=subprocess.PIPE,
-                                        stderr= subprocess.PIPE
-                                        ).communicate()
-    
-    error, output = subprocess.Popen(["sed", "-i", "-e", sedstate,
-                                      conf_stub_file_path],
-                                        stdout=subprocess.PIPE,
-                                        stderr= subprocess.PIPE
-                                        ).communicate()
-
-    error, output = subprocess.Popen(["sed", "-i", "-e", sedcity,
-                                      conf_stub_file_path],
-                                        stdout=subprocess.PIPE,
-                                        stderr= subprocess.PIPE
-                                        ).communicate()
-
-    error, output = subprocess.Popen(["sed", "-i", "-e", sedcommon_name,
-                                      conf_stub_file_path],
-                                        stdout=subprocess.PIPE,
-                                        stderr= subprocess.PIPE
-                                        ).communicate()
-    error, output = subprocess.Popen(["sed", "-i", "-e", sedorganization,
-                                      conf_stub_file_path],
-                                        stdout=subprocess.PIPE,
-                                        stderr= subprocess.PIPE
-                                        ).communicate()
-    
-    error, output = subprocess.Popen(["sed", "-i", "-e", sedemail,
-                                      conf_stub_file_path],
-                                        stdout=subprocess.PIPE,
-                                        stderr= subprocess.PIPE
-                                        ).communicate()
-    
-
-    
     
+    #fill out the stub
+    render_stub("crl-stub.cnf", conf_stub_file_path,
+                COMPLETED_ANCHOR_DIR = completed_anchor_dir,
+                DNS             = dns,
+                ANCHORDNS       = anchor_dns,
+                DAYS            = expires,
+                CERTIFICATE     = public_key_path,
+                PRIVATE_KEY     = private_key_path,
+                COUNTRY         = country,
+                STATE           = state,
+                CITY            = city,
+                COMMON_NAME     = common_name,
+                ORGANIZATION    = organization,
+                EMAIL_ADDRESS   = email)
     
     
-    # Get back to the directory we started.
-    os.chdir(settings.BASE_DIR) 
     result = {"status": "success"}
     return result
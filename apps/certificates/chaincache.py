@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+Certificate chain material for the x5c (JOSE) files and -chain.pem files
+verification publishes.
+
+Each certificate file (the CA's, an anchor's, an endpoint's) is read and
+split into its PEM blocks and their base64 DER once, and kept until the
+file's mtime, size or inode changes, so verifying certificate after
+certificate does not re-read and re-scan the CA certificate every time.
+A chain is assembled from memory, and its -chain.pem is only written
+when it is missing or its content would change.
+
+    from chaincache import chain_cache
+    x5c = chain_cache.write_chain(chain_path, [settings.CA_PUBLIC_CERT,
+                                               anchor_pem_path])
+"""
+
+import os, re, threading
+
+PEM_BLOCK = re.compile('-----BEGIN CERTIFICATE-----$\n(.*?)\n^-----END CERTIFICATE-----',
+                       re.DOTALL | re.MULTILINE)
+
+
+def stat_key(path):
+    st = os.stat(path)
+    return st.st_mtime, st.st_size, st.st_ino
+
+
+class ChainCache(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {}     # path -> (stat key, text, [base64 DER])
+        self.written = {}   # chain path -> (stat key, text)
+        self.loads = 0
+        self.writes = 0
+
+    def material(self, path):
+        """The text of the certificate file at path and its x5c entries."""
+        key = stat_key(path)
+        with self.lock:
+            cached = self.files.get(path)
+        if cached and cached[0] == key:
+            return cached[1], cached[2]
+        with open(path) as f:
+            text = f.read()
+        x5c = [c.replace('\n', '') for c in PEM_BLOCK.findall(text)]
+        with self.lock:
+            self.files[path] = (key, text, x5c)
+            self.loads += 1
+        return text, x5c
+
+    def chain(self, filenames):
+        """The chain PEM of filenames, in order, and its x5c list."""
+        texts, x5c = [], []
+        for path in filenames:
+            text, entries = self.material(path)
+            texts.append(text)
+            x5c.extend(entries)
+        return "".join(texts), x5c
+
+    def write_chain(self, outpath, filenames):
+        """Write the chain PEM to outpath if it changed; return its x5c."""
+        text, x5c = self.chain(filenames)
+        with self.lock:
+            written = self.written.get(outpath)
+        try:
+            current = stat_key(outpath)
+        except OSError:
+            current = None
+        if not (written and written == (current, text)):
+            f = open(outpath, 'w')
+            f.write(text)
+            f.close()
+            with self.lock:
+                self.written[outpath] = (stat_key(outpath), text)
+                self.writes += 1
+        return x5c
+
+
+chain_cache = ChainCache()
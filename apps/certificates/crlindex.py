@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+Revoked serial lookups against large CRLs.
+
+A CRL (PEM or DER) is walked once, without building an object per entry,
+and its serials are written next to it as a sorted array of fixed width
+big-endian integers (crl + ".idx"). Lookups memory-map that file and
+binary search it, so a million-entry CRL costs a few pages of memory and
+about twenty comparisons per serial.
+
+    from crlindex import CRLIndexSet
+    crls = CRLIndexSet(["global-crl.pem", "anchor.org.crl"])
+    crls.is_revoked("0A")           # hex as openssl prints it, or an int
+
+The index is rebuilt whenever the CRL is newer than it. The CRL's
+signature is not checked here.
+"""
+
+import os, mmap, struct, binascii
+
+MAGIC = "CRLIDX1\n"
+HEADER = struct.Struct(">II")   # width, count
+
+SEQUENCE = 0x30
+INTEGER = 0x02
+UTC_TIME = 0x17
+GENERALIZED_TIME = 0x18
+
+
+def der_header(buf, pos):
+    """The tag, content start and content end of the DER element at pos."""
+    tag = ord(buf[pos])
+    length = ord(buf[pos + 1])
+    pos += 2
+    if length & 0x80:
+        n = length & 0x7f
+        length = int(binascii.hexlify(buf[pos:pos + n]), 16)
+        pos += n
+    return tag, pos, pos + length
+
+
+def crl_der(path):
+    """
+    The DER bytes of the CRL at path: a read-only mmap for a DER file, a
+    string decoded line by line for PEM.
+    """
+    f = open(path, "rb")
+    try:
+        if f.read(1) == chr(SEQUENCE):
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        f.seek(0)
+        chunks, inside = [], False
+        for line in f:
+            if line.startswith("-----BEGIN"):
+                inside = True
+            elif line.startswith("-----END"):
+                break
+            elif inside:
+                chunks.append(binascii.a2b_base64(line))
+        return "".join(chunks)
+    finally:
+        f.close()
+
+
+def iter_serials(der):
+    """The serials a DER CRL lists, as big-endian bytes, in CRL order."""
+    tag, pos, end = der_header(der, 0)              # CertificateList
+    tag, pos, tbs_end = der_header(der, pos)        # tbsCertList
+    tag, start, pos = der_header(der, pos)
+    if tag == INTEGER:                              # version
+        tag, start, pos = der_header(der, pos)      # signature
+    tag, start, pos = der_header(der, pos)          # issuer
+    tag, start, pos = der_header(der, pos)          # thisUpdate
+    if pos >= tbs_end:
+        return
+    tag, start, end = der_header(der, pos)
+    if tag in (UTC_TIME, GENERALIZED_TIME):         # nextUpdate
+        if end >= tbs_end:
+            return
+        tag, start, end = der_header(der, end)
+    if tag != SEQUENCE:                             # no revokedCertificates
+        return
+    pos = start
+    while pos < end:
+        tag, entry, entry_end = der_header(der, pos)
+        tag, start, stop = der_header(der, entry)   # userCertificate
+        yield der[start:stop].lstrip("\x00")
+        pos = entry_end
+
+
+def serial_bytes(serial):
+    """A serial given as an int or a hex string, as big-endian bytes."""
+    if isinstance(serial, (int, long)):
+        serial = "%x" % (serial)
+    serial = serial.replace(":", "")
+    if len(serial) % 2:
+        serial = "0" + serial
+    return binascii.unhexlify(serial).lstrip("\x00")
+
+
+def format_serial(serial):
+    """Big-endian bytes as openssl prints a serial, "0A"."""
+    return binascii.hexlify(serial).upper() or "00"
+
+
+def build_index(crl_path, index_path=None):
+    """Write the index of the CRL at crl_path. Returns its path."""
+    index_path = index_path or crl_path + ".idx"
+    serials = set(iter_serials(crl_der(crl_path)))
+    width = max([len(s) for s in serials] or [1])
+    serials = sorted([s.rjust(width, "\x00") for s in serials])
+    tmp = "%s.%s.tmp" % (index_path, os.getpid())
+    f = open(tmp, "wb")
+    f.write(MAGIC)
+    f.write(HEADER.pack(width, len(serials)))
+    f.write("".join(serials))
+    f.close()
+    os.rename(tmp, index_path)
+    return index_path
+
+
+class CRLIndex(object):
+    """The memory-mapped index of one CRL."""
+
+    def __init__(self, crl_path, index_path=None):
+        self.crl_path = crl_path
+        self.index_path = index_path or crl_path + ".idx"
+        if (not os.path.exists(self.index_path) or
+            os.path.getmtime(self.index_path) < os.path.getmtime(crl_path)):
+            build_index(crl_path, self.index_path)
+        f = open(self.index_path, "rb")
+        try:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        if self.map[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s is not a CRL index" % (self.index_path))
+        self.width, self.count = HEADER.unpack_from(self.map, len(MAGIC))
+        self.offset = len(MAGIC) + HEADER.size
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for i in xrange(self.count):
+            start = self.offset + i * self.width
+            yield format_serial(self.map[start:start + self.width].lstrip("\x00"))
+
+    def is_revoked(self, serial):
+        key = serial_bytes(serial)
+        if len(key) > self.width:
+            return False
+        key = key.rjust(self.width, "\x00")
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self.offset + mid * self.width
+            value = self.map[start:start + self.width]
+            if value < key:
+                lo = mid + 1
+            elif value > key:
+                hi = mid
+            else:
+                return True
+        return False
+
+    def close(self):
+        self.map.close()
+
+
+class CRLIndexSet(object):
+    """Lookups across several CRLs: revoked if any of them lists the serial."""
+
+    def __init__(self, crl_paths):
+        self.indexes = [CRLIndex(p) for p in crl_paths]
+
+    def revoked_by(self, serial):
+        """The path of the first CRL listing serial, or None."""
+        for index in self.indexes:
+            if index.is_revoked(serial):
+                return index.crl_path
+        return None
+
+    def is_revoked(self, serial):
+        return self.revoked_by(serial) is not None
+
+    def close(self):
+        for index in self.indexes:
+            index.close()
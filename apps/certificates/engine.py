@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+In-process issuance engine.
+
+Builds the same artifacts as the openssl/sed/zip subprocess chain in
+cautils.create_endpoint_certificate, but with pyOpenSSL and cryptography so
+a certificate costs no fork/exec and no temp-file churn. The filled-in stub
+config is still written next to the certificate and is honoured exactly as
+`openssl ca` would (policy, new_certs_dir, database, extensions), so
+revocation and CRL generation keep working against the same files. Serials
+come from serials.next_serial(), as they do for the subprocess path.
+
+Select it with CA_ISSUANCE_ENGINE = "inprocess" in settings.
+"""
+
+from django.utils.datastructures import SortedDict
+import os, uuid, fcntl, zipfile
+from shutil import copyfile, rmtree
+from OpenSSL import crypto
+from cryptography.hazmat.primitives import serialization
+from stubs import get_stub
+from keypool import get_key
+from serials import next_serial, format_serial
+from sha import sha256_from_bytes
+import castore
+
+
+# openssl x509 -noout -text names these fields by their short names.
+DN_SHORT_NAMES = SortedDict([('countryName',             'C'),
+                             ('stateOrProvinceName',     'ST'),
+                             ('localityName',            'L'),
+                             ('organizationName',        'O'),
+                             ('organizationalUnitName',  'OU'),
+                             ('commonName',              'CN'),
+                             ('emailAddress',            'emailAddress')])
+
+
+class IssuanceError(Exception):
+    """Raised when the request cannot be signed. The message mirrors the
+    openssl ca output so it can be stored in the certificate notes."""
+    pass
+
+
+def parse_conf(text):
+    """Parse an OpenSSL config into {section: SortedDict(name: value)}."""
+    sections = SortedDict()
+    current = sections.setdefault("default", SortedDict())
+    for line in text.splitlines():
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        if line.startswith("[") and line.endswith("]"):
+            current = sections.setdefault(line[1:-1].strip(), SortedDict())
+        elif "=" in line:
+            name, value = line.split("=", 1)
+            current[name.strip()] = value.strip()
+    return sections
+
+
+def subject_oneline(name):
+    return "".join(["/%s=%s" % (k, v) for k, v in name.get_components()])
+
+
+def index_expiry(cert):
+    # ASN1 GeneralizedTime YYYYMMDDHHMMSSZ -> UTCTime YYMMDDHHMMSSZ
+    return cert.get_notAfter()[2:]
+
+
+def write_file(path, content):
+    f = open(path, "wb")
+    f.write(content)
+    f.close()
+
+
+class locked_file(object):
+    """Hold an exclusive flock on path for the duration of a with block."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self.fp = open(self.path, "a+")
+        fcntl.flock(self.fp.fileno(), fcntl.LOCK_EX)
+        return self.fp
+
+    def __exit__(self, *args):
+        fcntl.flock(self.fp.fileno(), fcntl.LOCK_UN)
+        self.fp.close()
+
+
+def database_lock(conf):
+    """
+    Serialise updates to the index database named in conf. openssl ca
+    replaces the index by renaming a new copy over it, so the lock is a
+    separate file rather than the index itself.
+    """
+    ca = conf[conf["ca"]["default_ca"]]
+    return locked_file(ca["database"] + ".lock")
+
+
+def policy_subject(conf, values):
+    """
+    The subject line openssl ca records in the index for a request with
+    these {short name: value} fields: ordered by the policy section, empty
+    fields dropped.
+    """
+    ca = conf[conf["ca"]["default_ca"]]
+    return "".join(["/%s=%s" % (DN_SHORT_NAMES[field],
+                                values[DN_SHORT_NAMES[field]])
+                    for field in conf[ca["policy"]]
+                    if values.get(DN_SHORT_NAMES[field])])
+
+
+def duplicate_subject_error(subject):
+    return IssuanceError("ERROR:There is already a certificate for %s\n"
+                         "failed to update database" % (subject))
+
+
+def build_request(key, email, country, state, city, common_name, organization,
+                  digest="sha256"):
+    """The in-process equivalent of openssl req -subj ... -new"""
+    req = crypto.X509Req()
+    subj = req.get_subject()
+    # Same order as the -subj string used by the subprocess path.
+    subj.emailAddress = email
+    subj.C = country
+    subj.ST = state
+    subj.L = city
+    subj.CN = common_name
+    subj.O = organization
+    req.set_pubkey(key)
+    req.sign(key, digest)
+    return req
+
+
+def sign_request(req, conf, serial, passphrase=None):
+    """
+    The in-process equivalent of `openssl ca -batch -config conf -in req`,
+    signing with the given serial. Returns the signed crypto.X509. Updates
+    the index database named in conf exactly as openssl ca does.
+    """
+    ca_name = conf["ca"]["default_ca"]
+    ca = conf[ca_name]
+
+    with open(ca["certificate"], 'r') as f:
+        issuer_cert = crypto.load_certificate(crypto.FILETYPE_PEM, f.read())
+    with open(ca["private_key"], 'r') as f:
+        if passphrase:
+            issuer_key = crypto.load_privatekey(crypto.FILETYPE_PEM, f.read(),
+                                                passphrase)
+        else:
+            issuer_key = crypto.load_privatekey(crypto.FILETYPE_PEM, f.read())
+
+    # Order and check the subject according to the policy section.
+    requested = dict(req.get_subject().get_components())
+    issuer_subject = dict(issuer_cert.get_subject().get_components())
+    cert = crypto.X509()
+    subject = cert.get_subject()
+    for field, rule in conf[ca["policy"]].items():
+        short = DN_SHORT_NAMES[field]
+        value = requested.get(short)
+        if rule == "match" and value != issuer_subject.get(short):
+            raise IssuanceError("The %s field is different between\n"
+                                "CA certificate (%s) and the request (%s)" % (
+                                field, issuer_subject.get(short), value))
+        if rule == "supplied" and not value:
+            raise IssuanceError("The %s field needed to be supplied and "
+                                "was missing" % (field))
+        if value:
+            setattr(subject, short, value)
+
+    cert.set_version(2)
+    cert.set_issuer(issuer_cert.get_subject())
+    cert.set_pubkey(req.get_pubkey())
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(int(ca["default_days"]) * 24 * 60 * 60)
+
+    database = ca["database"]
+    cert.set_serial_number(serial)
+
+    extensions = []
+    for name, value in conf[ca["x509_extensions"]].items():
+        critical = value.startswith("critical")
+        if critical:
+            value = value.split(",", 1)[1].strip()
+        extensions.append(crypto.X509Extension(name, critical, value,
+                                               subject=cert,
+                                               issuer=issuer_cert))
+    cert.add_extensions(extensions)
+    cert.sign(issuer_key, ca.get("default_md", "sha256"))
+
+    serial_hex = format_serial(serial)
+    oneline = subject_oneline(subject)
+    index_line = "V\t%s\t\t%s\tunknown\t%s\n" % (index_expiry(cert),
+                                                  serial_hex, oneline)
+    with database_lock(conf):
+        if castore.store_enabled():
+            # The store answers unique_subject from an index; the index
+            # file is only appended to.
+            if castore.subject_in_use(database, oneline):
+                raise duplicate_subject_error(oneline)
+            castore.relax_index_attr(database)
+            db = open(database, "a")
+            db.write(index_line)
+            db.close()
+            castore.record_issued(database, serial_hex, oneline,
+                        castore.parse_index_time(cert.get_notAfter()))
+        else:
+            db = open(database, "a+")
+            try:
+                db.seek(0)
+                for line in db:
+                    fields = line.rstrip("\n").split("\t")
+                    if len(fields) == 6 and fields[0] == "V" and \
+                       fields[5] == oneline:
+                        raise duplicate_subject_error(oneline)
+                db.write(index_line)
+            finally:
+                db.close()
+
+            if not os.path.exists(database + ".attr"):
+                write_file(database + ".attr", "unique_subject = yes\n")
+
+    # openssl ca keeps a copy of every certificate it signs.
+    write_file(os.path.join(ca["new_certs_dir"], serial_hex + ".pem"),
+               dump_certificate(cert))
+    return cert
+
+
+def dump_certificate(cert):
+    """The PEM with the text dump in front, like openssl ca -out writes."""
+    return crypto.dump_certificate(crypto.FILETYPE_TEXT, cert) + \
+           crypto.dump_certificate(crypto.FILETYPE_PEM, cert)
+
+
+def issue_endpoint_certificate(common_name     = "foo.bar.org",
+                               email           = "foo.bar.org",
+                               dns             = "foo.bar.org",
+                               anchor_dns      = "bar.org",
+                               expires         = 1095,
+                               organization    = "NIST",
+                               city            = "Gaithersburg",
+                               state           = "MD",
+                               country         = "US",
+                               rsakey          = 4096,
+                               user            = "",
+                               private_key_path = "",
+                               public_key_path  = "",
+                               completed_anchor_dir = ""):
+    """Drop-in replacement for cautils.create_endpoint_certificate."""
+
+    result = {  "sha256_digest":                      "",
+                "anchor_zip_download_file_name":      "",
+                "status":                             "failed",
+                "serial_number":                      "-01",
+                "sha1_fingerprint":                   "",
+                "private_key_path":                   "",
+                "public_key_path":                    "",
+                "notes":                              "Certificate generation in process.",
+                "completed_dir_path":                 ""}
+
+    tname =  dns
+    csrname = tname + ".csr"
+    privkeyname = tname + "Key.key"         # Private key in pem format
+    PCKS8privkeyname  = tname + "Key.der"   # PCKS8 DER formatted private key file
+    p12name = tname + ".p12"                # p12 formatted private and public keys
+    public_cert_name =  tname + ".pem"      #pubic certificate as a PEM
+    public_cert_name_der =  tname + ".der"  # pubic certificate as a der
+    conf_stub_file_name = tname  + "domain-bound-stub.cnf"
+    anchor_zip_download_file_name = str(uuid.uuid4()) + "-" + tname + "-ENDPOINT.zip"
+
+    completed_endpoint_dir = os.path.join(completed_anchor_dir, "endpoints/")
+    completed_this_endpoint = os.path.join(completed_endpoint_dir, dns, )
+
+    if email.__contains__("@"):
+        stub_name = "email-bound-stub.cnf"
+    else:
+        stub_name = "domain-bound-stub.cnf"
+
+    # Create the key and the signing request.
+    key = get_key(rsakey)
+    req = build_request(key, email, country, state, city, common_name,
+                        organization)
+
+    values = {"COMPLETED_ANCHOR_DIR": completed_anchor_dir,
+              "DNS":                  dns,
+              "ANCHORDNS":            anchor_dns,
+              "DAYS":                 expires,
+              "CERTIFICATE":          public_key_path,
+              "PRIVATE_KEY":          private_key_path,
+              "COUNTRY":              country,
+              "STATE":                state,
+              "CITY":                 city,
+              "COMMON_NAME":          common_name,
+              "ORGANIZATION":         organization,
+              "EMAIL_ADDRESS":        email}
+
+    # Build the certificate from the signing request.
+    try:
+        serial = next_serial()
+        values["SERIAL"] = format_serial(serial)
+        values["SERIAL_FILE"] = os.path.join(completed_this_endpoint, "serial")
+        stub = get_stub(stub_name).render(values)
+        cert = sign_request(req, parse_conf(stub), serial)
+    except (IssuanceError, crypto.Error, IOError, KeyError), e:
+        print "PUBLIC CERT NAME:", public_cert_name, "FAILED!!!!"
+        result["status"] = "failed"
+        result["notes"]  = str(e)
+        return result
+
+    serial_number = format_serial(cert.get_serial_number())
+    sha1_fingerprint = cert.digest("sha1")
+    cryptography_key = key.to_cryptography_key()
+
+    artifacts = SortedDict()
+    artifacts[public_cert_name] = dump_certificate(cert)
+    artifacts[public_cert_name_der] = crypto.dump_certificate(
+                                                crypto.FILETYPE_ASN1, cert)
+    artifacts[privkeyname] = cryptography_key.private_bytes(
+                                serialization.Encoding.PEM,
+                                serialization.PrivateFormat.PKCS8,
+                                serialization.NoEncryption())
+    artifacts[PCKS8privkeyname] = cryptography_key.private_bytes(
+                                serialization.Encoding.DER,
+                                serialization.PrivateFormat.PKCS8,
+                                serialization.NoEncryption())
+    p12 = crypto.PKCS12()
+    p12.set_privatekey(key)
+    p12.set_certificate(cert)
+    artifacts[p12name] = p12.export(passphrase="")
+
+    sha256_digest = sha256_from_bytes(artifacts[public_cert_name_der])
+
+    # Write everything straight into the completed directory.
+    if not os.path.exists(completed_endpoint_dir):
+        os.makedirs(completed_endpoint_dir)
+    if os.path.exists(completed_this_endpoint):
+        rmtree(completed_this_endpoint)
+    os.makedirs(completed_this_endpoint)
+
+    write_file(os.path.join(completed_this_endpoint, csrname),
+               crypto.dump_certificate_request(crypto.FILETYPE_PEM, req))
+    write_file(os.path.join(completed_this_endpoint, conf_stub_file_name), stub)
+    # What openssl ca leaves in the serial file named in the config.
+    write_file(values["SERIAL_FILE"], format_serial(serial + 1) + "\n")
+    for name, content in artifacts.items():
+        write_file(os.path.join(completed_this_endpoint, name), content)
+
+    #if a crl.cnf does not exist, then create it.
+    crl_conf = os.path.join(completed_anchor_dir, "crl.cnf" )
+    if not os.path.exists(crl_conf):
+        copyfile(os.path.join(completed_this_endpoint, conf_stub_file_name),
+                 crl_conf)
+
+    #create the zip file containing the private and public keys)
+    z = zipfile.ZipFile(os.path.join(completed_this_endpoint,
+                                     anchor_zip_download_file_name),
+                        "w", zipfile.ZIP_DEFLATED)
+    for name, content in artifacts.items():
+        z.writestr(name, content)
+    z.close()
+
+    result.update({"sha256_digest":  sha256_digest,
+                   "anchor_zip_download_file_name": anchor_zip_download_file_name,
+                   "notes": "",
+                   "serial_number" : serial_number,
+                   "status": "unverified",
+                   "sha1_fingerprint": sha1_fingerprint,
+                   "private_key_path": os.path.join(completed_this_endpoint,
+                                                    privkeyname),
+                   "public_key_path": os.path.join(completed_this_endpoint,
+                                                   public_cert_name),
+                   "completed_dir_path" :completed_this_endpoint
+                   })
+    return result
@@ -2,7 +2,7 @@
 
 
 from django.conf import settings
-import sys, os, re
+import sys, os, re, threading
 from boto.s3.connection import S3Connection
 from boto.exception import S3CreateError
 from boto.s3.key import Key
@@ -46,6 +46,59 @@ AWS_SECRET_ACCESS_KEY_ACCESS_KEY='*****PUT_YOUR_SECRET_KEY_HERE****'
 
 
 
+class S3ConnectionPool(object):
+    """
+    S3 connections shared by everything in a process. Each thread gets its
+    own S3Connection, made on first use, whose HTTPS connections boto keeps
+    alive between requests; bucket handles are made once per connection
+    without a round trip, and each bucket is created (or found) only the
+    first time the process uploads to it. A forked child starts afresh.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.local = threading.local()
+        self.ensured = set()
+
+    def connection(self):
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.local = threading.local()
+                    self.ensured = set()
+                    self.pid = os.getpid()
+        conn = getattr(self.local, "connection", None)
+        if conn is None:
+            conn = S3Connection(settings.AWS_ACCESS_KEY_ID,
+                                settings.AWS_SECRET_ACCESS_KEY,
+                                **settings.AWS_S3_CONNECTION)
+            self.local.connection = conn
+            self.local.buckets = {}
+        return conn
+
+    def bucket(self, name, create=False):
+        conn = self.connection()
+        b = self.local.buckets.get(name)
+        if b is None:
+            if create and name not in self.ensured:
+                try:
+                    b = conn.create_bucket(name)
+                except(S3CreateError):
+                    b = conn.get_bucket(name, validate=False)
+                with self.lock:
+                    self.ensured.add(name)
+            else:
+                b = conn.get_bucket(name, validate=False)
+            self.local.buckets[name] = b
+        return b
+
+    def reset(self):
+        """Drop this thread's connection, after an error, to start over."""
+        self.local.connection = None
+
+
+s3pool = S3ConnectionPool()
 
 
 class SimpleS3:
@@ -60,10 +113,7 @@ class SimpleS3:
 
         try:
             
-            conn = S3Connection(settings.AWS_ACCESS_KEY_ID,
-                                   settings.AWS_SECRET_ACCESS_KEY)
-         
-            b = conn.get_bucket(bucket_name)
+            b = s3pool.bucket(bucket_name)
             k = Key(b)
             k.key=key_name
             k.delete()
@@ -71,6 +121,7 @@ class SimpleS3:
             
         except:
             print sys.exc_info()
+            s3pool.reset()
             return ""
         finally:
             return ""
@@ -86,14 +137,7 @@ class SimpleS3:
             """Store a file in s3"""
             url=""
             try:
-                conn= S3Connection(settings.AWS_ACCESS_KEY_ID,
-                                   settings.AWS_SECRET_ACCESS_KEY)
-                try:
-                    b = conn.create_bucket(bucket)
-                except(S3CreateError):
-                    #print "ERROR"
-                    #print sys.exc_info()
-                    b = conn.get_bucket(bucket)
+                b = s3pool.bucket(bucket, create=True)
                     
                 k=Key(b)
                 k.key=filename
@@ -109,19 +153,23 @@ class SimpleS3:
                 #print "MIME Type = %s" % (mime)
                 k.set_metadata("Content-Type", mime)
                 
-                x=k.set_contents_from_filename(local_filepath)
-                if public==True:
-                    k.set_acl("public-read")
+                # A public object's ACL goes with the upload, not after it.
+                x=k.set_contents_from_filename(local_filepath,
+                            policy="public-read" if public==True else None)
                 
-                url = "http://%s.s3.amazonaws.com/%s" % (bucket, k.key)
-                if https:
-                    url = "https://%s.s3.amazonaws.com/%s" % (bucket, k.key)
+                url = self.url(k.key, bucket, https)
             except:
                 print sys.exc_info()
+                s3pool.reset()
                 return url
             finally:
                 return url
 
+    def url(self, filename, bucket=settings.AWS_BUCKET, https=False):
+        """The URL store_in_s3 gives filename in bucket."""
+        return "%s://%s.s3.amazonaws.com/%s" % ("https" if https else "http",
+                                                bucket, filename)
+
             
 #Store a file in s3
     def get_presignedurl (self, filename,
@@ -129,9 +177,7 @@ class SimpleS3:
                      public=False, presigned_seconds = 604800):
             url=""
             try:
-                conn= S3Connection(settings.AWS_ACCESS_KEY_ID,
-                                   settings.AWS_SECRET_ACCESS_KEY)
-                b = conn.get_bucket(bucket)
+                b = s3pool.bucket(bucket)
                 k=Key(b)
                 k.key=filename
 
@@ -166,14 +212,11 @@ class SimpleS3:
         return url
 
     #Get a file from s3
-    def get_from_s3 (bucket, filename, local_filepath ):
+    def get_from_s3 (self, bucket, filename, local_filepath ):
             """Get a file from s3"""
             retval = False
             try:
-                conn= S3Connection(AWS_ACCESS_KEY,
-                                   AWS_SECRET_ACCESS_KEY_ACCESS_KEY)
-
-                b = conn.get_bucket(bucket)
+                b = s3pool.bucket(bucket)
                 k = Key(b)
                 k.key = filename
                 k.get_contents_to_filename(local_filepath)
@@ -181,6 +224,7 @@ class SimpleS3:
             except:
                 #print "Error in get_from_s3"
                 #print sys.exc_info()
+                s3pool.reset()
                 return retval
             finally:
                 return retval
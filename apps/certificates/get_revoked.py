@@ -3,25 +3,38 @@
 # vim: ai ts=4 sts=4 et sw=4
 
 
-import OpenSSL
 import json, sys
+from crlindex import crl_der, iter_serials, format_serial, CRLIndexSet
 
 def get_revoked_serials(path_to_crl):
-    revoked_list = []
-    with open(path_to_crl, 'r') as _crl_file:
-        crl = "".join(_crl_file.readlines())
-    
-    crl_object = OpenSSL.crypto.load_crl(OpenSSL.crypto.FILETYPE_PEM, crl)
-    
-    revoked_objects = crl_object.get_revoked()
-    
-    for rvk in revoked_objects:
-        revoked_list.append(rvk.get_serial())
-    return revoked_list
+    """The serials a CRL (PEM or DER) lists, as openssl prints them."""
+    return [format_serial(s) for s in iter_serials(crl_der(path_to_crl))]
+
+def check_serials(serials_file, crl_paths):
+    """Print each serial in serials_file (one per line) and its status."""
+    crls = CRLIndexSet(crl_paths)
+    revoked = 0
+    with open(serials_file, 'r') as f:
+        for line in f:
+            serial = line.strip()
+            if not serial:
+                continue
+            crl = crls.revoked_by(serial)
+            if crl:
+                revoked += 1
+                print "%s revoked %s" % (serial, crl)
+            else:
+                print "%s good" % (serial)
+    crls.close()
+    return revoked
 
 if __name__ == "__main__":
+    if len(sys.argv) > 3 and sys.argv[1] == "-c":
+        check_serials(sys.argv[2], sys.argv[3:])
+        sys.exit(0)
     if len(sys.argv)!=2:
         print "Usage: python get_revoked.py [filepath]"
+        print "       python get_revoked.py -c [serials file] [filepath ...]"
         sys.exit(1)
     rs = get_revoked_serials(sys.argv[1])
-    print json.dumps(rs)
\ No newline at end of file
+    print json.dumps(rs)
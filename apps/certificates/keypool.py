@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+A pool of pre-generated RSA keys.
+
+Generating a 4096 bit key is most of the CPU time of an issuance request.
+The pool keeps CA_KEYPOOL_SIZES[bits] keys per size in CA_KEYPOOL_DIR/<bits>/,
+each one an encrypted PKCS#8 PEM file. scripts/fill_keypool.py refills it in the
+background across all cores; issuance takes a key with one rename.
+
+    from keypool import get_key
+    key = get_key(4096)     # a crypto.PKey, from the pool when it has one
+"""
+
+from django.conf import settings
+import os, errno, uuid, threading, multiprocessing
+from OpenSSL import crypto
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+
+_lock = threading.Lock()
+_names = {}     # bits -> key file names this process has listed but not tried
+_stats = {"hits": 0, "misses": 0, "low_water": 0}
+
+
+def pool_enabled():
+    return getattr(settings, "CA_KEYPOOL_ENABLED", False)
+
+
+def pool_dir(bits):
+    return os.path.join(settings.CA_KEYPOOL_DIR, str(bits))
+
+
+def _passphrase():
+    return str(settings.CA_KEYPOOL_PASSWORD)
+
+
+def generate_encrypted_key(bits, passphrase):
+    """Create a key and return it as an encrypted PKCS#8 PEM."""
+    key = rsa.generate_private_key(public_exponent=65537, key_size=bits,
+                                   backend=default_backend())
+    return key.private_bytes(serialization.Encoding.PEM,
+                             serialization.PrivateFormat.PKCS8,
+                             serialization.BestAvailableEncryption(passphrase))
+
+
+def _generate(args):
+    bits, passphrase = args
+    return bits, generate_encrypted_key(bits, passphrase)
+
+
+def generate_key(bits):
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, int(bits))
+    return key
+
+
+def level(bits):
+    """The number of keys of this size waiting in the pool."""
+    try:
+        return len([n for n in os.listdir(pool_dir(bits))
+                    if n.endswith(".pem")])
+    except OSError:
+        return 0
+
+
+def _next_name(bits):
+    names = _names.get(bits)
+    if not names:
+        try:
+            names = [n for n in os.listdir(pool_dir(bits)) if n.endswith(".pem")]
+        except OSError:
+            names = []
+        _names[bits] = names
+    if names:
+        return names.pop()
+    return None
+
+
+def take_key(bits):
+    """
+    Claim one pooled key of this size. Returns a crypto.PKey, or None if the
+    pool is empty. Each key is handed out once, across all processes: the
+    claim is an atomic rename out of the pool directory.
+    """
+    bits = int(bits)
+    directory = pool_dir(bits)
+    while True:
+        with _lock:
+            name = _next_name(bits)
+        if name is None:
+            return None
+        path = os.path.join(directory, name)
+        claimed = os.path.join(directory, name[:-4] + ".claimed")
+        try:
+            os.rename(path, claimed)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                # Another process got it first.
+                continue
+            raise
+        try:
+            with open(claimed, "r") as f:
+                pem = f.read()
+        finally:
+            os.remove(claimed)
+        return crypto.load_privatekey(crypto.FILETYPE_PEM, pem, _passphrase())
+
+
+def get_key(bits):
+    """
+    A key of this size, from the pool when the pool is enabled and has one,
+    otherwise generated inline.
+    """
+    if not pool_enabled():
+        return generate_key(bits)
+
+    key = take_key(bits)
+    with _lock:
+        if key is None:
+            _stats["misses"] += 1
+        else:
+            _stats["hits"] += 1
+    if key is None:
+        return generate_key(bits)
+
+    # What this process last saw in the pool, so no extra directory scan.
+    with _lock:
+        if len(_names.get(int(bits), [])) < settings.CA_KEYPOOL_LOW_WATER:
+            _stats["low_water"] += 1
+    return key
+
+
+def stats():
+    """Hit/miss/low-water counters for this process and the pool levels."""
+    with _lock:
+        s = dict(_stats)
+    total = s["hits"] + s["misses"]
+    s["hit_rate"] = float(s["hits"]) / total if total else 0.0
+    s["levels"] = dict([(bits, level(bits))
+                        for bits in settings.CA_KEYPOOL_SIZES])
+    return s
+
+
+def fill(processes=None):
+    """
+    Top up every size in CA_KEYPOOL_SIZES, generating the missing keys in a
+    process pool (one process per core by default). Returns {bits: added}.
+    """
+    wanted = []
+    for bits, size in settings.CA_KEYPOOL_SIZES.items():
+        if not os.path.exists(pool_dir(bits)):
+            os.makedirs(pool_dir(bits), 0700)
+        wanted.extend([(bits, _passphrase())] * max(size - level(bits), 0))
+
+    added = dict([(bits, 0) for bits in settings.CA_KEYPOOL_SIZES])
+    if not wanted:
+        return added
+
+    pool = multiprocessing.Pool(processes or multiprocessing.cpu_count())
+    try:
+        for bits, pem in pool.imap_unordered(_generate, wanted):
+            name = "%s.pem" % (uuid.uuid4())
+            tmp = os.path.join(pool_dir(bits), name + ".tmp")
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+            os.write(fd, pem)
+            os.close(fd)
+            # Only whole files ever appear under a .pem name.
+            os.rename(tmp, os.path.join(pool_dir(bits), name))
+            added[bits] += 1
+    finally:
+        pool.close()
+        pool.join()
+    return added
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+What was last uploaded to each S3 bucket/key, so unchanged content is not
+uploaded again.
+
+With CA_STORAGE_DEDUP on, every upload the S3 backend (storage.py) makes
+is recorded as a file under CA_STORAGE_MANIFEST_DIR holding the content's
+SHA-256, size, ACL and URL. An upload of the same content to the same key
+and ACL is skipped, and its recorded URL returned, until the record is
+CA_STORAGE_MANIFEST_SECONDS old; then it is uploaded again, in case the
+object went away. Deleting a key forgets its record. The files are shared
+by every process; counts of what was uploaded and skipped are per process.
+
+    from manifest import manifest
+    url = manifest.lookup(bucket, key, digest, public)
+    manifest.record(bucket, key, digest, size, public, url)
+    print manifest.report()
+"""
+
+from django.conf import settings
+import os, time, hashlib, threading
+from sha import sha256_from_filepath
+
+
+def entry_path(bucket, key):
+    name = hashlib.sha1(key).hexdigest()
+    return os.path.join(settings.CA_STORAGE_MANIFEST_DIR, bucket, name[:2],
+                        name)
+
+
+class Manifest(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.lock:
+            self.uploaded = 0
+            self.uploaded_bytes = 0
+            self.skipped = 0
+            self.skipped_bytes = 0
+
+    def fingerprint(self, path):
+        """The SHA-256 and size of the file at path."""
+        return sha256_from_filepath(path), os.path.getsize(path)
+
+    def lookup(self, bucket, key, digest, public, now=None):
+        """The URL of bucket/key if digest was uploaded there with this ACL."""
+        path = entry_path(bucket, key)
+        try:
+            if (now or time.time()) - os.path.getmtime(path) > \
+                    settings.CA_STORAGE_MANIFEST_SECONDS:
+                return None
+            with open(path) as f:
+                recorded, size, acl, url, stored_key = \
+                    f.read().rstrip("\n").split(" ", 4)
+        except (IOError, OSError, ValueError):
+            return None
+        if (recorded, acl, stored_key) != (digest, public and "public" or
+                                           "private", key):
+            return None
+        return url
+
+    def record(self, bucket, key, digest, size, public, url):
+        path = entry_path(bucket, key)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another thread or process made it first.
+                if not os.path.isdir(directory):
+                    raise
+        tmp = "%s.%s.%s.tmp" % (path, os.getpid(),
+                                threading.current_thread().ident)
+        f = open(tmp, "w")
+        f.write("%s %s %s %s %s\n" % (digest, size,
+                                      public and "public" or "private",
+                                      url, key))
+        f.close()
+        os.rename(tmp, path)
+
+    def forget(self, bucket, key):
+        try:
+            os.unlink(entry_path(bucket, key))
+        except OSError:
+            pass
+
+    def counted(self, skipped, size):
+        with self.lock:
+            if skipped:
+                self.skipped += 1
+                self.skipped_bytes += size
+            else:
+                self.uploaded += 1
+                self.uploaded_bytes += size
+
+    def report(self):
+        return "Uploaded %s files (%s bytes); skipped %s unchanged (%s bytes)." % (
+                self.uploaded, self.uploaded_bytes, self.skipped,
+                self.skipped_bytes)
+
+
+manifest = Manifest()
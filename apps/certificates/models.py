@@ -3,8 +3,8 @@
 # vim: ai ts=4 sts=4 et sw=4
 
 from django.conf import settings
-from django.db import models
-import datetime, os, json
+from django.db import models, transaction, IntegrityError
+import datetime, os, json, traceback, threading, operator
 import pdb
 from django.contrib.auth.models import User
 from django_localflavor_us.us_states import US_STATES
@@ -12,11 +12,14 @@ from django_localflavor_us.models import PhoneNumberField
 from cautils import (create_endpoint_certificate, create_trust_anchor_certificate,
                      revoke, build_crl, write_verification_message,
                      chain_keys_in_list, create_crl_conf, write_x5c_message,
-                     revoke_from_anchor, build_anchor_crl)
+                     revoke_from_anchor, build_anchor_crl, crl_path,
+                     anchor_crl_path, crl_next_update)
+from castore import IssuedCertificate
 import uuid
 import sha
-from fileutils import SimpleS3
-from django.core.mail import send_mail, EmailMessage
+from storage import get_storage, storage_enabled
+from publisher import Publication, publish_all, pool
+from django.core.mail import send_mail, EmailMessage, get_connection
 
 RSA_KEYSIZE_CHOICES = ((1024,1024), (2048,2048),(4096,4096),)
 STATUS_CHOICES = (  ('incomplete','incomplete'),
@@ -122,79 +125,86 @@ class TrustAnchorCertificate(models.Model):
         get_latest_by = "creation_date"
         ordering = ('-creation_date',)
         
-    def save(self, **kwargs):
-             
-        if not self.sha256_digest and self.revoke==False:
-            """I'm a new certificate"""
+    def issue(self, **kwargs):
+        """Create the certificate, its CRL config and notify the verifier."""
 
-            today = datetime.date.today ()
-            self.expiration_date = today + datetime.timedelta(
-                                                    days=self.expire_days)
-            result = create_trust_anchor_certificate(
-                                        common_name     = self.common_name,
-                                        email           = self.email,
-                                        dns             = self.dns,
-                                        expires         = self.expire_days,
-                                        organization    = self.organization,
-                                        city            = self.city,
-                                        state           = self.state,
-                                        country         = self.country,
-                                        rsakey          = self.rsa_keysize,
-                                        user            = self.owner.username)
-            
-            self.sha256_digest      = result['sha256_digest']
-            self.serial_number      = result['serial_number']
-            self.sha1_fingerprint   = result['sha1_fingerprint']
-            self.notes              = result['notes']
-            self.private_zip_name   = result['anchor_zip_download_file_name']
-            self.status             = result['status']
-            self.private_key_path   = result['private_key_path']
-            self.public_key_path    = result['public_key_path']
-            self.completed_dir_path = result['completed_dir_path']
-            
-            #send the verifier an email notification
-            msg = """
-            <html>
-            <head>
-            </head>
-            <body>
-            A new Direct Trust Anchor was created by %s and requires your review.
-            Here is a link for the domain %s:
-            <ul>
-            <li><a href="/admin/certificates/trustanchorcertificate/%s">%s</a></li>
-            </ul>
-            </body>
-            </html>
-            """ % (self.organization, self.domain, self.id, self.domain)
-            if settings.SEND_CA_EMAIL:
-                msg = EmailMessage('[DirectCA]A new Trust Anchor certificate requires verification',
-                               msg,
-                               settings.EMAIL_HOST_USER,
-                               [settings.CA_VERIFIER_EMAIL,])            
-                msg.content_subtype = "html"  # Main content is now text/html
-                msg.send()
+        today = datetime.date.today ()
+        self.expiration_date = today + datetime.timedelta(
+                                                days=self.expire_days)
+        result = create_trust_anchor_certificate(
+                                    common_name     = self.common_name,
+                                    email           = self.email,
+                                    dns             = self.dns,
+                                    expires         = self.expire_days,
+                                    organization    = self.organization,
+                                    city            = self.city,
+                                    state           = self.state,
+                                    country         = self.country,
+                                    rsakey          = self.rsa_keysize,
+                                    user            = self.owner.username)
+            
+        self.sha256_digest      = result['sha256_digest']
+        self.serial_number      = result['serial_number']
+        self.sha1_fingerprint   = result['sha1_fingerprint']
+        self.notes              = result['notes']
+        self.private_zip_name   = result['anchor_zip_download_file_name']
+        self.status             = result['status']
+        self.private_key_path   = result['private_key_path']
+        self.public_key_path    = result['public_key_path']
+        self.completed_dir_path = result['completed_dir_path']
+            
+        #send the verifier an email notification
+        msg = """
+        <html>
+        <head>
+        </head>
+        <body>
+        A new Direct Trust Anchor was created by %s and requires your review.
+        Here is a link for the domain %s:
+        <ul>
+        <li><a href="/admin/certificates/trustanchorcertificate/%s">%s</a></li>
+        </ul>
+        </body>
+        </html>
+        """ % (self.organization, self.domain, self.id, self.domain)
+        if settings.SEND_CA_EMAIL:
+            msg = EmailMessage('[DirectCA]A new Trust Anchor certificate requires verification',
+                           msg,
+                           settings.EMAIL_HOST_USER,
+                           [settings.CA_VERIFIER_EMAIL,])            
+            msg.content_subtype = "html"  # Main content is now text/html
+            msg.send()
                         
             
             
-            # Create the CRL config file
-            crl_result = create_crl_conf(
-                      common_name           = self.common_name,
-                        email               = self.email,
-                        dns                 = self.dns,
-                        anchor_dns          = self.dns,
-                        expires             = self.expire_days,
-                        organization        = self.organization,
-                        city                = self.city,
-                        state               = self.state,
-                        country             = self.country,
-                        rsakey              = self.rsa_keysize,
-                        user                = self.owner.username,
-                        public_key_path     = result['public_key_path'],
-                        private_key_path    = result['private_key_path'],
-                        completed_anchor_dir= result['completed_dir_path'])
-
-
-            return super(TrustAnchorCertificate, self).save(**kwargs)
+        # Create the CRL config file
+        crl_result = create_crl_conf(
+                  common_name           = self.common_name,
+                    email               = self.email,
+                    dns                 = self.dns,
+                    anchor_dns          = self.dns,
+                    expires             = self.expire_days,
+                    organization        = self.organization,
+                    city                = self.city,
+                    state               = self.state,
+                    country             = self.country,
+                    rsakey              = self.rsa_keysize,
+                    user                = self.owner.username,
+                    public_key_path     = result['public_key_path'],
+                    private_key_path    = result['private_key_path'],
+                    completed_anchor_dir= result['completed_dir_path'])
+
+
+        return super(TrustAnchorCertificate, self).save(**kwargs)
+        
+
+    def save(self, **kwargs):
+             
+        if not self.sha256_digest and self.revoke==False:
+            """I'm a new certificate"""
+            if settings.CA_ASYNC_ISSUANCE:
+                return IssuanceJob.enqueue_for(self, **kwargs)
+            return self.issue(**kwargs)
            
            
             
@@ -202,241 +212,241 @@ class TrustAnchorCertificate(models.Model):
         if self.verified and not self.verified_message_sent and \
            self.status in  ('unverified', 'good'):
             """This is the verify routine"""
-            
-            self.status = "good"
-            # Get the response
-            rcsp_result = write_verification_message(self.serial_number,
-                                                     self.common_name,
-                                                    "good",
-                                                    self.sha1_fingerprint,
-                                                    )
-            #Write it to db
-            self.rcsp_response = rcsp_result
-            fn = "%s.json" % (self.serial_number)
-            #Write it to file
-            fp = os.path.join(self.completed_dir_path, fn)
-            
-            f = open(fp, "w")
-            f.write(str(rcsp_result))
-            f.close()
-            
-            #Upload the RCSP file to S3
-            if settings.USE_S3:
-                s=SimpleS3()
-                self.public_cert_status_url  = s.store_in_s3(fn, fp,
-                                    bucket=settings.RCSP_BUCKET, public=True)
-                self.public_cert_status_url = s.build_pretty_url(
-                                                     self.public_cert_status_url,
-                                                    settings.RCSP_BUCKET)
-                
-                
-                
-            #"JOSE -------------------------------------------------------------"    
-            #get all the files
-            certfilelist = [settings.CA_PUBLIC_CERT, self.public_key_path]
-            
-            fn = "%s-chain.pem" % (self.dns)
-            chained_cert_path = os.path.join(self.completed_dir_path, fn )
-            certlist = chain_keys_in_list(chained_cert_path, certfilelist)
-            #write the json
-            
-            x5c_json = write_x5c_message(self.email, certlist)
-        
-            # set the filename ------------------------------------------------
-            fn = "%s-x5c.json" % (self.serial_number)
-            
-            # Write it to file ------------------------------------------------
-            fp = os.path.join(self.completed_dir_path, fn)
-            
-            f = open(fp, "w")
-            f.write(str(x5c_json))
-            f.close()
-            
-            #Upload the x5c file to S3
-            s=SimpleS3()
-            if settings.USE_S3:
-                key = "x5c/" + fn
-                self.public_cert_x5c_url = s.store_in_s3(key, fp,
-                                        bucket=settings.X5C_BUCKET,
-                                        public=True)
-                self.public_cert_x5c_url = s.build_pretty_url(
-                                                     self.public_cert_x5c_url,
-                                                    settings.X5C_BUCKET)
-                
-            #Calculate the SHA1 fingerprint & write it to a file
-            digestsha1 = json.dumps(sha.sha1_from_filepath(fp), indent =4)
-            fn = "%s-sha1.json" % (self.serial_number)
-            fp = os.path.join(self.completed_dir_path, fn)
-            f = open(fp, "w")
-            f.write(str(digestsha1)) 
-            f.close()
-                
-            #Upload the RCSP SHA! Digest to S3
-            if settings.USE_S3:
-                self.public_cert_status_sha1_url = s.store_in_s3(fn, fp,
-                                            bucket=settings.RCSPSHA1_BUCKET,
-                                            public=True)
-                self.public_cert_status_sha1_url= s.build_pretty_url(
-                                            self.public_cert_status_sha1_url,
-                                            settings.RCSPSHA1_BUCKET)
-                
-              
-            #Upload the PEM and DER public certificates  
-            fn = "%s.pem" % (self.dns)
-            key = "%s/%s/%s" % ( self.owner.username ,self.dns, fn )
-            fp = os.path.join(self.completed_dir_path, fn)
-            if settings.USE_S3:
-                self.public_cert_pem_url = s.store_in_s3(key, fp,
-                                                bucket=settings.PUBCERT_BUCKET,
-                                                public=True)
-                self.public_cert_pem_url= s.build_pretty_url(
-                                                    self.public_cert_pem_url,
-                                                    settings.PUBCERT_BUCKET)
-                
-                self.public_cert_pem_s3 = json.dumps({"bucket": settings.PUBCERT_BUCKET,
-                                                       "key": key})
-                
-            
-            fn = "%s.der" % (self.dns)
-            key = "%s/%s/%s" % (self.owner.username, self.dns, fn ) 
-            fp = os.path.join(self.completed_dir_path, fn)
-            if settings.USE_S3:
-                self.public_cert_der_url = s.store_in_s3(key, fp,
-                                                bucket=settings.PUBCERT_BUCKET,
-                                                public=True)
-                self.public_cert_der_url = s.build_pretty_url(
-                                                    self.public_cert_der_url,
-                                                    settings.PUBCERT_BUCKET)
-                self.public_cert_der_s3 = json.dumps({"bucket": settings.PUBCERT_BUCKET,
-                                                       "key": key})
-            
-            #Send the zip file and expire in one week
-            fn = self.private_zip_name
-            fp = os.path.join(self.completed_dir_path, self.private_zip_name)
-            key = "%s/%s/%s" % (self.owner.username, self.dns, fn ) 
-            if settings.USE_S3:
-                self.presigned_zip_url  = s.store_in_s3(key, fp,
-                                        bucket = settings.PUBCERT_BUCKET,
-                                        public = True)
-                
-                self.presigned_zip_url = s.build_pretty_url(
-                                                    self.presigned_zip_url,
-                                                    settings.PUBCERT_BUCKET)
-                
-                #We dont need this for trust anchos since there is no private key give.
-                #self.presigned_zip_url = s.get_presignedurl(key, bucket = settings.PRIVCERT_BUCKET) 
-                
-                self.presigned_zip_s3 = json.dumps({"bucket": settings.PUBCERT_BUCKET,
-                                                       "key": key})
-            
-            """ Mark th certificate as verified """
-            self.verified = True
-            
-            #send the verification email.
-            msg = """
-            <html>
-            <head>
-            </head>
-            <body>
-            Congratulations. Your trust anchor has for %s been verified.
-            Here are some links to your public certificates and related status
-            information.
-            
-            <ul>
-            <li><a href="%s">PEM File                             - %s</a></li>
-            <li><a href="%s">DER File                             - %s</a></li>
-            <li><a href="%s">Status                               - %s</a></li>
-            <li><a href="%s">Status SHA1 Digest                   - %s</a></li>
-            <li><a href="%s">Certificate Chain in JOSE x5c Format - %s</a></li>
-            </ul>
-            </body>
-            </html>
-            """ % (self.domain,
-                   self.public_cert_pem_url,self.public_cert_pem_url,
-                   self.public_cert_der_url,self.public_cert_der_url,
-                   self.public_cert_status_url,self.public_cert_status_url,
-                   self.public_cert_status_sha1_url, self.public_cert_status_sha1_url,
-                   self.public_cert_x5c_url, self.public_cert_x5c_url
-                   )
-            if settings.SEND_CA_EMAIL:
-                msg = EmailMessage('[DirectCA]Your Trust Anchor Certificate has been verified',
-                               msg,
-                               settings.EMAIL_HOST_USER,
-                               [self.owner.email, self.contact_email])            
-                msg.content_subtype = "html"  # Main content is now text/html
-                msg.send()
-            
-            
-            self.verified_message_sent = True
+            self.finish_verification(self.prepare_verification().publish())
 
                         
         
             
         if self.revoke and self.status != "revoked":
-                self.status = "revoked"
-                
-                # Build the  RCSP response
-                # Get the status
-                self.rcsp_response =  write_verification_message(self.serial_number,
-                                                     self.common_name,
-                                                    "revoked",
-                                                    self.sha1_fingerprint,
-                                                    )
-                fn = "%s.json" % (self.serial_number)
-                
-                #Write it to file
-                fp = os.path.join(self.completed_dir_path, fn)
-                
-                f = open(fp, "w")
-                f.write(str(self.rcsp_response))
-                f.close()
-                
-                #Upload the RCSP file to S3
-                if settings.USE_S3:
-                    s=SimpleS3()
-                    url = s.store_in_s3(fn, fp, bucket=settings.RCSP_BUCKET,
-                                    public=True)
-        
-                    
-                #Calculate the SHA1 fingerprint & write it to a file
-                digestsha1 = json.dumps(sha.sha1_from_filepath(fp), indent =4)
-                fn = "%s-sha1.json" % (self.serial_number)
-                fp = os.path.join(self.completed_dir_path, fn)
-                f = open(fp, "w")
-                f.write(str(digestsha1)) 
-                f.close()
-                if settings.USE_S3:            
-                    #Upload the RCSP SHA! Digest to S3
-                    url = s.store_in_s3(fn, fp, bucket=settings.RCSPSHA1_BUCKET,
-                                    public=True)
-                    
-                
-                    #Delete all the old files:
-                    #PEM, DIR, ZIP
-                    if self.presigned_zip_s3:
-                        s3info = json.loads(self.presigned_zip_s3) 
-                        self.presigned_zip_url = s.delete_in_s3(    s3info['bucket'],
-                                                                s3info['key'],
-                                                            )
-                
-                    if self.public_cert_der_s3:
-                        s3info = json.loads(self.public_cert_der_s3) 
-                        self.public_cert_der_url = s.delete_in_s3(  s3info['bucket'],
-                                                                s3info['key'],
-                                                            )
-                
-                    if self.public_cert_pem_s3:
-                        s3info = json.loads(self.public_cert_pem_s3) 
-                        self.public_cert_pem_url = s.delete_in_s3(  s3info['bucket'],
-                                                                s3info['key'],
-                                                            )
-                
-                #revoke the cert
-                revoke(self)
+            self.finish_revocation(self.prepare_revocation().publish())
+            CRLState.revoked()
                 
             
         super(TrustAnchorCertificate, self).save(**kwargs)
         
+    def prepare_verification(self):
+        """
+        The first half of verifying: write the status, x5c and digest files
+        and collect everything to publish. finish_verification() takes the
+        published Publication.
+        """
+        publication = Publication()
+        self.status = "good"
+        # Get the response
+        rcsp_result = write_verification_message(self.serial_number,
+                                                 self.common_name,
+                                                "good",
+                                                self.sha1_fingerprint,
+                                                )
+        #Write it to db
+        self.rcsp_response = rcsp_result
+        fn = "%s.json" % (self.serial_number)
+        #Write it to file
+        fp = os.path.join(self.completed_dir_path, fn)
+        
+        f = open(fp, "w")
+        f.write(str(rcsp_result))
+        f.close()
+        
+        #Upload the RCSP file to S3
+        if storage_enabled():
+            publication.add("public_cert_status_url", fn, fp,
+                            settings.RCSP_BUCKET)
+            
+            
+            
+        #"JOSE -------------------------------------------------------------"    
+        #get all the files
+        certfilelist = [settings.CA_PUBLIC_CERT, self.public_key_path]
+        
+        fn = "%s-chain.pem" % (self.dns)
+        chained_cert_path = os.path.join(self.completed_dir_path, fn )
+        certlist = chain_keys_in_list(chained_cert_path, certfilelist)
+        #write the json
+        
+        x5c_json = write_x5c_message(self.email, certlist)
+    
+        # set the filename ------------------------------------------------
+        fn = "%s-x5c.json" % (self.serial_number)
+        
+        # Write it to file ------------------------------------------------
+        fp = os.path.join(self.completed_dir_path, fn)
+        
+        f = open(fp, "w")
+        f.write(str(x5c_json))
+        f.close()
+        
+        #Upload the x5c file to S3
+        if storage_enabled():
+            publication.add("public_cert_x5c_url", "x5c/" + fn, fp,
+                            settings.X5C_BUCKET)
+            
+        #Calculate the SHA1 fingerprint & write it to a file
+        digestsha1 = json.dumps(sha.sha1_from_bytes(str(x5c_json)),
+                                indent =4)
+        fn = "%s-sha1.json" % (self.serial_number)
+        fp = os.path.join(self.completed_dir_path, fn)
+        f = open(fp, "w")
+        f.write(str(digestsha1)) 
+        f.close()
+            
+        #Upload the RCSP SHA! Digest to S3
+        if storage_enabled():
+            publication.add("public_cert_status_sha1_url", fn, fp,
+                            settings.RCSPSHA1_BUCKET)
+            
+          
+        #Upload the PEM and DER public certificates  
+        fn = "%s.pem" % (self.dns)
+        key = "%s/%s/%s" % ( self.owner.username ,self.dns, fn )
+        fp = os.path.join(self.completed_dir_path, fn)
+        if storage_enabled():
+            publication.add("public_cert_pem_url", key, fp,
+                            settings.PUBCERT_BUCKET)
+            self.public_cert_pem_s3 = json.dumps({"bucket": settings.PUBCERT_BUCKET,
+                                                   "key": key})
+            
+        
+        fn = "%s.der" % (self.dns)
+        key = "%s/%s/%s" % (self.owner.username, self.dns, fn ) 
+        fp = os.path.join(self.completed_dir_path, fn)
+        if storage_enabled():
+            publication.add("public_cert_der_url", key, fp,
+                            settings.PUBCERT_BUCKET)
+            self.public_cert_der_s3 = json.dumps({"bucket": settings.PUBCERT_BUCKET,
+                                                   "key": key})
+        
+        #Send the zip file and expire in one week
+        fn = self.private_zip_name
+        fp = os.path.join(self.completed_dir_path, self.private_zip_name)
+        key = "%s/%s/%s" % (self.owner.username, self.dns, fn ) 
+        if storage_enabled():
+            publication.add("presigned_zip_url", key, fp,
+                            settings.PUBCERT_BUCKET)
+            
+            #We dont need this for trust anchos since there is no private key give.
+            #self.presigned_zip_url = s.get_presignedurl(key, bucket = settings.PRIVCERT_BUCKET) 
+            
+            self.presigned_zip_s3 = json.dumps({"bucket": settings.PUBCERT_BUCKET,
+                                                   "key": key})
+        return publication
+        
+    def finish_verification(self, publication, send=True):
+        """
+        The second half of verifying: take the published URLs and send the
+        verification email, or only return it when send is False.
+        """
+        for field, url in publication.urls.items():
+            setattr(self, field, url)
+        
+        """ Mark th certificate as verified """
+        self.verified = True
+        
+        #send the verification email.
+        msg = """
+        <html>
+        <head>
+        </head>
+        <body>
+        Congratulations. Your trust anchor has for %s been verified.
+        Here are some links to your public certificates and related status
+        information.
+        
+        <ul>
+        <li><a href="%s">PEM File                             - %s</a></li>
+        <li><a href="%s">DER File                             - %s</a></li>
+        <li><a href="%s">Status                               - %s</a></li>
+        <li><a href="%s">Status SHA1 Digest                   - %s</a></li>
+        <li><a href="%s">Certificate Chain in JOSE x5c Format - %s</a></li>
+        </ul>
+        </body>
+        </html>
+        """ % (self.domain,
+               self.public_cert_pem_url,self.public_cert_pem_url,
+               self.public_cert_der_url,self.public_cert_der_url,
+               self.public_cert_status_url,self.public_cert_status_url,
+               self.public_cert_status_sha1_url, self.public_cert_status_sha1_url,
+               self.public_cert_x5c_url, self.public_cert_x5c_url
+               )
+        email = None
+        if settings.SEND_CA_EMAIL:
+            email = EmailMessage('[DirectCA]Your Trust Anchor Certificate has been verified',
+                           msg,
+                           settings.EMAIL_HOST_USER,
+                           [self.owner.email, self.contact_email])            
+            email.content_subtype = "html"  # Main content is now text/html
+            if send:
+                email.send()
+        
+        
+        self.verified_message_sent = True
+        return email
+
+    def prepare_revocation(self):
+        """
+        The first half of revoking: write the revoked status and its digest
+        and collect their uploads, and the deletion of the published PEM,
+        DER and zip. finish_revocation() takes the published Publication.
+        """
+        publication = Publication()
+        self.status = "revoked"
+        
+        # Build the  RCSP response
+        # Get the status
+        self.rcsp_response =  write_verification_message(self.serial_number,
+                                             self.common_name,
+                                            "revoked",
+                                            self.sha1_fingerprint,
+                                            )
+        fn = "%s.json" % (self.serial_number)
+        
+        #Write it to file
+        fp = os.path.join(self.completed_dir_path, fn)
+        
+        f = open(fp, "w")
+        f.write(str(self.rcsp_response))
+        f.close()
+        
+        #Upload the RCSP file to S3
+        if storage_enabled():
+            publication.add("public_cert_status_url", fn, fp,
+                            settings.RCSP_BUCKET, pretty=False)
+
+            
+        #Calculate the SHA1 fingerprint & write it to a file
+        digestsha1 = json.dumps(sha.sha1_from_bytes(str(self.rcsp_response)),
+                                indent =4)
+        fn = "%s-sha1.json" % (self.serial_number)
+        fp = os.path.join(self.completed_dir_path, fn)
+        f = open(fp, "w")
+        f.write(str(digestsha1)) 
+        f.close()
+        if storage_enabled():
+            #Upload the RCSP SHA! Digest to S3
+            publication.add("public_cert_status_sha1_url", fn, fp,
+                            settings.RCSPSHA1_BUCKET, pretty=False)
+            
+            #Delete all the old files:
+            #PEM, DIR, ZIP
+            for field, s3field in (("presigned_zip_url", "presigned_zip_s3"),
+                                   ("public_cert_der_url", "public_cert_der_s3"),
+                                   ("public_cert_pem_url", "public_cert_pem_s3")):
+                if getattr(self, s3field):
+                    s3info = json.loads(getattr(self, s3field))
+                    publication.remove(field, s3info['bucket'], s3info['key'])
+        return publication
+    
+    def finish_revocation(self, publication):
+        """
+        The second half of revoking, once the revoked status is published
+        and the old files deleted: revoke the certificate in the CA index.
+        """
+        for field, bucket, key in publication.deletions:
+            setattr(self, field, "")
+        
+        #revoke the cert
+        revoke(self)
+
     def delete(self, **kwargs):
         self.revoked = True
         self.status = "revoked"
@@ -458,14 +468,15 @@ class TrustAnchorCertificate(models.Model):
         f.close()
         
         #Upload the RCSP file to S3
-        s=SimpleS3()
-        if settings.USE_S3:
-            url = s.store_in_s3(fn, fp, bucket=settings.RCSP_BUCKET,
+        s = get_storage()
+        if s:
+            url = s.store(fn, fp, settings.RCSP_BUCKET,
                             public=True)
 
             
         #Calculate the SHA1 fingerprint & write it to a file
-        digestsha1 = json.dumps(sha.sha1_from_filepath(fp), indent =4)
+        digestsha1 = json.dumps(sha.sha1_from_bytes(str(rcsp_result)),
+                                indent =4)
         fn = "%s-sha1.json" % (self.serial_number)
         fp = os.path.join(self.completed_dir_path, fn)
         f = open(fp, "w")
@@ -473,12 +484,13 @@ class TrustAnchorCertificate(models.Model):
         f.close()
             
         #Upload the RCSP SHA! Digest to S3
-        if settings.USE_S3:
-            url = s.store_in_s3(fn, fp, bucket=settings.RCSPSHA1_BUCKET,
+        if s:
+            url = s.store(fn, fp, settings.RCSPSHA1_BUCKET,
                             public=True)
         
         #Revoke the cert.
         revoke(self)
+        CRLState.revoked()
         super(TrustAnchorCertificate, self).save(**kwargs)
         
 
@@ -591,307 +603,335 @@ class DomainBoundCertificate(models.Model):
         get_latest_by = "creation_date"
         ordering = ('-creation_date',)
         
-    def save(self, **kwargs):
-        if not self.sha256_digest and self.status=="incomplete":
-            print "We've only just begun...I'm new."
-            
-            today = datetime.date.today ()
-            self.expiration_date = today + datetime.timedelta(
-                                                    days=self.expire_days)
-            
-            
-            result = create_endpoint_certificate(
-                        common_name         = self.common_name,
-                        email               = self.email,
-                        dns                 = self.dns,
-                        anchor_dns          = self.trust_anchor.dns,
-                        expires             = self.expire_days,
-                        organization        = self.organization,
-                        city                = self.city,
-                        state               = self.state,
-                        country             = self.country,
-                        rsakey              = self.rsa_keysize,
-                        user                = self.trust_anchor.owner.username,
-                        public_key_path     = self.trust_anchor.public_key_path,
-                        private_key_path    = self.trust_anchor.private_key_path,
-                        completed_anchor_dir = self.trust_anchor.completed_dir_path
-                        )
-            
-            
-            sha256_digest           = result['sha256_digest']
-            self.serial_number      = result['serial_number']
-            self.sha1_fingerprint   = result['sha1_fingerprint']
-            self.notes              = result['notes']
-            self.private_zip_name   = result['anchor_zip_download_file_name']
-            self.status             = result['status']
-            self.completed_dir_path = result['completed_dir_path']
-            self.public_key_path     = result['public_key_path']
-            
-            #send the verifier an email notification
-            msg = """
-            <html>
-            <head>
-            </head>
-            <body>
-            A new Direct Domain Bound certificate was created by %s and requires your review.
-            Here is a link:
-            <ul>
-            <li><a href="https://console.directca.org/admin/certificates/domainboundcertificate/%s">%s</a></li>
-            </ul>
-            </body>
-            </html>
-            """ % (self.organization, self.id, self.domain,
-                   )
-            if settings.SEND_CA_EMAIL :
-                msg = EmailMessage('[DirectCA]A new Domain-Bound Certificate requires verification',
-                               msg,
-                               settings.EMAIL_HOST_USER,
-                               [settings.CA_VERIFIER_EMAIL,])            
-                msg.content_subtype = "html"  # Main content is now text/html
-                msg.send()
+    def issue(self, **kwargs):
+        """Create the endpoint certificate and notify the verifier."""
+        print "We've only just begun...I'm new."
             
+        today = datetime.date.today ()
+        self.expiration_date = today + datetime.timedelta(
+                                                days=self.expire_days)
             
-            super(DomainBoundCertificate, self).save(**kwargs)
-            return
+            
+        result = create_endpoint_certificate(
+                    common_name         = self.common_name,
+                    email               = self.email,
+                    dns                 = self.dns,
+                    anchor_dns          = self.trust_anchor.dns,
+                    expires             = self.expire_days,
+                    organization        = self.organization,
+                    city                = self.city,
+                    state               = self.state,
+                    country             = self.country,
+                    rsakey              = self.rsa_keysize,
+                    user                = self.trust_anchor.owner.username,
+                    public_key_path     = self.trust_anchor.public_key_path,
+                    private_key_path    = self.trust_anchor.private_key_path,
+                    completed_anchor_dir = self.trust_anchor.completed_dir_path
+                    )
+            
+            
+        sha256_digest           = result['sha256_digest']
+        self.serial_number      = result['serial_number']
+        self.sha1_fingerprint   = result['sha1_fingerprint']
+        self.notes              = result['notes']
+        self.private_zip_name   = result['anchor_zip_download_file_name']
+        self.status             = result['status']
+        self.completed_dir_path = result['completed_dir_path']
+        self.public_key_path     = result['public_key_path']
+            
+        #send the verifier an email notification
+        msg = """
+        <html>
+        <head>
+        </head>
+        <body>
+        A new Direct Domain Bound certificate was created by %s and requires your review.
+        Here is a link:
+        <ul>
+        <li><a href="https://console.directca.org/admin/certificates/domainboundcertificate/%s">%s</a></li>
+        </ul>
+        </body>
+        </html>
+        """ % (self.organization, self.id, self.domain,
+               )
+        if settings.SEND_CA_EMAIL :
+            msg = EmailMessage('[DirectCA]A new Domain-Bound Certificate requires verification',
+                           msg,
+                           settings.EMAIL_HOST_USER,
+                           [settings.CA_VERIFIER_EMAIL,])            
+            msg.content_subtype = "html"  # Main content is now text/html
+            msg.send()
+            
+            
+        super(DomainBoundCertificate, self).save(**kwargs)
+
+
+    def save(self, **kwargs):
+        if not self.sha256_digest and self.status=="incomplete":
+            if settings.CA_ASYNC_ISSUANCE:
+                return IssuanceJob.enqueue_for(self, **kwargs)
+            return self.issue(**kwargs)
         
         if self.verified and not self.verified_message_sent and \
            self.status in  ('unverified', 'good'):
             print "VERIFY ----------------------------"
-            
-            """ Mark the certificate as verified"""
-            self.verified = True
-            
-            self.status = "good"
-            # RCSP ------------------------------------------------------------
-            rcsp_result = write_verification_message(self.serial_number,
-                                                     self.common_name,
-                                                    "good",
-                                                    self.sha1_fingerprint,
-                                                    )
-            #Write it to db
-            self.rcsp_response = rcsp_result
-        
-            #set the filename
-            fn = "%s.json" % (self.serial_number)
-            #Write it to file
-            fp = os.path.join(self.completed_dir_path, fn)
-            
-            f = open(fp, "w")
-            f.write(str(rcsp_result))
-            f.close()
-            
-            #Upload the RCSP file to S3
-            s=SimpleS3()
-            if settings.USE_S3:
-                self.public_cert_status_url = s.store_in_s3(fn, fp,
-                                                bucket=settings.RCSP_BUCKET,
-                                                public=True)
-
-                self.public_cert_status_url= s.build_pretty_url(
-                                                    self.public_cert_status_url,
-                                                    settings.RCSP_BUCKET)
-                
-            #JOSE -------------------------------------------------------------    
-            #get all the files
-            certfilelist = [
-                                settings.CA_PUBLIC_CERT,
-                                self.trust_anchor.public_key_path,
-                                self.public_key_path
-                            ]
-            
-            fn = "%s-chain.pem" % (self.dns)
-            chained_cert_path = os.path.join(self.completed_dir_path, fn )
-            certlist = chain_keys_in_list(chained_cert_path, certfilelist)
-            #write the json
-            
-            x5c_json = write_x5c_message(self.email, certlist)
-        
-            # set the filename ------------------------------------------------
-            fn = "%s-x5c.json" % (self.serial_number)
-            
-            # Write it to file ------------------------------------------------
-            fp = os.path.join(self.completed_dir_path, fn)
-            
-            f = open(fp, "w")
-            f.write(str(x5c_json))
-            f.close()
-            
-            #Upload the x5c file to S3
-            s=SimpleS3()
-            if settings.USE_S3:
-                key = "x5c/" + fn
-                self.public_cert_x5c_url = s.store_in_s3(key, fp,
-                                        bucket=settings.X5C_BUCKET,
-                                        public=True)
-                self.public_cert_x5c_url= s.build_pretty_url(self.public_cert_x5c_url,
-                                                              settings.X5C_BUCKET)
-                
-            #Calculate the SHA1 fingerprint & write it to a file
-            digestsha1 = json.dumps(sha.sha1_from_filepath(fp), indent =4)
-            fn = "%s-sha1.json" % (self.serial_number)
-            fp = os.path.join(self.completed_dir_path, fn)
-            f = open(fp, "w")
-            f.write(str(digestsha1)) 
-            f.close()
-                
-            #Upload the RCSP SHA! Digest to S3
-            if settings.USE_S3:
-                self.public_cert_status_sha1_url = s.store_in_s3(fn, fp, bucket=settings.RCSPSHA1_BUCKET,
-                                public=True)
-                                          
-            #Upload the PEM and DER public certificates  
-            fn = "%s.pem" % (self.dns)
-            key = "%s/%s/endpoints/%s" % (self.trust_anchor.owner.username, self.trust_anchor.dns,
-                                  fn )
-            
-            fp = os.path.join(self.completed_dir_path, fn)
-            if settings.USE_S3:
-                self.public_cert_pem_url    = s.store_in_s3(key, fp,
-                                                    bucket=settings.PUBCERT_BUCKET,
-                                                    public=True)
-                
-                
-                self.public_cert_pem_url = s.build_pretty_url(self.public_cert_pem_url,
-                                                              settings.PUBCERT_BUCKET)
-                self.public_cert_pem_s3 =  json.dumps({"bucket": settings.PUBCERT_BUCKET,
-                                                          "key": key })
-                
-                
-            
-            fn = "%s.der" % (self.dns)
-            key = "%s/%s/%s" % (self.trust_anchor.owner.username, self.dns,
-                                   fn )
-            fp = os.path.join(self.completed_dir_path, fn)
-            #print "S3 --------------------", key, fp
-            if settings.USE_S3:
-                self.public_cert_der_url = s.store_in_s3(key, fp, bucket=settings.PUBCERT_BUCKET,
-                               public=True)
-                self.public_cert_der_url= s.build_pretty_url(self.public_cert_der_url,
-                                                              settings.PUBCERT_BUCKET)
-                self.public_cert_der_s3 =  json.dumps({"bucket": settings.PUBCERT_BUCKET,
-                                                          "key": key })
-            
-            
-            #Send the zip file and expire in one week
-            fp = os.path.join(self.completed_dir_path, self.private_zip_name)
-            key = str(self.private_zip_name)
-            if settings.USE_S3:
-                url = s.store_in_s3(key, fp, bucket = settings.PRIVCERT_BUCKET)
-
-                self.presigned_zip_url = s.get_presignedurl(key, bucket = settings.PRIVCERT_BUCKET) 
-                self.presigned_zip_s3  =  json.dumps({"bucket": settings.PRIVCERT_BUCKET,
-                                                          "key": key })
-            
-            
-            #send the verification email.
-            msg = """
-            <html>
-            <head>
-            </head>
-            <body>
-            Congratulations. Your domain bound certificate has been verified.
-            Below are links to your public certificates and related status information.
-            Please login into <a href="https://console.directca.org">console.directca.org</a>
-            to retrieve your private certificates for this domain.
-            <ul>
-                <li><a href="%s">PEM File - %s </a></li>
-                <li><a href="%s">DER File -  %s </a></li>
-                <li><a href="%s">Status - %s </a></li>
-                <li><a href="%s">Status SHA1 Digest - %s </a></li>
-                <li><a href="%s">Certificate chain in JOSE x5c format - %s </a></li>
-            </ul>
-            
-            <p>For security purposes you must
-            <a href="https://console.directca.org">login</a> and download the
-            private certificates within 72 hours of this email.  
-            </p>
-            
-            </body>
-            </html>
-            """ % (self.public_cert_pem_url,            self.public_cert_pem_url,
-                   self.public_cert_der_url,            self.public_cert_der_url,
-                   self.public_cert_status_url,         self.public_cert_status_url,
-                   self.public_cert_status_sha1_url,    self.public_cert_status_sha1_url,
-                   self.public_cert_x5c_url,            self.public_cert_x5c_url,
-                   )
-            if settings.SEND_CA_EMAIL:
-                msg = EmailMessage('[DirectCA]Your Domain-Bound Certificate has been verified',
-                               msg,
-                               settings.EMAIL_HOST_USER,
-                               [self.trust_anchor.owner.email, self.contact_email])            
-                msg.content_subtype = "html"  # Main content is now text/html
-                msg.send()
-            
-            
-            #send the verification email.
-            self.verified_message_sent = True
+            self.finish_verification(self.prepare_verification().publish())
             super(DomainBoundCertificate, self).save(**kwargs)
             return
         
         if self.revoke and self.status != "revoked":
-            self.revoke = True
-            self.status = "revoked"
-            
-             # Get the response
-            rcsp_result = write_verification_message(self.serial_number,
+            self.finish_revocation(self.prepare_revocation().publish())
+            CRLState.revoked(self.trust_anchor)
+            CRLState.revoked()
+        
+         
+        super(DomainBoundCertificate, self).save(**kwargs)
+
+    def prepare_verification(self):
+        """
+        The first half of verifying: write the status, x5c and digest files
+        and collect everything to publish. finish_verification() takes the
+        published Publication.
+        """
+        publication = Publication()
+        
+        """ Mark the certificate as verified"""
+        self.verified = True
+        
+        self.status = "good"
+        # RCSP ------------------------------------------------------------
+        rcsp_result = write_verification_message(self.serial_number,
                                                  self.common_name,
-                                                "revoked",
+                                                "good",
                                                 self.sha1_fingerprint,
                                                 )
-            #Write it to db
-            self.rcsp_response = rcsp_result
-            fn = "%s.json" % (self.serial_number)
-            #Write it to file
-            fp = os.path.join(self.completed_dir_path, fn)
-            
-            f = open(fp, "w")
-            f.write(str(rcsp_result))
-            f.close()
-            
-            #Upload the RCSP file to S3
-            s=SimpleS3()
-            if settings.USE_S3:
-                url = s.store_in_s3(fn, fp, bucket=settings.RCSP_BUCKET,
-                                public=True)
+        #Write it to db
+        self.rcsp_response = rcsp_result
     
-                
-            #Calculate the SHA1 fingerprint & write it to a file
-            digestsha1 = json.dumps(sha.sha1_from_filepath(fp), indent = 4)
-            fn = "%s-sha1.json" % (self.serial_number)
-            fp = os.path.join(self.completed_dir_path, fn)
-            f = open(fp, "w")
-            f.write(str(digestsha1)) 
-            f.close()
-                
-            #Upload the RCSP SHA! Digest to S3
-            if settings.USE_S3:
-                url = s.store_in_s3(fn, fp, bucket=settings.RCSPSHA1_BUCKET,
-                                public=True)
-                
-                
-                #Delete all the old files:
-                #PEM, DIR, ZIP
-                if self.presigned_zip_s3:
-                    s3info = json.loads(self.presigned_zip_s3) 
-                    self.presigned_zip_url = s.delete_in_s3(s3info['bucket'],
-                                                        s3info['key'],)
-                if self.public_cert_der_s3:
-                    s3info = json.loads(self.public_cert_der_s3) 
-                    self.public_cert_der_url = s.delete_in_s3(s3info['bucket'],
-                                                          s3info['key'],)
-                
-                
-                if self.public_cert_pem_s3:
-                    s3info = json.loads(self.public_cert_pem_s3) 
-                    self.public_cert_pem_url = s.delete_in_s3(s3info['bucket'],
-                                                          s3info['key'],)
-                
-            # Now perform the revcation on our index and delete old files.
-            revoke_from_anchor(self)
-            revoke(self)
+        #set the filename
+        fn = "%s.json" % (self.serial_number)
+        #Write it to file
+        fp = os.path.join(self.completed_dir_path, fn)
         
-         
-        super(DomainBoundCertificate, self).save(**kwargs)
+        f = open(fp, "w")
+        f.write(str(rcsp_result))
+        f.close()
+        
+        #Upload the RCSP file to S3
+        if storage_enabled():
+            publication.add("public_cert_status_url", fn, fp,
+                            settings.RCSP_BUCKET)
+            
+        #JOSE -------------------------------------------------------------    
+        #get all the files
+        certfilelist = [
+                            settings.CA_PUBLIC_CERT,
+                            self.trust_anchor.public_key_path,
+                            self.public_key_path
+                        ]
+        
+        fn = "%s-chain.pem" % (self.dns)
+        chained_cert_path = os.path.join(self.completed_dir_path, fn )
+        certlist = chain_keys_in_list(chained_cert_path, certfilelist)
+        #write the json
+        
+        x5c_json = write_x5c_message(self.email, certlist)
+    
+        # set the filename ------------------------------------------------
+        fn = "%s-x5c.json" % (self.serial_number)
+        
+        # Write it to file ------------------------------------------------
+        fp = os.path.join(self.completed_dir_path, fn)
+        
+        f = open(fp, "w")
+        f.write(str(x5c_json))
+        f.close()
+        
+        #Upload the x5c file to S3
+        if storage_enabled():
+            publication.add("public_cert_x5c_url", "x5c/" + fn, fp,
+                            settings.X5C_BUCKET)
+            
+        #Calculate the SHA1 fingerprint & write it to a file
+        digestsha1 = json.dumps(sha.sha1_from_bytes(str(x5c_json)),
+                                indent =4)
+        fn = "%s-sha1.json" % (self.serial_number)
+        fp = os.path.join(self.completed_dir_path, fn)
+        f = open(fp, "w")
+        f.write(str(digestsha1)) 
+        f.close()
+            
+        #Upload the RCSP SHA! Digest to S3
+        if storage_enabled():
+            publication.add("public_cert_status_sha1_url", fn, fp,
+                            settings.RCSPSHA1_BUCKET, pretty=False)
+                                      
+        #Upload the PEM and DER public certificates  
+        fn = "%s.pem" % (self.dns)
+        key = "%s/%s/endpoints/%s" % (self.trust_anchor.owner.username, self.trust_anchor.dns,
+                              fn )
+        
+        fp = os.path.join(self.completed_dir_path, fn)
+        if storage_enabled():
+            publication.add("public_cert_pem_url", key, fp,
+                            settings.PUBCERT_BUCKET)
+            self.public_cert_pem_s3 =  json.dumps({"bucket": settings.PUBCERT_BUCKET,
+                                                      "key": key })
+            
+            
+        
+        fn = "%s.der" % (self.dns)
+        key = "%s/%s/%s" % (self.trust_anchor.owner.username, self.dns,
+                               fn )
+        fp = os.path.join(self.completed_dir_path, fn)
+        #print "S3 --------------------", key, fp
+        if storage_enabled():
+            publication.add("public_cert_der_url", key, fp,
+                            settings.PUBCERT_BUCKET)
+            self.public_cert_der_s3 =  json.dumps({"bucket": settings.PUBCERT_BUCKET,
+                                                      "key": key })
+        
+        
+        #Send the zip file and expire in one week
+        fp = os.path.join(self.completed_dir_path, self.private_zip_name)
+        key = str(self.private_zip_name)
+        if storage_enabled():
+            publication.add("presigned_zip_url", key, fp,
+                            settings.PRIVCERT_BUCKET, public=False)
+            self.presigned_zip_s3  =  json.dumps({"bucket": settings.PRIVCERT_BUCKET,
+                                                      "key": key })
+        return publication
+        
+    def finish_verification(self, publication, send=True):
+        """
+        The second half of verifying: take the published URLs, presign the
+        private zip's and send the verification email, or only return it
+        when send is False.
+        """
+        for field, url in publication.urls.items():
+            setattr(self, field, url)
+        if storage_enabled():
+            self.presigned_zip_url = PresignedURL.url_for(
+                                            settings.PRIVCERT_BUCKET,
+                                            str(self.private_zip_name))
+        
+        
+        #send the verification email.
+        msg = """
+        <html>
+        <head>
+        </head>
+        <body>
+        Congratulations. Your domain bound certificate has been verified.
+        Below are links to your public certificates and related status information.
+        Please login into <a href="https://console.directca.org">console.directca.org</a>
+        to retrieve your private certificates for this domain.
+        <ul>
+            <li><a href="%s">PEM File - %s </a></li>
+            <li><a href="%s">DER File -  %s </a></li>
+            <li><a href="%s">Status - %s </a></li>
+            <li><a href="%s">Status SHA1 Digest - %s </a></li>
+            <li><a href="%s">Certificate chain in JOSE x5c format - %s </a></li>
+        </ul>
+        
+        <p>For security purposes you must
+        <a href="https://console.directca.org">login</a> and download the
+        private certificates within 72 hours of this email.  
+        </p>
+        
+        </body>
+        </html>
+        """ % (self.public_cert_pem_url,            self.public_cert_pem_url,
+               self.public_cert_der_url,            self.public_cert_der_url,
+               self.public_cert_status_url,         self.public_cert_status_url,
+               self.public_cert_status_sha1_url,    self.public_cert_status_sha1_url,
+               self.public_cert_x5c_url,            self.public_cert_x5c_url,
+               )
+        email = None
+        if settings.SEND_CA_EMAIL:
+            email = EmailMessage('[DirectCA]Your Domain-Bound Certificate has been verified',
+                           msg,
+                           settings.EMAIL_HOST_USER,
+                           [self.trust_anchor.owner.email, self.contact_email])            
+            email.content_subtype = "html"  # Main content is now text/html
+            if send:
+                email.send()
+        
+        
+        #send the verification email.
+        self.verified_message_sent = True
+        return email
+
+    def prepare_revocation(self):
+        """
+        The first half of revoking: write the revoked status and its digest
+        and collect their uploads, and the deletion of the published PEM,
+        DER and zip. finish_revocation() takes the published Publication.
+        """
+        publication = Publication()
+        self.revoke = True
+        self.status = "revoked"
+        
+         # Get the response
+        rcsp_result = write_verification_message(self.serial_number,
+                                             self.common_name,
+                                            "revoked",
+                                            self.sha1_fingerprint,
+                                            )
+        #Write it to db
+        self.rcsp_response = rcsp_result
+        fn = "%s.json" % (self.serial_number)
+        #Write it to file
+        fp = os.path.join(self.completed_dir_path, fn)
+        
+        f = open(fp, "w")
+        f.write(str(rcsp_result))
+        f.close()
+        
+        #Upload the RCSP file to S3
+        if storage_enabled():
+            publication.add("public_cert_status_url", fn, fp,
+                            settings.RCSP_BUCKET, pretty=False)
+
+            
+        #Calculate the SHA1 fingerprint & write it to a file
+        digestsha1 = json.dumps(sha.sha1_from_bytes(str(rcsp_result)),
+                                indent = 4)
+        fn = "%s-sha1.json" % (self.serial_number)
+        fp = os.path.join(self.completed_dir_path, fn)
+        f = open(fp, "w")
+        f.write(str(digestsha1)) 
+        f.close()
+            
+        #Upload the RCSP SHA! Digest to S3
+        if storage_enabled():
+            publication.add("public_cert_status_sha1_url", fn, fp,
+                            settings.RCSPSHA1_BUCKET, pretty=False)
+            
+            #Delete all the old files:
+            #PEM, DIR, ZIP
+            for field, s3field in (("presigned_zip_url", "presigned_zip_s3"),
+                                   ("public_cert_der_url", "public_cert_der_s3"),
+                                   ("public_cert_pem_url", "public_cert_pem_s3")):
+                if getattr(self, s3field):
+                    s3info = json.loads(getattr(self, s3field))
+                    publication.remove(field, s3info['bucket'], s3info['key'])
+        return publication
+    
+    def finish_revocation(self, publication):
+        """
+        The second half of revoking, once the revoked status is published
+        and the old files deleted: revoke the certificate in the anchor's
+        and the CA's index.
+        """
+        for field, bucket, key in publication.deletions:
+            setattr(self, field, "")
+            if field == "presigned_zip_url":
+                PresignedURL.forget(bucket, key)
+        
+        # Now perform the revcation on our index and delete old files.
+        revoke_from_anchor(self)
+        revoke(self)
 
     def delete(self, **kwargs):
         self.revoke = True
@@ -913,14 +953,15 @@ class DomainBoundCertificate(models.Model):
         f.close()
         
         #Upload the RCSP file to S3
-        s=SimpleS3()
-        if settings.USE_S3:
-            url = s.store_in_s3(fn, fp, bucket=settings.RCSP_BUCKET,
+        s = get_storage()
+        if s:
+            url = s.store(fn, fp, settings.RCSP_BUCKET,
                             public=True)
 
             
         #Calculate the SHA1 fingerprint & write it to a file
-        digestsha1 = json.dumps(sha.sha1_from_filepath(fp), indent =4)
+        digestsha1 = json.dumps(sha.sha1_from_bytes(str(rcsp_result)),
+                                indent =4)
         fn = "%s-sha1.json" % (self.serial_number)
         fp = os.path.join(self.completed_dir_path, fn)
         f = open(fp, "w")
@@ -928,15 +969,214 @@ class DomainBoundCertificate(models.Model):
         f.close()
             
         #Upload the RCSP SHA! Digest to S3
-        if settings.USE_S3:
-            url = s.store_in_s3(fn, fp, bucket=settings.RCSPSHA1_BUCKET,
+        if s:
+            url = s.store(fn, fp, settings.RCSPSHA1_BUCKET,
                             public=True)
         revoke_from_anchor(self)
         revoke(self)
+        CRLState.revoked(self.trust_anchor)
+        CRLState.revoked()
         
         super(DomainBoundCertificate, self).save(**kwargs)
 
 
+def load_related(certificates):
+    """Fetch each certificate's owner, and anchor, before threads use them."""
+    for c in certificates:
+        getattr(c, "trust_anchor", c).owner
+
+
+def send_emails(emails):
+    """Send emails over one SMTP connection."""
+    if not emails:
+        return
+    try:
+        get_connection().send_messages(emails)
+    except Exception, e:
+        print "[ERROR] Could not send %s emails: %s" % (len(emails), e)
+
+
+def verify_certificates(certificates):
+    """
+    Verify trust anchor and domain-bound certificates together, as the
+    admin's verify action does: each one's files are written in the
+    publishing threads, all their uploads made at once, every row saved in
+    one transaction, then every email sent over one SMTP connection.
+    Returns those verified.
+    """
+    pending = [c for c in certificates if not c.verified_message_sent and
+               c.status in ('unverified', 'good')]
+    load_related(pending)
+    for c in pending:
+        c.verified = True
+    publications = publish_all(pool().map(
+                        operator.methodcaller("prepare_verification"), pending))
+    if storage_enabled():
+        # Presign the private zips together, outside the transaction.
+        PresignedURL.urls_for([(settings.PRIVCERT_BUCKET,
+                                str(c.private_zip_name)) for c in pending
+                               if isinstance(c, DomainBoundCertificate)])
+    emails = []
+    with transaction.commit_on_success():
+        for c, publication in zip(pending, publications):
+            email = c.finish_verification(publication, send=False)
+            if email:
+                emails.append(email)
+            c.save()
+    send_emails(emails)
+    return pending
+
+
+def revoke_certificates(certificates):
+    """
+    Revoke trust anchor and domain-bound certificates together, as the
+    admin's revoke action does: each one's revoked status is written in
+    the publishing threads and all the uploads and deletions made at once.
+    Each row is then saved in its own transaction with its change to the
+    index, which cannot be undone, so a failure leaves the rest revoked;
+    the CRL states follow in one more. Returns those revoked and a list of
+    (certificate, error) of those that were not.
+    """
+    # Endpoints first: revoking an anchor removes its directory.
+    pending = sorted([c for c in certificates if
+                      c.status in ('unverified', 'good')],
+                     key=lambda c: isinstance(c, TrustAnchorCertificate))
+    for c in pending:
+        c.revoke = True
+    publications = publish_all(pool().map(
+                        operator.methodcaller("prepare_revocation"), pending))
+    revoked, failed, anchors = [], [], {}
+    for c, publication in zip(pending, publications):
+        try:
+            with transaction.commit_on_success():
+                c.finish_revocation(publication)
+                c.save()
+        except Exception, e:
+            print "[ERROR] Could not revoke %s: %s" % (c.serial_number, e)
+            failed.append((c, e))
+            continue
+        revoked.append(c)
+        if isinstance(c, DomainBoundCertificate):
+            anchors[c.trust_anchor_id] = c.trust_anchor
+    with transaction.commit_on_success():
+        for anchor in anchors.values():
+            CRLState.revoked(anchor)
+        if revoked:
+            CRLState.revoked()
+    return revoked, failed
+
+
+def refresh_presigned_zip_urls(certificates):
+    """
+    Set presigned_zip_url on each certificate whose zip is private to a
+    current presigned URL, from PresignedURL, for pages listing them.
+    """
+    wanted = {}
+    for c in certificates:
+        if c.presigned_zip_s3 and c.status != "revoked":
+            s3info = json.loads(c.presigned_zip_s3)
+            if s3info['bucket'] == settings.PRIVCERT_BUCKET:
+                wanted[c] = (s3info['bucket'], s3info['key'])
+    if wanted and storage_enabled():
+        urls = PresignedURL.urls_for(wanted.values())
+        for c, obj in wanted.items():
+            c.presigned_zip_url = urls.get(obj, c.presigned_zip_url)
+    return certificates
+
+
+class PresignedURL(models.Model):
+    """
+    The presigned URL last made for a private object. url_for() and
+    urls_for() hand out the same URL, from memory or from here, until
+    CA_PRESIGNED_URL_MARGIN seconds before it expires, then sign a new one
+    valid for CA_PRESIGNED_URL_SECONDS, so pages do not sign a URL on
+    every view nor show one that has expired.
+    """
+    bucket      = models.CharField(max_length=255)
+    key         = models.CharField(max_length=255)
+    url         = models.CharField(max_length=1024)
+    expires     = models.DateTimeField()
+
+    # (bucket, key) -> (url, expires), this process's copy.
+    cache = {}
+    cache_lock = threading.Lock()
+
+    class Meta:
+        unique_together = (("bucket", "key"),)
+
+    def __unicode__(self):
+        return '%s/%s until %s' % (self.bucket, self.key, self.expires)
+
+    @staticmethod
+    def usable(expires, now):
+        return expires - now > datetime.timedelta(
+                                    seconds=settings.CA_PRESIGNED_URL_MARGIN)
+
+    @classmethod
+    def url_for(cls, bucket, key, now=None):
+        return cls.urls_for([(bucket, key)], now).get((bucket, key), "")
+
+    @classmethod
+    def urls_for(cls, objects, now=None):
+        """
+        A dict of (bucket, key) -> URL for objects, (bucket, key) pairs,
+        signing only those without a usable URL. Objects that could not be
+        signed are left out.
+        """
+        now = now or datetime.datetime.now()
+        urls, missing = {}, set()
+        with cls.cache_lock:
+            for obj in objects:
+                cached = cls.cache.get(obj)
+                if cached and cls.usable(cached[1], now):
+                    urls[obj] = cached[0]
+                else:
+                    missing.add(obj)
+        if not missing:
+            return urls
+
+        stored = cls.objects.filter(key__in=set(k for b, k in missing))
+        for p in stored:
+            obj = (p.bucket, p.key)
+            if obj in missing and cls.usable(p.expires, now):
+                urls[obj] = p.url
+                missing.discard(obj)
+                with cls.cache_lock:
+                    cls.cache[obj] = (p.url, p.expires)
+
+        s = get_storage()
+        signed = []
+        for bucket, key in missing:
+            url = s.presigned_url(key, bucket,
+                                  settings.CA_PRESIGNED_URL_SECONDS)
+            if url:
+                expires = now + datetime.timedelta(
+                                    seconds=settings.CA_PRESIGNED_URL_SECONDS)
+                urls[(bucket, key)] = url
+                signed.append(cls(bucket=bucket, key=key, url=url,
+                                  expires=expires))
+        if signed:
+            try:
+                with transaction.commit_on_success():
+                    cls.objects.filter(bucket__in=set(p.bucket for p in signed),
+                                       key__in=set(p.key for p in signed)
+                                       ).delete()
+                    cls.objects.bulk_create(signed)
+            except IntegrityError:
+                # Another process signed them too; either URL will do.
+                pass
+            with cls.cache_lock:
+                for p in signed:
+                    cls.cache[(p.bucket, p.key)] = (p.url, p.expires)
+        return urls
+
+    @classmethod
+    def forget(cls, bucket, key):
+        with cls.cache_lock:
+            cls.cache.pop((bucket, key), None)
+        cls.objects.filter(bucket=bucket, key=key).delete()
+
+
 
 class CertificateRevocationList(models.Model):
     
@@ -954,7 +1194,10 @@ class CertificateRevocationList(models.Model):
         ordering = ('-creation_date',)
         
     def save(self, **kwargs):
+        state = CRLState.for_anchor()
         self.url = build_crl()
+        if self.url != "Failed":
+            state.published(crl_path())
     
         super(CertificateRevocationList, self).save(**kwargs)
         
@@ -974,7 +1217,286 @@ class AnchorCertificateRevocationList(models.Model):
         
     def save(self, **kwargs):
         
+        state = CRLState.for_anchor(self.trust_anchor)
         self.url = build_anchor_crl(self.trust_anchor)
+        if self.url != "Failed":
+            state.published(anchor_crl_path(self.trust_anchor))
     
         super(AnchorCertificateRevocationList, self).save(**kwargs)
-    
\ No newline at end of file
+
+    @classmethod
+    def replace(cls, trust_anchor, url, state):
+        """
+        Replace the CRL row of trust_anchor with one for a CRL that was
+        already built and published to url, as scripts/buildcrl.py does.
+        """
+        cls.objects.filter(trust_anchor=trust_anchor).delete()
+        crl = cls(trust_anchor=trust_anchor, url=url)
+        models.Model.save(crl)
+        if url != "Failed":
+            state.published(anchor_crl_path(trust_anchor))
+        return crl
+
+
+class CRLState(models.Model):
+    """
+    Change tracking for one CRL: the CA's when trust_anchor is None, else
+    the trust anchor's. revocation_sequence goes up with every revocation
+    and published_sequence records the value the last published CRL was
+    built from, so scripts/buildcrl.py only rebuilds CRLs that changed or
+    are within CA_CRL_REFRESH_SECONDS of their nextUpdate.
+    """
+    trust_anchor        = models.OneToOneField(TrustAnchorCertificate,
+                                               null=True, blank=True)
+    revocation_sequence = models.IntegerField(default=0)
+    published_sequence  = models.IntegerField(default=-1)
+    next_update         = models.DateTimeField(null=True, blank=True)
+    published_datetime  = models.DateTimeField(null=True, blank=True)
+
+    def __unicode__(self):
+        return 'CRL state for %s: %s/%s' % (self.trust_anchor or "the CA",
+                                            self.published_sequence,
+                                            self.revocation_sequence)
+
+    @classmethod
+    def for_anchor(cls, trust_anchor=None):
+        state, created = cls.objects.get_or_create(trust_anchor=trust_anchor)
+        return state
+
+    @classmethod
+    def revoked(cls, trust_anchor=None):
+        """Mark the CRL of trust_anchor (or the CA's) as out of date."""
+        state = cls.for_anchor(trust_anchor)
+        cls.objects.filter(id=state.id).update(
+                    revocation_sequence=models.F('revocation_sequence') + 1)
+
+    def needs_crl(self, now=None):
+        if self.published_sequence != self.revocation_sequence:
+            return True
+        if self.next_update is None:
+            return True
+        now = now or datetime.datetime.utcnow()
+        margin = datetime.timedelta(seconds=settings.CA_CRL_REFRESH_SECONDS)
+        return self.next_update - margin <= now
+
+    def published(self, path):
+        """
+        Record that the CRL at path was published. Revocations made since
+        this state was loaded keep it dirty.
+        """
+        self.published_sequence = self.revocation_sequence
+        self.next_update = crl_next_update(path)
+        self.published_datetime = datetime.datetime.utcnow()
+        CRLState.objects.filter(id=self.id).update(
+                                published_sequence=self.published_sequence,
+                                next_update=self.next_update,
+                                published_datetime=self.published_datetime)
+
+
+
+CRL_KIND_CHOICES = (('base','base'),
+                    ('delta','delta'))
+
+
+class CRLPublication(models.Model):
+    """
+    A numbered base or delta CRL, published under crl/ by scripts/buildcrl.py
+    when CA_DELTA_CRLS is on: the CA's when trust_anchor is None, else the
+    trust anchor's. Base and delta CRLs of one issuer share one sequence of
+    CRL numbers.
+    """
+    trust_anchor        = models.ForeignKey(TrustAnchorCertificate, null=True,
+                                            blank=True)
+    kind                = models.CharField(max_length=5, choices=CRL_KIND_CHOICES)
+    crl_number          = models.IntegerField()
+    base_crl_number     = models.IntegerField(null=True, blank=True)
+    url                 = models.CharField(max_length=512, default="", blank=True)
+    this_update         = models.DateTimeField()
+    next_update         = models.DateTimeField()
+    creation_datetime   = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return '%s CRL %s for %s' % (self.kind, self.crl_number,
+                                     self.trust_anchor or "the CA")
+
+    class Meta:
+        get_latest_by = "crl_number"
+        ordering = ('-crl_number',)
+        index_together = [['trust_anchor', 'kind']]
+
+    @classmethod
+    def plan(cls, trust_anchor=None, now=None, force=False):
+        """
+        What to build next for trust_anchor (or the CA): ("base", number,
+        None) when a base CRL is due, every CA_BASE_CRL_SECONDS or before the
+        current one runs out, else ("delta", number, (base number, base
+        thisUpdate)).
+        """
+        now = now or datetime.datetime.utcnow()
+        crls = cls.objects.filter(trust_anchor=trust_anchor)
+        last = list(crls[:1])
+        crl_number = last[0].crl_number + 1 if last else 1
+        base = list(crls.filter(kind="base")[:1])
+        if force or not base:
+            return ("base", crl_number, None)
+        base = base[0]
+        age = datetime.timedelta(seconds=settings.CA_BASE_CRL_SECONDS)
+        margin = datetime.timedelta(seconds=settings.CA_CRL_REFRESH_SECONDS)
+        if base.this_update + age <= now or base.next_update - margin <= now:
+            return ("base", crl_number, None)
+        return ("delta", crl_number, (base.crl_number, base.this_update))
+
+    @classmethod
+    def record(cls, trust_anchor, crls, urls, state):
+        """
+        Record the CRLs from sign_numbered_crls() as published to urls, and
+        drop rows a new base CRL has superseded.
+        """
+        for (fields, path), url in zip(crls, urls):
+            cls.objects.create(trust_anchor=trust_anchor, url=url, **fields)
+            if fields["kind"] == "base":
+                cls.objects.filter(trust_anchor=trust_anchor,
+                        crl_number__lt=fields["crl_number"]).delete()
+        state.published(crls[-1][1])
+
+
+JOB_STATUS_CHOICES = (  ('queued','queued'),
+                        ('running','running'),
+                        ('done','done'),
+                        ('failed','failed'))
+
+JOB_KIND_CHOICES = (('trust_anchor','Trust Anchor'),
+                    ('domain_bound','Domain Bound'))
+
+
+class IssuanceJob(models.Model):
+    """
+    Issuance of one new certificate, queued by save() when CA_ASYNC_ISSUANCE
+    is set and run by scripts/issuance_worker.py.
+    """
+    kind                = models.CharField(max_length=20, choices=JOB_KIND_CHOICES)
+    object_id           = models.IntegerField(db_index=True)
+    status              = models.CharField(max_length=10, default="queued",
+                                           choices=JOB_STATUS_CHOICES,
+                                           db_index=True)
+    attempts            = models.IntegerField(default=0)
+    error               = models.TextField(blank=True, default="")
+    creation_datetime   = models.DateTimeField(auto_now_add=True)
+    started_datetime    = models.DateTimeField(null=True, blank=True)
+    heartbeat_datetime  = models.DateTimeField(null=True, blank=True)
+    finished_datetime   = models.DateTimeField(null=True, blank=True)
+
+    def __unicode__(self):
+        return '%s %s Status=%s, Attempts %s.' % (self.kind, self.object_id,
+                                                 self.status, self.attempts)
+
+    class Meta:
+        ordering = ('id',)
+
+    @staticmethod
+    def kind_for(cert):
+        if isinstance(cert, TrustAnchorCertificate):
+            return "trust_anchor"
+        return "domain_bound"
+
+    @classmethod
+    def enqueue_for(cls, cert, **kwargs):
+        """
+        Save a new certificate as incomplete and queue its issuance, unless a
+        job for it is already waiting or running.
+        """
+        cert.status = "incomplete"
+        cert.expiration_date = datetime.date.today() + datetime.timedelta(
+                                                    days=cert.expire_days)
+        models.Model.save(cert, **kwargs)
+        kind = cls.kind_for(cert)
+        if not cls.objects.filter(kind=kind, object_id=cert.id,
+                                  status__in=("queued", "running")).exists():
+            cls.objects.create(kind=kind, object_id=cert.id)
+
+    @classmethod
+    def latest_for(cls, cert):
+        jobs = cls.objects.filter(kind=cls.kind_for(cert),
+                                  object_id=cert.id).order_by('-id')[:1]
+        if jobs:
+            return jobs[0]
+        return None
+
+    @classmethod
+    def claim(cls):
+        """
+        Mark the oldest queued job running and return it, or None. The
+        conditional update means two workers never claim the same job.
+        """
+        for job_id in cls.objects.filter(status="queued").values_list(
+                                                            'id', flat=True)[:10]:
+            now = datetime.datetime.now()
+            claimed = cls.objects.filter(id=job_id, status="queued").update(
+                                    status="running",
+                                    attempts=models.F('attempts') + 1,
+                                    started_datetime=now,
+                                    heartbeat_datetime=now)
+            if claimed:
+                return cls.objects.get(id=job_id)
+        return None
+
+    @classmethod
+    def beat(cls, job_ids):
+        """Record that the worker running job_ids is still alive."""
+        return cls.objects.filter(id__in=list(job_ids), status="running").update(
+                                    heartbeat_datetime=datetime.datetime.now())
+
+    @classmethod
+    def requeue_stale(cls, seconds):
+        """
+        Put back jobs left running by a worker that died: those it has not
+        beat() for in seconds. A job that is only slow keeps its heartbeat,
+        so it is never issued twice.
+        """
+        cutoff = datetime.datetime.now() - datetime.timedelta(seconds=seconds)
+        return cls.objects.filter(status="running",
+                                  heartbeat_datetime__lt=cutoff).update(
+                                                            status="queued")
+
+    def certificate_model(self):
+        if self.kind == "trust_anchor":
+            return TrustAnchorCertificate
+        return DomainBoundCertificate
+
+    def run(self):
+        """
+        Issue the certificate. An exception puts the job back in the queue
+        until it has had CA_ISSUANCE_MAX_ATTEMPTS tries.
+        """
+        model = self.certificate_model()
+        try:
+            cert = model.objects.get(id=self.object_id)
+        except model.DoesNotExist:
+            cert = None
+        if cert is None:
+            self.status = "failed"
+            self.error = "The certificate no longer exists."
+        elif cert.status != "incomplete":
+            # Issued by an earlier attempt that died before finishing the job.
+            self.status = "done"
+        else:
+            try:
+                cert.issue()
+            except Exception:
+                self.error = traceback.format_exc()
+                if self.attempts < settings.CA_ISSUANCE_MAX_ATTEMPTS:
+                    self.status = "queued"
+                else:
+                    self.status = "failed"
+                    model.objects.filter(id=self.object_id).update(
+                                            status="failed", notes=self.error)
+            else:
+                if cert.status == "failed":
+                    self.status = "failed"
+                    self.error = cert.notes
+                else:
+                    self.status = "done"
+        self.finished_datetime = datetime.datetime.now()
+        self.save()
+        return self.status
+
@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+An OCSP responder (RFC 6960) for the certificates in our tables.
+
+The CA answers for the trust anchors it issued and each trust anchor for
+its domain-bound certificates, signing with its own key. Statuses come
+from an in-memory index of TrustAnchorCertificate and
+DomainBoundCertificate, rebuilt every CA_OCSP_INDEX_SECONDS and patched by
+post_save as certificates change in this process. Signed responses are
+cached until their nextUpdate, CA_OCSP_RESPONSE_SECONDS after they are
+made; a status change drops the cached response. Nonces are ignored, as
+in the RFC 5019 lightweight profile, so cached responses can be served.
+With CA_OCSP_CACHE_ENABLED, responses are also read from the pre-signed
+cache shared by all processes (ocspcache.py), and a revocation re-signs
+its certificate's responses there at once. A shared response signed since
+the one held in memory wins, so another process's revocation is served
+without waiting for the index; the responder itself never writes the
+shared cache, as its index may be CA_OCSP_INDEX_SECONDS behind.
+
+    from ocsp import responder
+    der = responder.respond(request_der)
+"""
+
+from django.conf import settings
+from django.db.models.signals import post_save
+import datetime, time, json, threading
+from cryptography import x509
+from cryptography.x509 import ocsp
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from models import TrustAnchorCertificate, DomainBoundCertificate
+from castore import load_key_pair
+from cautils import read_conf
+import ocspcache
+
+HASH_ALGORITHMS = {"sha1": hashes.SHA1, "sha256": hashes.SHA256}
+
+GOOD_STATUSES = ("good", "unverified")
+
+
+def unsuccessful(status):
+    """The DER of an OCSPResponse that carries no body."""
+    return ocsp.OCSPResponseBuilder.build_unsuccessful(status).public_bytes(
+                                                    serialization.Encoding.DER)
+
+MALFORMED_REQUEST = unsuccessful(ocsp.OCSPResponseStatus.MALFORMED_REQUEST)
+INTERNAL_ERROR = unsuccessful(ocsp.OCSPResponseStatus.INTERNAL_ERROR)
+UNAUTHORIZED = unsuccessful(ocsp.OCSPResponseStatus.UNAUTHORIZED)
+
+_stub_key = []
+
+
+def stub_certificate(issuer_cert, serial):
+    """
+    A throw-away certificate with serial, issued in issuer_cert's name. The
+    OCSP builders take the CertID's serial and issuer name from a
+    certificate, and we answer for serials, not certificates. It is signed
+    with a P-256 key made once per process, which costs far less than the
+    response's own RSA signature.
+    """
+    if not _stub_key:
+        _stub_key.append(ec.generate_private_key(ec.SECP256R1(),
+                                                 default_backend()))
+    return x509.CertificateBuilder().subject_name(
+                issuer_cert.subject).issuer_name(
+                issuer_cert.subject).public_key(
+                _stub_key[0].public_key()).serial_number(
+                serial).not_valid_before(
+                issuer_cert.not_valid_before).not_valid_after(
+                issuer_cert.not_valid_after).sign(_stub_key[0],
+                                                  hashes.SHA256(),
+                                                  default_backend())
+
+
+def build_request(issuer_cert, serial, algorithm="sha1"):
+    return ocsp.OCSPRequestBuilder().add_certificate(
+                    stub_certificate(issuer_cert, serial), issuer_cert,
+                    HASH_ALGORITHMS[algorithm]()).build()
+
+
+def request_der(issuer_cert, serial, algorithm="sha1"):
+    """A single-certificate OCSP request, as relying parties send."""
+    return build_request(issuer_cert, serial, algorithm).public_bytes(
+                                                    serialization.Encoding.DER)
+
+
+def revocation_time(rcsp_response):
+    """When a certificate was revoked, from the RCSP JSON written then."""
+    try:
+        local = datetime.datetime.strptime(
+                    json.loads(rcsp_response)["ThisUpdate"].split(".")[0],
+                    "%Y-%m-%d %H:%M:%S")
+        return datetime.datetime.utcfromtimestamp(time.mktime(local.timetuple()))
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def cert_status(status, rcsp):
+    """The (status, revoked at) Issuer.respond() takes, or None if unknown."""
+    if status == "revoked":
+        return (status, revocation_time(rcsp))
+    elif status in GOOD_STATUSES:
+        return (status, None)
+    return None
+
+
+def ca_issuer():
+    conf = read_conf(settings.CA_MAIN_CONF)
+    return Issuer("ca", settings.CA_PUBLIC_CERT,
+                  conf[conf["ca"]["default_ca"]]["private_key"],
+                  getattr(settings, "PRIVATE_PASSWORD", None))
+
+
+def parse_serial(serial_number):
+    try:
+        return int(serial_number, 16)
+    except (ValueError, TypeError):
+        return None
+
+
+class Issuer(object):
+    """A certificate that signs responses for what it issued."""
+
+    def __init__(self, id, cert_path, key_path, passphrase=None):
+        self.id = id
+        self.key_path = key_path
+        self.passphrase = passphrase
+        self.key = None
+        with open(cert_path, "rb") as f:
+            self.cert = x509.load_pem_x509_certificate(f.read(),
+                                                       default_backend())
+        self.cert_path = cert_path
+        self.hashes = {}
+        for algorithm in HASH_ALGORITHMS:
+            req = build_request(self.cert, 1, algorithm)
+            self.hashes[algorithm] = (req.issuer_name_hash,
+                                      req.issuer_key_hash)
+
+    def respond(self, algorithm, serial, status, now, next_update):
+        """A signed, successful OCSPResponse for one certificate."""
+        if self.key is None:
+            self.cert, self.key = load_key_pair(self.cert_path, self.key_path,
+                                                self.passphrase)
+        revoked_at = None
+        if status is None:
+            cert_status = ocsp.OCSPCertStatus.UNKNOWN
+        elif status[0] == "revoked":
+            cert_status = ocsp.OCSPCertStatus.REVOKED
+            revoked_at = status[1] or now
+        else:
+            cert_status = ocsp.OCSPCertStatus.GOOD
+        builder = ocsp.OCSPResponseBuilder().add_response(
+                        cert=stub_certificate(self.cert, serial),
+                        issuer=self.cert,
+                        algorithm=HASH_ALGORITHMS[algorithm](),
+                        cert_status=cert_status, this_update=now,
+                        next_update=next_update, revocation_time=revoked_at,
+                        revocation_reason=None).responder_id(
+                        ocsp.OCSPResponderEncoding.HASH, self.cert)
+        return builder.sign(self.key, hashes.SHA256()).public_bytes(
+                                                    serialization.Encoding.DER)
+
+
+class Responder(object):
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.built = None
+        self.issuers = {}       # (algorithm, name hash, key hash) -> Issuer
+        self.statuses = {}      # (issuer id, serial) -> (status, revoked at)
+        self.responses = {}     # (issuer id, algorithm, serial) ->
+                                #   (der, this update, next update,
+                                #    time.time() it was signed or loaded)
+        self.reset_stats()
+
+    def reset_stats(self):
+        # Where answers came from, and how old they were when served, by
+        # ocspcache.AGE_BUCKETS. Counted without the lock, so approximate.
+        self.hits = {"memory": 0, "presigned": 0, "signed": 0}
+        self.ages = [0] * (len(ocspcache.AGE_BUCKETS) + 1)
+
+    def stats(self):
+        served = sum(self.hits.values())
+        return {"served": served,
+                "hits": dict(self.hits),
+                "hit_rate": (float(self.hits["memory"] + self.hits["presigned"])
+                             / served if served else None),
+                "ages": zip(ocspcache.bucket_labels(), self.ages)}
+
+    def add_issuer(self, issuer, issuers=None):
+        issuers = self.issuers if issuers is None else issuers
+        for algorithm, (name_hash, key_hash) in issuer.hashes.items():
+            issuers[(algorithm, name_hash, key_hash)] = issuer
+
+    def build(self):
+        """Load every issuer and certificate status from the database."""
+        issuers, statuses = {}, {}
+        try:
+            self.add_issuer(ca_issuer(), issuers)
+        except (IOError, KeyError):
+            # No CA on this host; the trust anchors still answer.
+            pass
+        for id, serial, status, rcsp, public, private in \
+                TrustAnchorCertificate.objects.values_list('id',
+                    'serial_number', 'status', 'rcsp_response',
+                    'public_key_path', 'private_key_path').iterator():
+            self.set_status("ca", serial, status, rcsp, statuses)
+            try:
+                self.add_issuer(Issuer(id, public, private), issuers)
+            except IOError:
+                pass
+        for anchor, serial, status, rcsp in \
+                DomainBoundCertificate.objects.values_list('trust_anchor_id',
+                    'serial_number', 'status', 'rcsp_response').iterator():
+            self.set_status(anchor, serial, status, rcsp, statuses)
+        self.issuers = issuers
+        self.statuses = statuses
+        self.responses = {}
+        self.built = time.time()
+
+    def set_status(self, issuer_id, serial_number, status, rcsp, statuses=None):
+        statuses = self.statuses if statuses is None else statuses
+        serial = parse_serial(serial_number)
+        if serial is None:
+            return
+        status = cert_status(status, rcsp)
+        if status:
+            statuses[(issuer_id, serial)] = status
+        else:
+            statuses.pop((issuer_id, serial), None)
+        for algorithm in HASH_ALGORITHMS:
+            self.responses.pop((issuer_id, algorithm, serial), None)
+
+    def refresh(self):
+        if (self.built is None or
+            time.time() - self.built > settings.CA_OCSP_INDEX_SECONDS):
+            with self.lock:
+                if (self.built is None or
+                    time.time() - self.built > settings.CA_OCSP_INDEX_SECONDS):
+                    self.build()
+
+    def certificate_saved(self, instance):
+        if settings.CA_OCSP_CACHE_ENABLED and instance.status == "revoked":
+            self.resign(instance)
+        if self.built is None:
+            return
+        with self.lock:
+            if isinstance(instance, TrustAnchorCertificate):
+                self.set_status("ca", instance.serial_number, instance.status,
+                                instance.rcsp_response)
+                try:
+                    self.add_issuer(Issuer(instance.id, instance.public_key_path,
+                                           instance.private_key_path))
+                except IOError:
+                    pass
+            else:
+                self.set_status(instance.trust_anchor_id,
+                                instance.serial_number, instance.status,
+                                instance.rcsp_response)
+
+    def resign(self, instance):
+        """
+        Replace a revoked certificate's pre-signed responses, unless they
+        already say revoked. Without the issuer's key here, the next
+        presign_ocsp run does it instead.
+        """
+        serial = parse_serial(instance.serial_number)
+        if serial is None:
+            return
+        try:
+            if isinstance(instance, TrustAnchorCertificate):
+                issuer = ca_issuer()
+            else:
+                anchor = instance.trust_anchor
+                issuer = Issuer(anchor.id, anchor.public_key_path,
+                                anchor.private_key_path)
+        except (IOError, KeyError):
+            return
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        next_update = now + datetime.timedelta(
+                                    seconds=settings.CA_OCSP_RESPONSE_SECONDS)
+        status = cert_status(instance.status, instance.rcsp_response)
+        for algorithm in settings.CA_OCSP_PRESIGN_ALGORITHMS:
+            cached = ocspcache.load(issuer.id, algorithm, serial)
+            if cached and cached[1].certificate_status == ocsp.OCSPCertStatus.REVOKED:
+                continue
+            try:
+                ocspcache.store(issuer.id, algorithm, serial,
+                                issuer.respond(algorithm, serial, status,
+                                               now, next_update))
+            except (IOError, OSError, ValueError, TypeError):
+                return
+
+    def respond(self, request):
+        """The DER OCSPResponse for a DER OCSPRequest."""
+        try:
+            req = ocsp.load_der_ocsp_request(request)
+            algorithm = req.hash_algorithm.name
+            issuer = self.issuers_for(algorithm, req.issuer_name_hash,
+                                      req.issuer_key_hash)
+            serial = req.serial_number
+        except (ValueError, NotImplementedError):
+            return MALFORMED_REQUEST
+        if issuer is None:
+            return UNAUTHORIZED
+        key = (issuer.id, algorithm, serial)
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        cached = self.responses.get(key)
+        if settings.CA_OCSP_CACHE_ENABLED:
+            signed = ocspcache.signed(issuer.id, algorithm, serial)
+            if signed is not None and (cached is None or signed > cached[3]):
+                presigned = ocspcache.load(issuer.id, algorithm, serial)
+                if presigned and presigned[1].next_update > now:
+                    cached = (presigned[0], presigned[1].this_update,
+                              presigned[1].next_update, signed)
+                    self.responses[key] = cached
+                    return self.served("presigned", cached, now)
+        if cached and cached[2] > now:
+            return self.served("memory", cached, now)
+        next_update = now + datetime.timedelta(
+                                    seconds=settings.CA_OCSP_RESPONSE_SECONDS)
+        with self.lock:
+            try:
+                der = issuer.respond(algorithm, serial,
+                                     self.statuses.get((issuer.id, serial)),
+                                     now, next_update)
+            except (IOError, ValueError, TypeError):
+                # The issuer's key is missing or would not load.
+                return INTERNAL_ERROR
+            cached = (der, now, next_update, time.time())
+            self.responses[key] = cached
+        return self.served("signed", cached, now)
+
+    def served(self, source, cached, now):
+        self.hits[source] += 1
+        age = now - cached[1]
+        self.ages[ocspcache.bucket(age.days * 86400 + age.seconds)] += 1
+        return cached[0]
+
+    def issuers_for(self, algorithm, name_hash, key_hash):
+        self.refresh()
+        return self.issuers.get((algorithm, name_hash, key_hash))
+
+
+responder = Responder()
+
+
+def certificate_saved(sender, instance, **kwargs):
+    responder.certificate_saved(instance)
+
+post_save.connect(certificate_saved, sender=TrustAnchorCertificate)
+post_save.connect(certificate_saved, sender=DomainBoundCertificate)
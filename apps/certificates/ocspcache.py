@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+Pre-signed OCSP responses, shared by every responder process as files.
+
+With CA_OCSP_CACHE_ENABLED on, each signed response is kept as DER at
+CA_OCSP_CACHE_DIR/<issuer id>/<algorithm>/<serial>.der, written whole and
+renamed into place. scripts/presign_ocsp.py re-signs every response older
+than CA_OCSP_RESIGN_SECONDS in a process pool, and a revocation re-signs
+its certificate's responses at once; they are the only writers. The
+responder (ocsp.py) reads them, and so seldom signs anything itself. A
+file's mtime is when it was signed.
+
+    from ocspcache import load, store
+    store("ca", "sha1", 10, der)
+    der, response = load("ca", "sha1", 10)
+"""
+
+from django.conf import settings
+import os, time
+from cryptography.x509 import ocsp
+
+# Upper bounds, in seconds, of the age histogram buckets.
+AGE_BUCKETS = (60, 5 * 60, 15 * 60, 60 * 60, 6 * 60 * 60, 24 * 60 * 60)
+
+
+def cache_path(issuer_id, algorithm, serial):
+    return os.path.join(settings.CA_OCSP_CACHE_DIR, str(issuer_id), algorithm,
+                        "%X.der" % (serial))
+
+
+def store(issuer_id, algorithm, serial, der):
+    path = cache_path(issuer_id, algorithm, serial)
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Another worker made it first.
+            if not os.path.isdir(directory):
+                raise
+    tmp = "%s.%s.tmp" % (path, os.getpid())
+    f = open(tmp, "wb")
+    f.write(der)
+    f.close()
+    os.rename(tmp, path)
+
+
+def load(issuer_id, algorithm, serial):
+    """The cached DER response and its parsed form, or None."""
+    try:
+        with open(cache_path(issuer_id, algorithm, serial), "rb") as f:
+            der = f.read()
+        return der, ocsp.load_der_ocsp_response(der)
+    except (IOError, ValueError):
+        return None
+
+
+def signed(issuer_id, algorithm, serial):
+    """When the cached response was signed, as time.time(), or None."""
+    try:
+        return os.path.getmtime(cache_path(issuer_id, algorithm, serial))
+    except OSError:
+        return None
+
+
+def age(issuer_id, algorithm, serial, now=None):
+    """Seconds since the cached response was signed, or None if there is none."""
+    mtime = signed(issuer_id, algorithm, serial)
+    if mtime is None:
+        return None
+    return (now or time.time()) - mtime
+
+
+def bucket(seconds):
+    """The index in AGE_BUCKETS (len(AGE_BUCKETS) if older) of an age."""
+    for i, limit in enumerate(AGE_BUCKETS):
+        if seconds < limit:
+            return i
+    return len(AGE_BUCKETS)
+
+
+def bucket_labels():
+    labels = ["< %s" % (format_seconds(limit)) for limit in AGE_BUCKETS]
+    return labels + [">= %s" % (format_seconds(AGE_BUCKETS[-1]))]
+
+
+def format_seconds(seconds):
+    for unit, size in (("d", 86400), ("h", 3600), ("m", 60)):
+        if seconds >= size and seconds % size == 0:
+            return "%s%s" % (seconds // size, unit)
+    return "%ss" % (seconds)
+
+
+def cache_histogram(now=None):
+    """Counts of cached responses by age, one per AGE_BUCKETS bucket."""
+    now = now or time.time()
+    counts = [0] * (len(AGE_BUCKETS) + 1)
+    for directory, dirs, files in os.walk(settings.CA_OCSP_CACHE_DIR):
+        for name in files:
+            if name.endswith(".der"):
+                try:
+                    mtime = os.path.getmtime(os.path.join(directory, name))
+                except OSError:
+                    continue
+                counts[bucket(now - mtime)] += 1
+    return counts
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+Publishing a certificate's artifacts (status, digest, x5c, PEM, DER, zip)
+to the storage backend (storage.py).
+
+A Publication collects every upload a certificate needs and makes them
+at once in a pool of CA_PUBLISH_THREADS threads, each retried up to
+CA_PUBLISH_RETRIES times, so publishing takes about as long as the slowest
+upload rather than the sum of them. publish_all() puts the uploads of many
+certificates in the pool together.
+
+    from publisher import Publication
+    p = Publication()
+    p.add("public_cert_pem_url", key, path, settings.PUBCERT_BUCKET)
+    p.publish()
+    p.urls["public_cert_pem_url"], p.failed
+"""
+
+from django.conf import settings
+import os, time, threading
+from multiprocessing.pool import ThreadPool
+from storage import get_storage
+
+_lock = threading.Lock()
+_pool = {}      # pid -> ThreadPool
+
+
+def pool():
+    """This process's upload threads, made on first use."""
+    with _lock:
+        if os.getpid() not in _pool:
+            _pool.clear()
+            _pool[os.getpid()] = ThreadPool(settings.CA_PUBLISH_THREADS)
+        return _pool[os.getpid()]
+
+
+def remove(item):
+    """Delete one published artifact."""
+    field, bucket, key = item
+    get_storage().delete(bucket, key)
+
+
+def upload(item):
+    """Upload one artifact. Returns its URL, or "" if every attempt failed."""
+    field, key, path, bucket, public, pretty = item
+    s = get_storage()
+    for attempt in range(settings.CA_PUBLISH_RETRIES + 1):
+        if attempt:
+            time.sleep(settings.CA_PUBLISH_RETRY_SECONDS * attempt)
+        url = s.store(key, path, bucket, public=public)
+        if url:
+            return s.pretty_url(url, bucket) if pretty else url
+    return ""
+
+
+class Publication(object):
+    """The uploads of one certificate, and their results."""
+
+    def __init__(self):
+        self.uploads = []
+        self.deletions = []
+        self.urls = {}          # field -> URL
+        self.failed = []        # fields whose uploads failed
+
+    def add(self, field, key, path, bucket, public=True, pretty=True):
+        """Upload path as key; its URL goes to field (pretty, unless not)."""
+        self.uploads.append((field, key, path, bucket, public, pretty))
+
+    def remove(self, field, bucket, key):
+        """Delete bucket/key, once the uploads are made; field's URL goes."""
+        self.deletions.append((field, bucket, key))
+
+    def publish(self):
+        publish_all([self])
+        return self
+
+    @property
+    def ok(self):
+        return not self.failed
+
+
+def publish_all(publications):
+    """Make the uploads, then the deletions, of every publication together."""
+    items = [u for p in publications for u in p.uploads]
+    if items:
+        urls = iter(pool().map(upload, items))
+        for p in publications:
+            for field, key, path, bucket, public, pretty in p.uploads:
+                url = urls.next()
+                p.urls[field] = url
+                if not url:
+                    p.failed.append(field)
+                    print "[ERROR] Could not publish %s to %s." % (key, bucket)
+    deletions = [d for p in publications for d in p.deletions]
+    if deletions:
+        pool().map(remove, deletions)
+    return publications
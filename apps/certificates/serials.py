@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+Certificate serial numbers.
+
+CA_CONF_DIR/serial stays the one source of truth, in the format openssl ca
+uses, but only this module advances it. A process takes a block of
+CA_SERIAL_BLOCK_SIZE serials at a time under an flock and hands them out
+from memory, so concurrent issuances neither contend on the file nor race
+to the same number. Serials left in a block when a process exits are
+simply never used.
+
+    from serials import next_serial, format_serial
+    serial = next_serial()              # an int
+    format_serial(serial)               # "0A", as openssl prints it
+"""
+
+from django.conf import settings
+import os, fcntl, threading
+
+
+_lock = threading.Lock()
+_blocks = {}    # serial file path -> [pid, next, end]
+
+
+def format_serial(serial):
+    """Format a serial the way openssl prints it: upper case hex with an
+    even number of digits."""
+    s = "%X" % (serial)
+    if len(s) % 2:
+        s = "0" + s
+    return s
+
+
+def serial_path():
+    return os.path.join(settings.CA_CONF_DIR, "serial")
+
+
+def reserve(count, path=None):
+    """
+    Atomically take count serials from the serial file. Returns the first
+    one; the caller owns first .. first + count - 1.
+    """
+    path = path or serial_path()
+    lock = open(path + ".lock", "a")
+    try:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        f = open(path, "r")
+        first = int(f.read().strip(), 16)
+        f.close()
+        # Replace the file whole, so a crash never leaves half a serial.
+        tmp = "%s.%s.tmp" % (path, os.getpid())
+        f = open(tmp, "w")
+        f.write(format_serial(first + count) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(tmp, path)
+    finally:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+        lock.close()
+    return first
+
+
+def next_serial(path=None):
+    """The next unused serial, from this process's current block."""
+    path = path or serial_path()
+    pid = os.getpid()
+    with _lock:
+        block = _blocks.get(path)
+        # A forked child must not reuse the block its parent was handing out.
+        if block is None or block[0] != pid or block[1] >= block[2]:
+            size = max(int(getattr(settings, "CA_SERIAL_BLOCK_SIZE", 1)), 1)
+            first = reserve(size, path)
+            block = [pid, first, first + size]
+            _blocks[path] = block
+        serial = block[1]
+        block[1] += 1
+    return serial
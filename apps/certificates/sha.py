@@ -2,30 +2,57 @@
 # -*- coding: utf-8 -*-
 # vim: ai ts=4 sts=4 et sw=4
 
+"""
+Hex digests of files and of bytes already in memory.
+
+Files are read once, CHUNK bytes at a time, however large, and every
+digest asked for is computed in that one pass. Hash what you just wrote
+from the bytes you wrote rather than reading the file back.
+
+    from sha import digests_from_filepath, sha1_from_bytes
+    digests_from_filepath(path)     # {"sha1": ..., "sha256": ...}
+    sha1_from_bytes(rcsp_json)
+"""
 
 import os, sys, hashlib
 
+CHUNK = 1024 * 1024
+ALGORITHMS = ("sha1", "sha256")
+
+
+def digests_from_filepath(fp, algorithms=ALGORITHMS):
+    """The hex digests of the file at fp, by algorithm, in one read."""
+    hashes = [hashlib.new(a) for a in algorithms]
+    f = open(fp, 'rb')
+    try:
+        for chunk in iter(lambda: f.read(CHUNK), ""):
+            for m in hashes:
+                m.update(chunk)
+    finally:
+        f.close()
+    return dict(zip(algorithms, [m.hexdigest() for m in hashes]))
+
+
+def digests_from_bytes(data, algorithms=ALGORITHMS):
+    return dict((a, hashlib.new(a, data).hexdigest()) for a in algorithms)
+
+
 def sha1_from_filepath(fp):
-    f = open(fp, 'r')
-    m = hashlib.sha1()
-    m.update(f.read())
-    f.close()
-    return m.hexdigest()
+    return digests_from_filepath(fp, ("sha1",))["sha1"]
 
 def sha256_from_filepath(fp):
-    f = open(fp, 'r')
-    m = hashlib.sha256()
-    m.update(f.read())
-    f.close()
-    return m.hexdigest()
+    return digests_from_filepath(fp, ("sha256",))["sha256"]
+
+def sha1_from_bytes(data):
+    return hashlib.sha1(data).hexdigest()
+
+def sha256_from_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
 
 
-  
 if __name__ == "__main__":
     if len(sys.argv)!=2:
         print "Usage: python sha.py [filepath]"
         sys.exit(1)
     print sha256_from_filepath(sys.argv[1])
-        
-    
-    
\ No newline at end of file
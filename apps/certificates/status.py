@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+Certificate status lookups for the JSON status API (certificates/status/).
+
+Every issued TrustAnchorCertificate and DomainBoundCertificate is held in
+memory by serial and by SHA-1 fingerprint, each already serialized as the
+RCSP message the certificate last published (SerialNumber, CommonName,
+CertStatus, CertSHA1Fingerprint, ThisUpdate). A batch answer is those
+strings joined, so looking up a thousand certificates costs a thousand
+dictionary reads. The map is reloaded every CA_STATUS_INDEX_SECONDS and
+patched by post_save as certificates change in this process.
+
+    from status import status_map
+    status_map.lookup("0A")             # the entry, or None
+    status_map.lookup("AB:CD:...")      # by SHA-1 fingerprint
+"""
+
+from django.conf import settings
+from django.db.models.signals import post_save
+from django.utils.datastructures import SortedDict
+import datetime, time, json, threading
+from models import TrustAnchorCertificate, DomainBoundCertificate
+from ocsp import parse_serial
+
+ISSUED_STATUSES = ("unverified", "good", "revoked")
+FINGERPRINT_DIGITS = 40
+
+
+def normalize_fingerprint(fingerprint):
+    """A SHA-1 fingerprint without colons, upper case, or None."""
+    fingerprint = (fingerprint or "").replace(":", "").strip().upper()
+    if len(fingerprint) != FINGERPRINT_DIGITS:
+        return None
+    try:
+        int(fingerprint, 16)
+    except ValueError:
+        return None
+    return fingerprint
+
+
+def this_update(message):
+    """ThisUpdate from an RCSP message, as a local datetime, or None."""
+    try:
+        return datetime.datetime.strptime(message["ThisUpdate"].split(".")[0],
+                                          "%Y-%m-%d %H:%M:%S")
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+
+class Entry(object):
+    """One certificate's status, with its JSON made once."""
+
+    def __init__(self, serial_number, common_name, status, fingerprint, rcsp):
+        try:
+            message = json.loads(rcsp)
+        except (ValueError, TypeError):
+            message = {}
+        if message.get("CertStatus") != status:
+            # Issued but never published (or published before a change we
+            # have not written out): describe it from the row itself.
+            message = SortedDict()
+            message["SerialNumber"] = serial_number
+            message["CommonName"] = common_name
+            message["CertStatus"] = status
+            message["CertSHA1Fingerprint"] = fingerprint
+            message["ThisUpdate"] = None
+        self.serial = parse_serial(serial_number)
+        self.fingerprint = normalize_fingerprint(fingerprint)
+        self.this_update = this_update(message)
+        self.json = json.dumps(message)
+
+
+def unknown(identifier):
+    d = SortedDict()
+    d["Query"] = identifier
+    d["CertStatus"] = "unknown"
+    return json.dumps(d)
+
+
+class StatusMap(object):
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.built = None
+        self.by_serial = {}         # serial -> Entry
+        self.by_fingerprint = {}    # fingerprint -> Entry
+
+    def build(self):
+        """Load every issued certificate's status from the database."""
+        by_serial, by_fingerprint = {}, {}
+        for model in (TrustAnchorCertificate, DomainBoundCertificate):
+            for row in model.objects.filter(status__in=ISSUED_STATUSES) \
+                            .values_list('serial_number', 'common_name',
+                                         'status', 'sha1_fingerprint',
+                                         'rcsp_response').iterator():
+                self.add(Entry(*row), by_serial, by_fingerprint)
+        self.by_serial = by_serial
+        self.by_fingerprint = by_fingerprint
+        self.built = time.time()
+
+    def add(self, entry, by_serial=None, by_fingerprint=None):
+        by_serial = self.by_serial if by_serial is None else by_serial
+        by_fingerprint = (self.by_fingerprint if by_fingerprint is None
+                          else by_fingerprint)
+        if entry.serial is not None:
+            by_serial[entry.serial] = entry
+        if entry.fingerprint:
+            by_fingerprint[entry.fingerprint] = entry
+
+    def refresh(self):
+        if (self.built is None or
+            time.time() - self.built > settings.CA_STATUS_INDEX_SECONDS):
+            with self.lock:
+                if (self.built is None or
+                    time.time() - self.built > settings.CA_STATUS_INDEX_SECONDS):
+                    self.build()
+
+    def certificate_saved(self, instance):
+        if self.built is None:
+            return
+        with self.lock:
+            entry = Entry(instance.serial_number, instance.common_name,
+                          instance.status, instance.sha1_fingerprint,
+                          instance.rcsp_response)
+            if instance.status in ISSUED_STATUSES:
+                self.add(entry)
+            else:
+                self.by_serial.pop(entry.serial, None)
+                self.by_fingerprint.pop(entry.fingerprint, None)
+
+    def lookup(self, identifier):
+        """The Entry for a serial (hex) or SHA-1 fingerprint, or None."""
+        fingerprint = normalize_fingerprint(identifier)
+        if fingerprint:
+            entry = self.by_fingerprint.get(fingerprint)
+            if entry:
+                return entry
+        return self.by_serial.get(parse_serial(identifier))
+
+    def max_age(self, newest):
+        """
+        Seconds a response may be cached: a tenth of the time since its
+        newest ThisUpdate (the HTTP heuristic freshness of RFC 7234 4.2.2),
+        so recently changed statuses are re-checked soon, up to
+        CA_STATUS_MAX_AGE.
+        """
+        if newest is None:
+            return 0
+        age = datetime.datetime.now() - newest
+        age = age.days * 24 * 60 * 60 + age.seconds
+        return max(0, min(settings.CA_STATUS_MAX_AGE, age // 10))
+
+
+status_map = StatusMap()
+
+
+def certificate_saved(sender, instance, **kwargs):
+    status_map.certificate_saved(instance)
+
+post_save.connect(certificate_saved, sender=TrustAnchorCertificate)
+post_save.connect(certificate_saved, sender=DomainBoundCertificate)
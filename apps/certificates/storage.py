@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+Where published artifacts (status, digests, x5c, certificates, CRLs) go.
+
+CA_STORAGE_BACKEND picks the backend: "s3" uploads through SimpleS3, skipping
+content it already uploaded to the same key (manifest.py), and only while
+USE_S3 is on; "local" keeps everything under CA_STORAGE_DIR for
+deployments without S3, served by the storage_file view at
+CA_STORAGE_URL. The local backend is content addressed: each distinct
+content is stored once, as objects/<sha256[:2]>/<sha256>, and every
+bucket/key naming it is a hard link to that object. A private object's URL
+carries an expiry and an HMAC signature, like an S3 presigned URL.
+
+    from storage import get_storage
+    s = get_storage()
+    if s:
+        url = s.store("0A.json", path, settings.RCSP_BUCKET, public=True)
+        s.url(settings.RCSP_BUCKET, "0A.json")
+        s.delete(settings.RCSP_BUCKET, "0A.json")
+"""
+
+from django.conf import settings
+from django.utils.http import urlquote
+from django.utils.crypto import constant_time_compare
+import os, errno, time, hmac, hashlib, shutil, threading
+from fileutils import SimpleS3
+from sha import sha256_from_filepath
+from manifest import manifest
+
+CHUNK = 64 * 1024
+
+
+class S3Storage(object):
+    """The buckets on S3, through SimpleS3's pooled connections."""
+
+    def store(self, key, path, bucket, public=False):
+        """
+        Upload path as key, unless the manifest shows the same content is
+        there already. Returns its URL, or "" if the upload failed.
+        """
+        if not settings.CA_STORAGE_DEDUP:
+            return SimpleS3().store_in_s3(key, path, bucket=bucket,
+                                          public=public)
+        digest, size = manifest.fingerprint(path)
+        url = manifest.lookup(bucket, key, digest, public)
+        if url:
+            manifest.counted(True, size)
+            return url
+        url = SimpleS3().store_in_s3(key, path, bucket=bucket, public=public)
+        if url:
+            manifest.counted(False, size)
+            try:
+                manifest.record(bucket, key, digest, size, public, url)
+            except (IOError, OSError), e:
+                print "[ERROR] Could not record %s in the manifest: %s" % (
+                        key, e)
+        return url
+
+    def url(self, bucket, key):
+        """The public URL of bucket/key, by the bucket's own host name."""
+        return self.pretty_url(SimpleS3().url(key, bucket), bucket)
+
+    def delete(self, bucket, key):
+        manifest.forget(bucket, key)
+        SimpleS3().delete_in_s3(bucket, key)
+        return ""
+
+    def presigned_url(self, key, bucket, seconds=604800):
+        return SimpleS3().get_presignedurl(key, bucket=bucket,
+                                           presigned_seconds=seconds)
+
+    def pretty_url(self, url, bucket):
+        return SimpleS3().build_pretty_url(url, bucket)
+
+
+class LocalStorage(object):
+    """Content-addressed buckets under a directory, one hard link per key."""
+
+    def __init__(self, root=None, base_url=None):
+        self.root = root or settings.CA_STORAGE_DIR
+        self.base_url = base_url or settings.CA_STORAGE_URL
+
+    def object_path(self, digest):
+        return os.path.join(self.root, "objects", digest[:2], digest)
+
+    def name_path(self, bucket, key, public=True):
+        """The path of bucket/key, or None if either would leave the tree."""
+        parts = [bucket] + key.split("/")
+        if [p for p in parts if p in ("", ".", "..") or os.sep in p]:
+            return None
+        return os.path.join(self.root, "public" if public else "private",
+                            *parts)
+
+    def find(self, bucket, key):
+        """The path of bucket/key, public or private, or None."""
+        for public in (True, False):
+            path = self.name_path(bucket, key, public)
+            if path and os.path.isfile(path):
+                return path
+        return None
+
+    def url(self, bucket, key):
+        return "%s/%s/%s" % (self.base_url.rstrip("/"), urlquote(bucket),
+                             urlquote(key))
+
+    def store(self, key, path, bucket, public=False):
+        """Store path as key. Returns its URL, or "" if it could not be."""
+        name = self.name_path(bucket, key, public)
+        if not name:
+            return ""
+        try:
+            digest = sha256_from_filepath(path)
+            # The same key may move between public and private.
+            other = self.name_path(bucket, key, not public)
+            for attempt in range(3):
+                obj = self.add_object(digest, path)
+                try:
+                    self.link(obj, name)
+                    break
+                except OSError, e:
+                    # Collected by a concurrent delete; add it again.
+                    if e.errno != errno.ENOENT or attempt == 2:
+                        raise
+            if os.path.exists(other):
+                self.unlink(other)
+        except (IOError, OSError), e:
+            print "[ERROR] Could not store %s in %s: %s" % (key, bucket, e)
+            return ""
+        return self.url(bucket, key)
+
+    def add_object(self, digest, path):
+        """The object for digest, copying path to it if it is new."""
+        obj = self.object_path(digest)
+        if not os.path.exists(obj):
+            makedirs(os.path.dirname(obj))
+            tmp = tmp_name(obj)
+            shutil.copyfile(path, tmp)
+            os.chmod(tmp, 0444)
+            try:
+                os.link(tmp, obj)
+            except OSError, e:
+                # Someone stored the same content first.
+                if e.errno != errno.EEXIST:
+                    raise
+            finally:
+                os.unlink(tmp)
+        return obj
+
+    def link(self, obj, name):
+        """Point name at obj, in one rename, and collect what it replaced."""
+        makedirs(os.path.dirname(name))
+        tmp = tmp_name(name)
+        os.link(obj, tmp)
+        replaced = self.object_of(name)
+        os.rename(tmp, name)
+        if replaced and replaced != obj:
+            self.collect(replaced)
+
+    def object_of(self, name):
+        """The object a name links to, found by its content, or None."""
+        try:
+            return self.object_path(sha256_from_filepath(name))
+        except IOError:
+            return None
+
+    def unlink(self, name):
+        obj = self.object_of(name)
+        try:
+            os.unlink(name)
+        except OSError:
+            return
+        if obj:
+            self.collect(obj)
+
+    def collect(self, obj):
+        """Remove obj once no key links to it."""
+        try:
+            if os.stat(obj).st_nlink <= 1:
+                os.unlink(obj)
+        except OSError:
+            pass
+
+    def delete(self, bucket, key):
+        for public in (True, False):
+            name = self.name_path(bucket, key, public)
+            if name:
+                self.unlink(name)
+        return ""
+
+    def signature(self, bucket, key, expires):
+        message = "%s\n%s/%s" % (expires, bucket, key)
+        return hmac.new(settings.SECRET_KEY, message,
+                        hashlib.sha256).hexdigest()
+
+    def presigned_url(self, key, bucket, seconds=604800):
+        expires = int(time.time()) + seconds
+        return "%s?Expires=%s&Signature=%s" % (self.url(bucket, key), expires,
+                                              self.signature(bucket, key,
+                                                             expires))
+
+    def signed(self, bucket, key, expires, signature, now=None):
+        """Whether a presigned URL's expiry and signature hold."""
+        try:
+            if int(expires) < (now or time.time()):
+                return False
+        except (TypeError, ValueError):
+            return False
+        return constant_time_compare(self.signature(bucket, key, expires),
+                                     signature or "")
+
+    def pretty_url(self, url, bucket):
+        return url
+
+
+def byte_range(header, size):
+    """
+    The (first, last) bytes a Range header asks of size bytes; None to send
+    them all (no header, one we do not follow, or several ranges), or False
+    when the range lies past the end.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, sep, last = header[6:].strip().partition("-")
+    try:
+        if not first:
+            first, last = max(size - int(last), 0), size - 1
+        else:
+            first = int(first)
+            last = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if first > last or first >= size:
+        return False
+    return first, last
+
+
+def read_range(path, first, length):
+    """Yield length bytes of path from first, a chunk at a time."""
+    with open(path, "rb") as f:
+        f.seek(first)
+        while length > 0:
+            chunk = f.read(min(CHUNK, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def tmp_name(path):
+    return "%s.%s.%s.tmp" % (path, os.getpid(), threading.current_thread().ident)
+
+
+def makedirs(directory):
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Another thread or process made it first.
+            if not os.path.isdir(directory):
+                raise
+
+
+def get_storage():
+    """The configured backend, or None when publishing is off."""
+    if settings.CA_STORAGE_BACKEND == "local":
+        return LocalStorage()
+    if settings.CA_STORAGE_BACKEND == "s3" and settings.USE_S3:
+        return S3Storage()
+    return None
+
+
+def storage_enabled():
+    return get_storage() is not None
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+Render the *-stub.cnf files in CA_CONF_DIR.
+
+Each stub is read and split on its |TOKEN| placeholders once per process.
+Rendering joins the pieces with the supplied values and writes the finished
+config in one write, instead of a copyfile followed by one `sed -i` per token.
+Tokens without a value are left in place, just as sed leaves them.
+"""
+
+from django.conf import settings
+import os, re, threading
+
+TOKEN_RE = re.compile(r"\|([A-Z_]+)\|")
+
+_stubs = {}
+_stubs_lock = threading.Lock()
+
+
+class StubTemplate(object):
+
+    def __init__(self, text):
+        # Even indexes are literal text, odd indexes are token names.
+        self.parts = TOKEN_RE.split(text)
+
+    def render(self, values):
+        out = list(self.parts)
+        for i in range(1, len(out), 2):
+            if out[i] in values:
+                out[i] = str(values[out[i]])
+            else:
+                out[i] = "|%s|" % (out[i])
+        return "".join(out)
+
+    def write(self, path, values):
+        text = self.render(values)
+        f = open(path, "w")
+        f.write(text)
+        f.close()
+        return text
+
+
+def get_stub(stub_name):
+    """Return the compiled StubTemplate for a file in CA_CONF_DIR."""
+    path = os.path.join(settings.CA_CONF_DIR, stub_name)
+    stub = _stubs.get(path)
+    if stub is None:
+        with _stubs_lock:
+            stub = _stubs.get(path)
+            if stub is None:
+                with open(path, "r") as f:
+                    stub = StubTemplate(f.read())
+                _stubs[path] = stub
+    return stub
+
+
+def render_stub(stub_name, path, **values):
+    """Write stub_name from CA_CONF_DIR to path with its tokens filled in."""
+    return get_stub(stub_name).write(path, values)
@@ -21,7 +21,20 @@ urlpatterns = patterns('',
     url(r'revoke-endpoint/(?P<serial_number>\S+)', revoke_domain_certificate,
                         name="revoke_domain_certificate"),    
     
+    url(r'issuance-status/(?P<kind>trust-anchor|endpoint)/(?P<id>\d+)', issuance_status,
+                        name="issuance_status"),
+    
     url(r'revoke-trust-anchor/(?P<serial_number>\S+)', revoke_trust_anchor_certificate,
                         name="revoke_trust_anchor_certificate"),    
     
+    url(r'ocsp/(?P<encoded>\S*)', ocsp_responder, name="ocsp"),
+    
+    url(r'ocsp-stats/', ocsp_cache_stats, name="ocsp_cache_stats"),
+    
+    url(r'^files/(?P<bucket>[^/]+)/(?P<key>.+)$', storage_file,
+                        name="storage_file"),
+    
+    url(r'status/(?P<identifier>\S*)', certificate_status,
+                        name="certificate_status"),
+    
     )
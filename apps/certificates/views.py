@@ -1,57 +1,77 @@
 from django.conf import settings
+import os, json, base64, urllib, hashlib, time, mimetypes
 from django.shortcuts import render_to_response, get_object_or_404
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import (HttpResponse, HttpResponseRedirect,
+                         StreamingHttpResponse, Http404)
+from django.utils.http import http_date
 from django.contrib import messages
 from django.core.urlresolvers import reverse
 from django.template import RequestContext
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
+from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth.models import User
 from ..accounts.models import UserProfile
 from django.utils.translation import ugettext_lazy as _
-from models import DomainBoundCertificate, TrustAnchorCertificate
+from models import (DomainBoundCertificate, TrustAnchorCertificate, IssuanceJob,
+                    refresh_presigned_zip_urls)
+from ocsp import responder
+from status import status_map, unknown
+from storage import LocalStorage, byte_range, read_range
 from forms import (TrustAnchorCertificateForm, DomainBoundCertificateForm,
             RevokeDomainBoundCertificateForm, RevokeTrustAnchorCertificateForm)
 
+# The columns home/index.html shows, and refresh_presigned_zip_urls() reads;
+# the dashboard leaves the rest of each certificate in the database.
+DASHBOARD_FIELDS = ('status', 'email', 'sha1_fingerprint', 'serial_number',
+                    'creation_date', 'expiration_date',
+                    'public_cert_status_url', 'public_cert_status_sha1_url',
+                    'public_cert_der_url', 'public_cert_pem_url',
+                    'public_cert_x5c_url', 'presigned_zip_url',
+                    'presigned_zip_s3')
+ACTIVE_STATUSES = ("good", "unverified")
+
 @login_required
 def certificate_dashboard(request):
     
-    #get all active trust anchors and associated domain-bound certs
+    #get all active and revoked trust anchors and the domain-bound certs
+    #under them, in one query each, whatever the number of anchors.
     
     active_cert_list  = []
-    
-    active_tas = TrustAnchorCertificate.objects.filter(owner=request.user,
-                                                       status="good") | \
-                 TrustAnchorCertificate.objects.filter(owner=request.user,
-                                                       status="unverified")
-    
-    for a in active_tas:
-        domain = { 'trust_anchor': a,
-                  'domain_bounds': None
-                  }
-        domain_bounds = DomainBoundCertificate.objects.filter(trust_anchor=a,
-                                                        status="good") | \
-                        DomainBoundCertificate.objects.filter(trust_anchor=a,
-                                                    status="unverified")
-        if domain_bounds:
-            domain['domain_bounds'] = domain_bounds
-        active_cert_list.append(domain)
-    
-
     revoked_cert_list  = []
+    by_anchor = {}
     
-    revoked_tas = TrustAnchorCertificate.objects.filter(owner=request.user,
-                                                        status = "revoked")    
-        
-    for r in revoked_tas:
-        revoked_cert_list.append(r)
-       
+    anchors = TrustAnchorCertificate.objects.filter(owner=request.user,
+                    status__in=ACTIVE_STATUSES + ("revoked",)).only(
+                                                            *DASHBOARD_FIELDS)
+    for a in anchors:
+        if a.status == "revoked":
+            revoked_cert_list.append(a)
+        else:
+            by_anchor[a.id] = { 'trust_anchor': a,
+                                'domain_bounds': []
+                              }
+            active_cert_list.append(by_anchor[a.id])
+    
+    revoked_domain_bounds = []
     domain_bounds = DomainBoundCertificate.objects.filter(
-                                        trust_anchor__owner=request.user,
-                                        status="revoked")
+                    trust_anchor__owner=request.user,
+                    status__in=ACTIVE_STATUSES + ("revoked",)).only(
+                                        'trust_anchor', *DASHBOARD_FIELDS)
     for d in domain_bounds:
-        revoked_cert_list.append(d)
+        if d.status == "revoked":
+            revoked_domain_bounds.append(d)
+        elif d.trust_anchor_id in by_anchor:
+            domain = by_anchor[d.trust_anchor_id]
+            # The anchor is already here; do not fetch it again per row.
+            d.trust_anchor = domain['trust_anchor']
+            domain['domain_bounds'].append(d)
+    revoked_cert_list.extend(revoked_domain_bounds)
+    
+    # Sign (or reuse) their private zips' URLs all at once.
+    refresh_presigned_zip_urls([d for domain in active_cert_list
+                                for d in domain['domain_bounds']])
 
-        
     context={ 'active_cert_list': active_cert_list,
               'revoked_cert_list': revoked_cert_list, 
              }
@@ -72,7 +92,9 @@ def create_domain_certificate(request, serial_number):
             c.domain = c.dns
             c.trust_anchor = ta
             c.save()
-            if c.status == "unverified":
+            if c.status == "incomplete":
+                messages.info(request, _("Your Direct certificate creation request has been queued. It will appear here once it has been issued."))
+            elif c.status == "unverified":
                 messages.success(request, _("Your Direct certificate creation request completed successfully."))
             elif c.status == "failed":
                 messages.error(request, _("Oops.  Something has gone wrong.  Your certifcate creation request failed."))
@@ -118,7 +140,9 @@ def create_trust_anchor_certificate(request):
             ta.domain = ta.dns
             ta.owner=request.user
             ta.save()
-            if ta.status == "unverified":
+            if ta.status == "incomplete":
+                messages.info(request, _("Your trust anchor creation request has been queued. It will appear here once it has been issued. A human must then verify this information before you can create endpoint certificates."))
+            elif ta.status == "unverified":
                 messages.success(request, _("Your trust anchor creation request completed successfully. A human must verify this information before you can create endpoint certificates. An email will be sent when this process is complete."))
             elif ta.status == "failed":
                 messages.error(request, _("Oops.  Something has gone wrong.  Your trust anchor certifcate creation request failed. Please contact customer support."))
@@ -224,22 +248,160 @@ def revoke_domain_certificate(request, serial_number):
                               RequestContext(request, context,))
 
 
-def rcp(request, serial_number):
-    
-    tu = None
-    c = None
+@login_required
+def issuance_status(request, kind, id):
+    """Poll the progress of a certificate created with CA_ASYNC_ISSUANCE."""
+    if kind == "trust-anchor":
+        c = get_object_or_404(TrustAnchorCertificate, id=id,
+                              owner = request.user)
+    else:
+        c = get_object_or_404(DomainBoundCertificate, id=id,
+                              trust_anchor__owner = request.user)
+    job = IssuanceJob.latest_for(c)
     
     jsonstr = {
-                "HashAlgorithm":    "sha1",
-                "SHA1Fingerprint":  c.sha1_fingerprint,
+                "id":               c.id,
+                "status":           c.status,
                 "SerialNumber":     c.serial_number,
-                "CertStatus":       certstatus,
-                "ThisUpdate":       tu,
+                "JobStatus":        job.status if job else None,
+                "Attempts":         job.attempts if job else 0,
             }
-
-    jsonstr=json.dumps(jsonstr, indent = 4,)
+    if c.status != "incomplete":
+        jsonstr["SHA1Fingerprint"] = c.sha1_fingerprint
     
+    jsonstr=json.dumps(jsonstr, indent = 4,)
     return HttpResponse(jsonstr, status=200, mimetype="application/json")
+
+
+@csrf_exempt
+def ocsp_responder(request, encoded=""):
+    """OCSP (RFC 6960): a DER request POSTed, or base64 in the URL by GET."""
+    if request.method == "POST":
+        der = request.body
+    else:
+        try:
+            der = base64.b64decode(urllib.unquote(encoded))
+        except TypeError:
+            der = ""
+    return HttpResponse(responder.respond(der), status=200,
+                        mimetype="application/ocsp-response")
+
+
+@staff_member_required
+def ocsp_cache_stats(request):
+    """This process's OCSP responder: hit rate and served response ages."""
+    jsonstr = json.dumps(responder.stats(), indent = 4,)
+    return HttpResponse(jsonstr, status=200, mimetype="application/json")
+
+
+def status_response(body, newest, request):
+    etag = '"%s"' % (hashlib.sha1(body).hexdigest())
+    if etag in request.META.get("HTTP_IF_NONE_MATCH", ""):
+        response = HttpResponse(status=304)
+    else:
+        response = HttpResponse(body, status=200, mimetype="application/json")
+    response["ETag"] = etag
+    response["Cache-Control"] = "public, max-age=%s" % (
+                                            status_map.max_age(newest))
+    if newest:
+        response["Last-Modified"] = http_date(time.mktime(newest.timetuple()))
+    return response
+
+
+@csrf_exempt
+def certificate_status(request, identifier=""):
+    """
+    The RCSP status of certificates, by serial number or SHA-1 fingerprint.
+    GET one (status/<serial or fingerprint>), or POST a batch of up to
+    CA_STATUS_BATCH_LIMIT as {"SerialNumbers": [...], "SHA1Fingerprints":
+    [...]}, answered in that order.
+    """
+    status_map.refresh()
+    if request.method != "POST":
+        entry = status_map.lookup(identifier)
+        if entry is None:
+            return HttpResponse(unknown(identifier), status=404,
+                                mimetype="application/json")
+        return status_response(entry.json, entry.this_update, request)
+
+    try:
+        query = json.loads(request.body)
+        identifiers = (list(query.get("SerialNumbers", [])) +
+                       list(query.get("SHA1Fingerprints", [])))
+        identifiers = [unicode(i) for i in identifiers]
+    except (ValueError, TypeError, AttributeError):
+        return HttpResponse(json.dumps({"Error": "Expected a JSON object "
+                            "of SerialNumbers and/or SHA1Fingerprints."}),
+                            status=400, mimetype="application/json")
+    if len(identifiers) > settings.CA_STATUS_BATCH_LIMIT:
+        return HttpResponse(json.dumps({"Error": "At most %s certificates "
+                            "per request." % (settings.CA_STATUS_BATCH_LIMIT)}),
+                            status=400, mimetype="application/json")
+    results, newest = [], None
+    for i in identifiers:
+        entry = status_map.lookup(i)
+        if entry is None:
+            results.append(unknown(i))
+        else:
+            results.append(entry.json)
+            if entry.this_update and (newest is None or
+                                      entry.this_update > newest):
+                newest = entry.this_update
+    return status_response('{"Certificates": [%s]}' % (", ".join(results)),
+                           newest, request)
+
+
+def storage_file(request, bucket, key):
+    """
+    A file of the local storage backend (storage.py). A private file needs
+    its presigned URL's Expires and Signature. Byte ranges are served, and
+    with CA_STORAGE_SENDFILE set the front-end web server sends the file.
+    """
+    s = LocalStorage()
+    public = True
+    path = s.name_path(bucket, key, public)
+    if not (path and os.path.isfile(path)):
+        public = False
+        path = s.name_path(bucket, key, public)
+        if not (path and os.path.isfile(path)) or not s.signed(bucket, key,
+                                            request.GET.get("Expires"),
+                                            request.GET.get("Signature")):
+            raise Http404
+    st = os.stat(path)
+    # Stored files are never changed in place, only replaced by a new link.
+    etag = '"%x-%x-%x"' % (st.st_ino, st.st_size, int(st.st_mtime))
+    mime = mimetypes.guess_type(key)[0] or "application/octet-stream"
     
-    
-    
\ No newline at end of file
+    if etag in request.META.get("HTTP_IF_NONE_MATCH", ""):
+        response = HttpResponse(status=304)
+    elif settings.CA_STORAGE_SENDFILE:
+        response = HttpResponse(mimetype=mime)
+        if settings.CA_STORAGE_SENDFILE == "X-Accel-Redirect":
+            response["X-Accel-Redirect"] = settings.CA_STORAGE_SENDFILE_PREFIX + \
+                                     os.path.relpath(path, s.root)
+        else:
+            response[settings.CA_STORAGE_SENDFILE] = path
+    else:
+        byte_span = None
+        if request.META.get("HTTP_IF_RANGE", etag) == etag:
+            byte_span = byte_range(request.META.get("HTTP_RANGE"), st.st_size)
+        if byte_span is False:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = "bytes */%s" % (st.st_size)
+            return response
+        first, last = byte_span or (0, st.st_size - 1)
+        response = StreamingHttpResponse(read_range(path, first,
+                                                    last - first + 1),
+                                         content_type=mime)
+        response["Content-Length"] = str(last - first + 1)
+        if byte_span:
+            response.status_code = 206
+            response["Content-Range"] = "bytes %s-%s/%s" % (first, last,
+                                                            st.st_size)
+    response["ETag"] = etag
+    response["Accept-Ranges"] = "bytes"
+    response["Last-Modified"] = http_date(st.st_mtime)
+    response["Cache-Control"] = "%s, max-age=%s" % (
+                    "public" if public else "private",
+                    settings.CA_STORAGE_MAX_AGE)
+    return response
@@ -0,0 +1,24 @@
+from django.contrib import admin
+from models import OutboundEmail, OutboundSMS
+
+
+class OutboundEmailAdmin(admin.ModelAdmin):
+    
+    list_display = ('subject', 'recipients', 'status', 'attempts',
+                    'creation_datetime', 'sent_datetime')
+    
+    list_filter = ('status',)
+    search_fields = ('subject', 'recipients')
+    
+admin.site.register(OutboundEmail, OutboundEmailAdmin)
+
+
+class OutboundSMSAdmin(admin.ModelAdmin):
+    
+    list_display = ('to', 'status', 'attempts', 'creation_datetime',
+                    'sent_datetime')
+    
+    list_filter = ('status',)
+    search_fields = ('to',)
+    
+admin.site.register(OutboundSMS, OutboundSMSAdmin)
@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+An email backend that queues messages in the outbox (models.py) for
+scripts/outbox_worker.py to send, instead of talking to a mail server.
+
+    EMAIL_BACKEND = 'apps.outbox.backends.OutboxBackend'
+"""
+
+from django.core.mail.backends.base import BaseEmailBackend
+from models import OutboundEmail
+
+
+class OutboxBackend(BaseEmailBackend):
+
+    def send_messages(self, email_messages):
+        """Queue email_messages; returns how many were queued."""
+        count = 0
+        for message in email_messages:
+            if message.recipients():
+                OutboundEmail.enqueue(message)
+                count += 1
+        return count
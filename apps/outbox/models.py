@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+Outgoing mail and text messages, queued in the database and sent by a
+worker, so a request that sends one does not wait on the mail server or
+on Twilio.
+
+With EMAIL_BACKEND set to 'apps.outbox.backends.OutboxBackend', every
+EmailMessage.send() queues an OutboundEmail. send_queued(), which
+scripts/outbox_worker.py calls, sends the queue OUTBOX_BATCH_SIZE messages
+at a time, each batch over one connection of OUTBOX_EMAIL_BACKEND.
+send_queued_sms() sends queued OutboundSMS through the transport and at
+the pace sms.py sets.
+
+    from models import OutboundEmail, OutboundSMS, send_queued, send_queued_sms
+    OutboundEmail.enqueue(EmailMessage(subject, body, from_email, [to]))
+    OutboundSMS.objects.create(to=to, from_number=from_number, body=body)
+    sent, retried, failed = send_queued()
+    sent, retried, failed = send_queued_sms()
+"""
+
+from django.conf import settings
+from django.db import models
+from django.core.mail import EmailMultiAlternatives, get_connection
+from email.utils import formatdate
+import datetime, time, json, base64, hashlib, smtplib, socket, traceback
+import uuid
+import sms
+
+MESSAGE_STATUS_CHOICES = (('queued', 'queued'),
+                        ('sending', 'sending'),
+                        ('sent', 'sent'),
+                        ('failed', 'failed'))
+
+# Errors after which the server is still talking to us; anything else may
+# have left the connection unusable.
+SESSION_ERRORS = (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused)
+
+
+def serialize(message):
+    """An EmailMessage as JSON, without the Date and Message-ID it gets when sent."""
+    fields = {"subject": message.subject, "body": message.body,
+              "from_email": message.from_email, "to": list(message.to),
+              "cc": list(message.cc), "bcc": list(message.bcc),
+              "headers": message.extra_headers,
+              "content_subtype": message.content_subtype,
+              "alternatives": getattr(message, "alternatives", []),
+              "attachments": []}
+    for attachment in message.attachments:
+        filename, content, mimetype = attachment
+        if isinstance(content, unicode):
+            content = content.encode("utf-8")
+        fields["attachments"].append([filename, base64.b64encode(content),
+                                      mimetype])
+    return json.dumps(fields, sort_keys=True)
+
+
+class QueuedMessage(models.Model):
+    """What the outbox keeps of any message: where it is in the queue."""
+    status              = models.CharField(max_length=10, default="queued",
+                                           choices=MESSAGE_STATUS_CHOICES,
+                                           db_index=True)
+    attempts            = models.IntegerField(default=0)
+    error               = models.TextField(blank=True, default="")
+    claim               = models.CharField(max_length=32, blank=True, default="",
+                                           db_index=True)
+    creation_datetime   = models.DateTimeField(auto_now_add=True)
+    next_attempt_datetime = models.DateTimeField(default=datetime.datetime.now,
+                                                 db_index=True)
+    started_datetime    = models.DateTimeField(null=True, blank=True)
+    sent_datetime       = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        abstract = True
+        ordering = ('id',)
+
+    @classmethod
+    def claim_batch(cls, limit, now=None):
+        """
+        Mark up to limit due messages sending and return them, oldest first.
+        The conditional update means two workers never claim the same one.
+        """
+        now = now or datetime.datetime.now()
+        ids = list(cls.objects.filter(status="queued",
+                                      next_attempt_datetime__lte=now).values_list(
+                                                            'id', flat=True)[:limit])
+        if not ids:
+            return []
+        token = uuid.uuid4().hex
+        cls.objects.filter(id__in=ids, status="queued").update(
+                                status="sending", claim=token,
+                                attempts=models.F('attempts') + 1,
+                                started_datetime=now)
+        return list(cls.objects.filter(claim=token))
+
+    @classmethod
+    def requeue_stale(cls, seconds):
+        """Put back messages left sending by a worker that died."""
+        cutoff = datetime.datetime.now() - datetime.timedelta(seconds=seconds)
+        return cls.objects.filter(status="sending",
+                                  started_datetime__lt=cutoff).update(
+                                                        status="queued", claim="")
+
+    def retry(self, error, now=None):
+        """
+        Queue the message again, OUTBOX_RETRY_SECONDS later after its first
+        attempt and twice as long after each one since, or give up on it
+        after OUTBOX_MAX_ATTEMPTS.
+        """
+        now = now or datetime.datetime.now()
+        self.error = error
+        self.claim = ""
+        if self.attempts < settings.OUTBOX_MAX_ATTEMPTS:
+            self.status = "queued"
+            self.next_attempt_datetime = now + datetime.timedelta(
+                seconds=settings.OUTBOX_RETRY_SECONDS * 2 ** (self.attempts - 1))
+        else:
+            self.status = "failed"
+        self.save()
+
+
+class OutboundEmail(QueuedMessage):
+    """One message waiting for, or given up on by, scripts/outbox_worker.py."""
+    subject             = models.CharField(max_length=255, blank=True, default="")
+    recipients          = models.TextField(blank=True, default="")
+    message             = models.TextField()
+    digest              = models.CharField(max_length=40, db_index=True)
+
+    def __unicode__(self):
+        return '%s to %s Status=%s, Attempts %s.' % (self.subject,
+                                                     self.recipients,
+                                                     self.status, self.attempts)
+
+    @classmethod
+    def enqueue(cls, message, now=None):
+        """
+        Queue message, unless the same message to the same people is already
+        waiting or was sent in the last OUTBOX_DEDUPE_SECONDS. Returns the
+        queued OutboundEmail, new or not.
+        """
+        now = now or datetime.datetime.now()
+        data = serialize(message)
+        digest = hashlib.sha1(data).hexdigest()
+        cutoff = now - datetime.timedelta(seconds=settings.OUTBOX_DEDUPE_SECONDS)
+        for email in cls.objects.filter(digest=digest).exclude(
+                                                status="failed").order_by('-id'):
+            if email.status != "sent" or email.sent_datetime >= cutoff:
+                return email
+        return cls.objects.create(subject=message.subject[:255],
+                                  recipients=", ".join(message.recipients()),
+                                  message=data, digest=digest,
+                                  next_attempt_datetime=now)
+
+    def email_message(self):
+        fields = json.loads(self.message)
+        headers = fields["headers"]
+        # Dated when it was queued, not when the worker got to it.
+        if "Date" not in headers:
+            headers["Date"] = formatdate(time.mktime(
+                                self.creation_datetime.timetuple()), localtime=True)
+        message = EmailMultiAlternatives(fields["subject"], fields["body"],
+                                         fields["from_email"], fields["to"],
+                                         fields["bcc"], headers=headers,
+                                         cc=fields["cc"],
+                                         alternatives=[tuple(a) for a in
+                                                       fields["alternatives"]])
+        message.content_subtype = fields["content_subtype"]
+        for filename, content, mimetype in fields["attachments"]:
+            message.attach(filename, base64.b64decode(content), mimetype)
+        return message
+
+
+class OutboundSMS(QueuedMessage):
+    """A text message waiting for, or given up on by, the outbox worker."""
+    to                  = models.CharField(max_length=32)
+    from_number         = models.CharField(max_length=32)
+    body                = models.TextField()
+    sid                 = models.CharField(max_length=64, blank=True, default="")
+
+    def __unicode__(self):
+        return 'SMS to %s Status=%s, Attempts %s.' % (self.to, self.status,
+                                                     self.attempts)
+
+    def postpone(self, seconds, now=None):
+        """Queue the message again for seconds later, without using up an attempt."""
+        now = now or datetime.datetime.now()
+        self.status = "queued"
+        self.claim = ""
+        self.attempts -= 1
+        self.next_attempt_datetime = now + datetime.timedelta(seconds=seconds)
+        self.save()
+
+
+def send_queued(limit=None, connection=None, now=None):
+    """
+    Send up to limit (OUTBOX_BATCH_SIZE) due messages over one connection.
+    A message the server refuses is retried later without dropping the
+    connection; any other error reconnects for the rest of the batch.
+    Returns the numbers sent, queued again and given up on.
+    """
+    now = now or datetime.datetime.now()
+    batch = OutboundEmail.claim_batch(limit or settings.OUTBOX_BATCH_SIZE, now)
+    if not batch:
+        return 0, 0, 0
+    connection = connection or get_connection(settings.OUTBOX_EMAIL_BACKEND)
+    sent, failed = [], []
+    try:
+        for email in batch:
+            try:
+                connection.open()
+                if connection.send_messages([email.email_message()]):
+                    sent.append(email.id)
+                else:
+                    email.retry("Not sent; no recipients?", now)
+            except Exception, e:
+                email.retry(traceback.format_exc(), now)
+                if not isinstance(e, SESSION_ERRORS):
+                    close(connection)
+            if email.status == "failed":
+                failed.append(email.id)
+    finally:
+        close(connection)
+    OutboundEmail.objects.filter(id__in=sent).update(status="sent", claim="",
+                                            error="",
+                                            sent_datetime=datetime.datetime.now())
+    return len(sent), len(batch) - len(sent) - len(failed), len(failed)
+
+
+def deliver(message):
+    """
+    Send one OutboundSMS in a pool thread, at the throttle's pace. Returns
+    the provider's id, or the exception it raised. Touches no database, so
+    the caller's thread records the outcome.
+    """
+    try:
+        sms.throttle.wait()
+        return sms.get_transport().send(message.to, message.from_number,
+                                        message.body)
+    except sms.RateLimited, e:
+        sms.throttle.pause(e.retry_after or sms.DEFAULT_PAUSE)
+        return e
+    except Exception, e:
+        e.traceback = traceback.format_exc()
+        return e
+
+
+def send_queued_sms(limit=None, now=None):
+    """
+    Send up to limit (OUTBOX_SMS_BATCH_SIZE) due text messages from the
+    sms pool. One turned away for rate limiting goes back in the queue for
+    the pause it was given; any other failure is retried with backoff.
+    Returns the numbers sent, queued again and given up on.
+    """
+    now = now or datetime.datetime.now()
+    batch = OutboundSMS.claim_batch(limit or settings.OUTBOX_SMS_BATCH_SIZE,
+                                    now)
+    sent = retried = failed = 0
+    for message, result in zip(batch, sms.pool().map(deliver, batch)):
+        if isinstance(result, sms.RateLimited):
+            message.postpone(result.retry_after or sms.DEFAULT_PAUSE, now)
+            retried += 1
+        elif isinstance(result, Exception):
+            message.retry(getattr(result, "traceback", str(result)), now)
+            if message.status == "failed":
+                failed += 1
+            else:
+                retried += 1
+        else:
+            OutboundSMS.objects.filter(id=message.id).update(status="sent",
+                                    claim="", error="", sid=result,
+                                    sent_datetime=datetime.datetime.now())
+            sent += 1
+    return sent, retried, failed
+
+
+def close(connection):
+    try:
+        connection.close()
+    except (smtplib.SMTPException, socket.error):
+        pass
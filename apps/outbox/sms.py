@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+Transports for text messages, and the pace the outbox sends them at.
+
+OUTBOX_SMS_TRANSPORT names the transport class: TwilioTransport, or
+FakeTransport to run without Twilio. Each process makes one transport, and
+so one client, and sends from a pool of OUTBOX_SMS_THREADS threads, no
+faster together than OUTBOX_SMS_RATE messages a second. A transport raises
+RateLimited when the provider turns a message away for going too fast;
+every thread then waits out the pause it asked for.
+
+    from sms import get_transport, throttle
+    throttle.wait()
+    sid = get_transport().send("+15555550100", settings.TWILIO_DEFAULT_FROM,
+                               "Your code is 1234")
+"""
+
+from django.conf import settings
+from django.utils.importlib import import_module
+from twilio import TwilioRestException
+from twilio.rest import TwilioRestClient
+import os, time, uuid, threading
+from multiprocessing.pool import ThreadPool
+
+# Seconds to hold back when rate limited without being told how long.
+DEFAULT_PAUSE = 1.0
+
+
+class RateLimited(Exception):
+    """The provider wants us to slow down, for retry_after seconds."""
+
+    def __init__(self, retry_after=None):
+        Exception.__init__(self, "Rate limited; retry after %s seconds." % (
+                                                                retry_after))
+        self.retry_after = retry_after
+
+
+class TwilioTransport(object):
+    """Twilio's REST API through one client."""
+
+    def __init__(self):
+        self.client = TwilioRestClient(settings.TWILIO_SID,
+                                       settings.TWILIO_AUTH_TOKEN)
+
+    def send(self, to, from_, body):
+        """Send body to to; returns the provider's id for the message."""
+        try:
+            message = self.client.sms.messages.create(to=to, from_=from_,
+                                                      body=body)
+        except TwilioRestException, e:
+            if e.status == 429:
+                raise RateLimited()
+            raise
+        return message.sid
+
+
+class FakeTransport(object):
+    """
+    Accepts messages, delay seconds each, and keeps them in sent. Answers
+    RateLimited to more than limit messages a second (None for no limit)
+    and raises for numbers in fail, to load-test the sender without Twilio.
+    """
+
+    instances = 0
+    sent = []
+    delay = 0
+    limit = None
+    fail = set()
+    lock = threading.Lock()
+
+    def __init__(self):
+        with self.lock:
+            FakeTransport.instances += 1
+        self.window = (0, 0)    # (second, messages accepted in it)
+
+    def send(self, to, from_, body):
+        time.sleep(self.delay)
+        if to in self.fail:
+            raise IOError("Cannot send to %s" % (to))
+        with self.lock:
+            second = int(time.time())
+            count = self.window[1] + 1 if self.window[0] == second else 1
+            if self.limit is not None and count > self.limit:
+                raise RateLimited(second + 1 - time.time())
+            self.window = (second, count)
+            sid = "SM%s" % (uuid.uuid4().hex)
+            self.sent.append((to, from_, body, sid))
+        return sid
+
+
+class Throttle(object):
+    """Spaces sends 1/OUTBOX_SMS_RATE seconds apart across threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.next_slot = 0
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + 1.0 / settings.OUTBOX_SMS_RATE
+        if slot > now:
+            time.sleep(slot - now)
+
+    def pause(self, seconds):
+        """Hold every send back for seconds from now."""
+        with self.lock:
+            self.next_slot = max(self.next_slot, time.time() + seconds)
+
+
+throttle = Throttle()
+
+_lock = threading.Lock()
+_transports = {}    # (pid, class path) -> transport
+_pool = {}          # pid -> ThreadPool
+
+
+def get_transport():
+    """This process's OUTBOX_SMS_TRANSPORT, made on first use."""
+    key = (os.getpid(), settings.OUTBOX_SMS_TRANSPORT)
+    with _lock:
+        if key not in _transports:
+            module, name = settings.OUTBOX_SMS_TRANSPORT.rsplit(".", 1)
+            _transports[key] = getattr(import_module(module), name)()
+        return _transports[key]
+
+
+def pool():
+    """This process's sending threads, made on first use."""
+    with _lock:
+        if os.getpid() not in _pool:
+            _pool.clear()
+            _pool[os.getpid()] = ThreadPool(settings.OUTBOX_SMS_THREADS)
+        return _pool[os.getpid()]
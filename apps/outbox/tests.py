@@ -0,0 +1,217 @@
+"""
+Tests of the outbox against a local SMTP stand-in (apps/testsupport/smtp.py)
+and the fake SMS transport.
+"""
+
+import time, datetime
+from django.core.mail import EmailMessage, EmailMultiAlternatives
+from django.test import TestCase
+from django.test.utils import override_settings
+from models import OutboundEmail, OutboundSMS, send_queued, send_queued_sms
+import sms
+from sms import FakeTransport, throttle
+from ..accounts.sms_utils import send_sms_twilio
+from ..testsupport.smtp import StandIn, serve, smtp_settings
+
+OUTBOX_BACKEND = "apps.outbox.backends.OutboxBackend"
+
+
+class OutboxTest(TestCase):
+
+    def setUp(self):
+        self.stand_in = StandIn
+        StandIn.connections = 0
+        StandIn.messages = []
+        StandIn.refuse = set()
+        self.server = serve()
+        self.settings = override_settings(EMAIL_BACKEND=OUTBOX_BACKEND,
+                                          OUTBOX_RETRY_SECONDS=60,
+                                          OUTBOX_MAX_ATTEMPTS=3,
+                                          OUTBOX_DEDUPE_SECONDS=600,
+                                          **smtp_settings(self.server))
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def notice(self, to="verifier@example.com", body="Anchor 1 awaits."):
+        return EmailMessage("[DirectCA]A new Trust Anchor certificate requires verification",
+                            body, "ca@example.com", [to])
+
+    def test_send_queues_without_connecting(self):
+        self.assertEqual(self.notice().send(), 1)
+        msg = EmailMultiAlternatives("Verify your email", "text",
+                                     "ca@example.com", ["alan@example.com"])
+        msg.attach_alternative("<p>html</p>", "text/html")
+        msg.send()
+        self.assertEqual(self.stand_in.connections, 0)
+        self.assertEqual(list(OutboundEmail.objects.values_list("status",
+                                                                flat=True)),
+                         ["queued", "queued"])
+
+        self.assertEqual(send_queued(), (2, 0, 0))
+        self.assertEqual(self.stand_in.connections, 1)
+        self.assertEqual(OutboundEmail.objects.filter(status="sent").count(), 2)
+        recipients, data = self.stand_in.messages[1]
+        self.assertEqual(recipients, ["alan@example.com"])
+        self.assertTrue("multipart/alternative" in data)
+        self.assertTrue("<p>html</p>" in data)
+        self.assertEqual(send_queued(), (0, 0, 0))
+
+    def test_batch_shares_one_connection(self):
+        for i in range(12):
+            self.notice("v%s@example.com" % (i)).send()
+        self.assertEqual(send_queued(limit=5), (5, 0, 0))
+        self.assertEqual(self.stand_in.connections, 1)
+        self.assertEqual(send_queued(limit=50), (7, 0, 0))
+        self.assertEqual(self.stand_in.connections, 2)
+        self.assertEqual([r for r, data in self.stand_in.messages],
+                         [["v%s@example.com" % (i)] for i in range(12)])
+
+    def test_duplicates_are_dropped(self):
+        now = datetime.datetime.now()
+        first = OutboundEmail.enqueue(self.notice(), now)
+        self.assertEqual(OutboundEmail.enqueue(self.notice(), now).id, first.id)
+        self.assertNotEqual(OutboundEmail.enqueue(self.notice(body="Other"),
+                                                  now).id, first.id)
+        self.assertEqual(send_queued(now=now), (2, 0, 0))
+
+        soon = datetime.datetime.now() + datetime.timedelta(seconds=60)
+        self.assertEqual(OutboundEmail.enqueue(self.notice(), soon).id, first.id)
+        later = soon + datetime.timedelta(seconds=600)
+        self.assertNotEqual(OutboundEmail.enqueue(self.notice(), later).id,
+                            first.id)
+
+    def test_refused_message_is_retried_with_backoff(self):
+        self.stand_in.refuse = set(["gone@example.com"])
+        self.notice("a@example.com").send()
+        self.notice("gone@example.com").send()
+        self.notice("b@example.com").send()
+        now = datetime.datetime.now()
+        self.assertEqual(send_queued(now=now), (2, 1, 0))
+        # The refusal did not cost the rest of the batch its connection.
+        self.assertEqual(self.stand_in.connections, 1)
+        email = OutboundEmail.objects.get(recipients="gone@example.com")
+        self.assertEqual((email.status, email.attempts), ("queued", 1))
+        self.assertTrue("No such user" in email.error)
+        self.assertEqual(email.next_attempt_datetime,
+                         now + datetime.timedelta(seconds=60))
+
+        self.assertEqual(send_queued(now=now + datetime.timedelta(seconds=59)),
+                         (0, 0, 0))
+        now += datetime.timedelta(seconds=60)
+        self.assertEqual(send_queued(now=now), (0, 1, 0))
+        email = OutboundEmail.objects.get(id=email.id)
+        self.assertEqual(email.next_attempt_datetime,
+                         now + datetime.timedelta(seconds=120))
+        now += datetime.timedelta(seconds=120)
+        self.assertEqual(send_queued(now=now), (0, 0, 1))
+        self.assertEqual(OutboundEmail.objects.get(id=email.id).status, "failed")
+
+    def test_unreachable_server(self):
+        self.notice().send()
+        with override_settings(EMAIL_PORT=1):
+            self.assertEqual(send_queued(), (0, 1, 0))
+        email = OutboundEmail.objects.get()
+        self.assertEqual((email.status, email.claim), ("queued", ""))
+        self.assertEqual(send_queued(now=email.next_attempt_datetime), (1, 0, 0))
+
+    def test_requeue_stale(self):
+        self.notice().send()
+        self.assertEqual(len(OutboundEmail.claim_batch(10)), 1)
+        self.assertEqual(OutboundEmail.claim_batch(10), [])
+        self.assertEqual(OutboundEmail.requeue_stale(60), 0)
+        OutboundEmail.objects.update(started_datetime=datetime.datetime.now() -
+                                     datetime.timedelta(seconds=61))
+        self.assertEqual(OutboundEmail.requeue_stale(60), 1)
+        self.assertEqual(send_queued(), (1, 0, 0))
+
+
+class SMSOutboxTest(TestCase):
+
+    def setUp(self):
+        FakeTransport.instances = 0
+        FakeTransport.sent = []
+        FakeTransport.delay = 0
+        FakeTransport.limit = None
+        FakeTransport.fail = set()
+        throttle.next_slot = 0
+        sms._transports.clear()
+        self.settings = override_settings(
+                            OUTBOX_SMS_TRANSPORT="apps.outbox.sms.FakeTransport",
+                            OUTBOX_QUEUE_SMS=True, OUTBOX_SMS_RATE=1000,
+                            OUTBOX_RETRY_SECONDS=60, OUTBOX_MAX_ATTEMPTS=2)
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+
+    def queue(self, count):
+        return [send_sms_twilio("Your code is %s" % (i), "+1555555%04d" % (i))
+                for i in range(count)]
+
+    def test_queued_then_sent_through_one_transport(self):
+        queued = self.queue(8)
+        self.assertEqual(FakeTransport.sent, [])
+        self.assertEqual(send_queued_sms(), (8, 0, 0))
+        self.assertEqual(sorted(m[0] for m in FakeTransport.sent),
+                         [m.to for m in queued])
+        for message in OutboundSMS.objects.all():
+            self.assertEqual(message.status, "sent")
+            self.assertTrue(message.sid.startswith("SM"))
+        self.assertEqual(send_queued_sms(), (0, 0, 0))
+        self.queue(2)
+        self.assertEqual(send_queued_sms(), (2, 0, 0))
+        self.assertEqual(FakeTransport.instances, 1)
+
+    def test_sent_at_once_without_the_outbox(self):
+        with override_settings(OUTBOX_QUEUE_SMS=False):
+            sid = send_sms_twilio("Your code is 1", "+15555550001")
+        self.assertEqual(FakeTransport.sent[0][3], sid)
+        self.assertFalse(OutboundSMS.objects.exists())
+
+    def test_sent_in_parallel(self):
+        FakeTransport.delay = 0.1
+        self.queue(8)
+        start = time.time()
+        self.assertEqual(send_queued_sms(), (8, 0, 0))
+        # OUTBOX_SMS_THREADS (4) at a time, not one after another.
+        self.assertTrue(time.time() - start < 0.6)
+
+    def test_rate(self):
+        self.queue(6)
+        with override_settings(OUTBOX_SMS_RATE=20):
+            start = time.time()
+            self.assertEqual(send_queued_sms(), (6, 0, 0))
+            self.assertTrue(time.time() - start >= 0.25)
+
+    def test_rate_limited_messages_wait_without_using_attempts(self):
+        FakeTransport.limit = 3
+        self.queue(5)
+        now = datetime.datetime.now()
+        sent, retried, failed = send_queued_sms(now=now)
+        self.assertEqual((sent + retried, failed), (5, 0))
+        self.assertTrue(sent >= 3)
+        for message in OutboundSMS.objects.filter(status="queued"):
+            self.assertEqual(message.attempts, 0)
+            self.assertTrue(now < message.next_attempt_datetime <=
+                            now + datetime.timedelta(seconds=1))
+        time.sleep(1)
+        self.assertEqual(send_queued_sms(now=now + datetime.timedelta(seconds=1)),
+                         (retried, 0, 0))
+        self.assertEqual(len(FakeTransport.sent), 5)
+
+    def test_failures_are_retried_then_given_up(self):
+        FakeTransport.fail = set(["+15555550001"])
+        self.queue(2)
+        now = datetime.datetime.now()
+        self.assertEqual(send_queued_sms(now=now), (1, 1, 0))
+        message = OutboundSMS.objects.get(to="+15555550001")
+        self.assertTrue("Cannot send" in message.error)
+        self.assertEqual(message.next_attempt_datetime,
+                         now + datetime.timedelta(seconds=60))
+        now += datetime.timedelta(seconds=60)
+        self.assertEqual(send_queued_sms(now=now), (0, 0, 1))
+        self.assertEqual(OutboundSMS.objects.get(id=message.id).status, "failed")
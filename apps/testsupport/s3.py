@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+A local stand-in for S3, in this process, for the tests and the
+benchmarks that upload through boto. Every object put is kept in
+StandIn.objects by its path, /<bucket>/<key>.
+
+    from apps.testsupport.s3 import StandIn, serve, connection_settings
+    server = serve()
+    with override_settings(AWS_S3_CONNECTION=connection_settings(server)):
+        ...
+    server.shutdown()
+"""
+
+import os, ssl, time, socket, hashlib, threading, subprocess
+import BaseHTTPServer, SocketServer
+
+TCP_QUICKACK = getattr(socket, "TCP_QUICKACK", 12)
+
+
+class StandIn(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Just enough of S3 for boto's uploads, keeping connections alive."""
+
+    protocol_version = "HTTP/1.1"
+    # Send each reply whole, with no Nagle delay, as S3 would.
+    disable_nagle_algorithm = True
+    wbufsize = -1
+    # boto never closes kept-alive connections; let them go when idle.
+    timeout = 1
+    objects = {}
+    delay = 0       # seconds each upload takes, for a distant S3
+
+    def handle_one_request(self):
+        # boto writes a request's headers and its body separately; ACK at
+        # once so the body is not held back for a delayed ACK (Linux).
+        try:
+            self.connection.setsockopt(socket.IPPROTO_TCP, TCP_QUICKACK, 1)
+        except socket.error:
+            pass
+        BaseHTTPServer.BaseHTTPRequestHandler.handle_one_request(self)
+
+    def reply(self, code, body="", headers=()):
+        self.send_response(code)
+        for header in headers:
+            self.send_header(*header)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.delay)
+        if "?" not in self.path and "/" in self.path.strip("/"):
+            self.objects[self.path] = body
+        self.reply(200, headers=[("ETag", '"%s"' % (hashlib.md5(body).hexdigest()))])
+
+    def do_HEAD(self):
+        self.reply(200)
+
+    def do_GET(self):
+        self.reply(200, self.objects.get(self.path, ""))
+
+    def do_DELETE(self):
+        self.objects.pop(self.path, None)
+        self.reply(204)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    def handle_error(self, request, client_address):
+        # boto drops connections without a TLS close_notify.
+        pass
+
+
+def serve(dirpath=None):
+    """
+    Start the stand-in: over HTTPS with a throw-away certificate in
+    dirpath, or plain HTTP without one.
+    """
+    server = Server(("127.0.0.1", 0), StandIn)
+    if dirpath:
+        server.socket = ssl.wrap_socket(server.socket,
+                                        certfile=self_signed(dirpath),
+                                        server_side=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def connection_settings(server):
+    """AWS_S3_CONNECTION for the stand-in."""
+    return {"host": "127.0.0.1", "port": server.server_address[1],
+            "is_secure": isinstance(server.socket, ssl.SSLSocket),
+            "validate_certs": False,
+            "calling_format": "boto.s3.connection.OrdinaryCallingFormat"}
+
+
+def self_signed(dirpath):
+    cert = os.path.join(dirpath, "stand-in.pem")
+    subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048",
+                           "-nodes", "-subj", "/CN=127.0.0.1", "-days", "1",
+                           "-keyout", cert, "-out", cert],
+                          stderr=open(os.devnull, "w"))
+    return cert
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+A local SMTP stand-in, in this process, for the tests and the benchmarks
+that send mail. It counts connections in StandIn.connections and keeps
+each message as (recipients, data) in StandIn.messages.
+
+    from apps.testsupport.smtp import StandIn, serve, smtp_settings
+    server = serve()
+    with override_settings(**smtp_settings(server)):
+        ...
+    server.shutdown()
+"""
+
+import time, threading, SocketServer
+
+SMTP_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
+
+
+class StandIn(SocketServer.StreamRequestHandler):
+    """Just enough SMTP for smtplib, counting connections and messages."""
+
+    connections = 0
+    messages = []
+    refuse = set()  # recipients to answer 550
+    delay = 0       # seconds each message takes, for a distant server
+    lock = threading.Lock()
+
+    def reply(self, line):
+        self.wfile.write(line + "\r\n")
+        self.wfile.flush()
+
+    def handle(self):
+        with self.lock:
+            StandIn.connections += 1
+        self.reply("220 stand-in ESMTP")
+        recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.strip().split(" ", 1)[0].upper()
+            if command in ("EHLO", "HELO"):
+                self.reply("250 stand-in")
+            elif command == "MAIL":
+                recipients = []
+                self.reply("250 OK")
+            elif command == "RCPT":
+                address = line.split(":", 1)[1].strip().strip("<>")
+                if address in self.refuse:
+                    self.reply("550 No such user")
+                else:
+                    recipients.append(address)
+                    self.reply("250 OK")
+            elif command == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = []
+                for line in iter(self.rfile.readline, ""):
+                    if line.rstrip("\r\n") == ".":
+                        break
+                    data.append(line)
+                time.sleep(self.delay)
+                with self.lock:
+                    self.messages.append((recipients, "".join(data)))
+                self.reply("250 OK queued")
+            elif command in ("RSET", "NOOP"):
+                recipients = []
+                self.reply("250 OK")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Not implemented")
+
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve():
+    server = Server(("127.0.0.1", 0), StandIn)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def smtp_settings(server):
+    """Settings sending mail to the stand-in."""
+    return {"EMAIL_HOST": "127.0.0.1", "EMAIL_PORT": server.server_address[1],
+            "EMAIL_HOST_USER": "", "EMAIL_HOST_PASSWORD": "",
+            "EMAIL_USE_TLS": False, "OUTBOX_EMAIL_BACKEND": SMTP_BACKEND}
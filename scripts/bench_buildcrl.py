@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+Time trust anchor CRL generation one at a time and through the process and
+thread pools buildcrl uses, over a set of synthetic anchors.
+
+    python manage.py runscript bench_buildcrl --script-args 1000 8
+
+Arguments are the number of anchors (default 1000) and the number of
+signing processes for the parallel run (default CA_CRL_WORKERS, or one per
+CPU). Each anchor gets its own directory, CRL config and index with a few
+revoked entries, all in a temporary directory. S3 is left off, so this
+measures signing only; no database rows are written.
+"""
+
+import os, time, tempfile
+from shutil import rmtree
+from django.conf import settings
+from django.test.utils import override_settings
+from OpenSSL import crypto
+from apps.certificates.models import TrustAnchorCertificate
+from apps.certificates.cautils import create_crl_conf
+from apps.certificates.serials import format_serial
+from scripts.buildcrl import build_anchor_crls
+
+REVOKED_PER_ANCHOR = 10
+
+
+def make_key(dirpath):
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+    cert = crypto.X509()
+    cert.set_version(2)
+    cert.get_subject().CN = "bench.example.org"
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(24 * 60 * 60)
+    cert.sign(key, "sha256")
+    private_key_path = os.path.join(dirpath, "bench.key")
+    public_key_path = os.path.join(dirpath, "bench.pem")
+    with open(private_key_path, "w") as f:
+        f.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+    with open(public_key_path, "w") as f:
+        f.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+    return private_key_path, public_key_path
+
+
+def make_anchors(dirpath, count):
+    private_key_path, public_key_path = make_key(dirpath)
+    anchors = []
+    for i in range(count):
+        dns = "anchor%s.bench.example.org" % (i)
+        d = os.path.join(dirpath, dns)
+        os.mkdir(d)
+        create_crl_conf(dns=dns, anchor_dns=dns, completed_anchor_dir=d,
+                        private_key_path=private_key_path,
+                        public_key_path=public_key_path)
+        f = open(os.path.join(d, "index"), "w")
+        for serial in range(2, REVOKED_PER_ANCHOR + 2):
+            f.write("R\t301231235959Z\t150101000000Z\t%s\tunknown\t/CN=host%s.%s\n" % (
+                    format_serial(serial), serial, dns))
+        f.close()
+        anchors.append(TrustAnchorCertificate(id=i + 1, dns=dns,
+                                              completed_dir_path=d))
+    return anchors
+
+
+def timed(anchors, processes, threads):
+    start = time.time()
+    results, timings = build_anchor_crls([(t, None) for t in anchors],
+                                         processes, threads)
+    failed = len([r for r in results if r[3]])
+    return time.time() - start, failed
+
+
+def run(*args):
+    count = int(args[0]) if args else 1000
+    processes = int(args[1]) if len(args) > 1 else None
+    dirpath = tempfile.mkdtemp(prefix="bench-buildcrl-")
+    try:
+        with override_settings(USE_S3=False):
+            anchors = make_anchors(dirpath, count)
+            serial, failed = timed(anchors, 1, 1)
+            print "%s anchors, %-20s %8.1fs (%s failed)" % (
+                    count, "one at a time:", serial, failed)
+            parallel, failed = timed(anchors, processes, None)
+            print "%s anchors, %-20s %8.1fs (%s failed)" % (
+                    count, "%s processes:" % (processes or
+                        settings.CA_CRL_WORKERS or "cpu_count"),
+                    parallel, failed)
+    finally:
+        rmtree(dirpath)
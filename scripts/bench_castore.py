@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+Compare revoke and CRL generation through openssl ca and its flat index
+file with the CA state store, at growing index sizes.
+
+    python manage.py runscript bench_castore --script-args 100000 1000000
+
+Arguments are index sizes (default 100000 and 1000000). One in a hundred
+synthetic entries is revoked. Everything lives in a temporary directory and
+under a throw-away issuer name in the store, which is removed afterwards,
+but the store rows are written to the configured database.
+"""
+
+import os, time, tempfile, datetime, subprocess
+from shutil import rmtree
+from OpenSSL import crypto
+from apps.certificates import castore
+from apps.certificates.engine import parse_conf
+from apps.certificates.serials import format_serial
+
+CONF = """
+[ ca ]
+default_ca              = CA_default
+
+[ CA_default ]
+database                = %(dir)s/index
+certificate             = %(dir)s/ca.pem
+private_key             = %(dir)s/ca.key
+serial                  = %(dir)s/serial
+default_crl_days        = 30
+default_md              = sha256
+"""
+
+
+def make_ca(dirpath):
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+    cert = crypto.X509()
+    cert.set_version(2)
+    cert.get_subject().CN = "bench.example.org"
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(24 * 60 * 60)
+    cert.sign(key, "sha256")
+    with open(os.path.join(dirpath, "ca.key"), "w") as f:
+        f.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+    with open(os.path.join(dirpath, "ca.pem"), "w") as f:
+        f.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+    conf_path = os.path.join(dirpath, "ca.cnf")
+    with open(conf_path, "w") as f:
+        f.write(CONF % {"dir": dirpath})
+    return key, cert, conf_path
+
+
+def make_leaf(dirpath, key, issuer, serial):
+    """A real certificate for the last serial, for openssl ca -revoke."""
+    cert = crypto.X509()
+    cert.set_version(2)
+    cert.get_subject().CN = "leaf.bench.example.org"
+    cert.set_issuer(issuer.get_subject())
+    cert.set_pubkey(key)
+    cert.set_serial_number(serial)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(24 * 60 * 60)
+    cert.sign(key, "sha256")
+    path = os.path.join(dirpath, "leaf.pem")
+    with open(path, "w") as f:
+        f.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+    return path
+
+
+def write_index(path, size):
+    f = open(path, "w")
+    for i in range(2, size + 2):
+        if i % 100:
+            f.write("V\t301231235959Z\t\t%s\tunknown\t/CN=host%s.bench.example.org\n" % (
+                    format_serial(i), i))
+        else:
+            f.write("R\t301231235959Z\t150101000000Z\t%s\tunknown\t/CN=host%s.bench.example.org\n" % (
+                    format_serial(i), i))
+    # The one we revoke.
+    f.write("V\t301231235959Z\t\t%s\tunknown\t/CN=leaf.bench.example.org\n" % (
+            format_serial(size + 2)))
+    f.close()
+
+
+def timed(function, *args):
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+
+def openssl(*args):
+    subprocess.check_call(["openssl", "ca"] + list(args),
+                          stdout=open(os.devnull, "w"),
+                          stderr=open(os.devnull, "w"))
+
+
+def bench(size):
+    dirpath = tempfile.mkdtemp(prefix="bench-castore-")
+    issuer = os.path.join(dirpath, "index")
+    try:
+        key, cert, conf_path = make_ca(dirpath)
+        conf = parse_conf(open(conf_path).read())
+        issuer = castore.conf_database(conf)
+        index = os.path.join(dirpath, "index")
+        write_index(index, size)
+        leaf = make_leaf(dirpath, key, cert, size + 2)
+        crl = os.path.join(dirpath, "crl.pem")
+
+        times = {}
+        times["import"] = timed(castore.import_index, index)
+        times["openssl revoke"] = timed(openssl, "-config", conf_path,
+                                        "-revoke", leaf)
+        times["openssl gencrl"] = timed(openssl, "-config", conf_path,
+                                        "-gencrl", "-out", crl)
+        times["store revoke"] = timed(castore.revoke, issuer,
+                                      format_serial(size + 2),
+                                      "/CN=leaf.bench.example.org",
+                                      datetime.datetime(2030, 12, 31))
+        times["store gencrl"] = timed(castore.write_crl, conf, crl)
+
+        revoked = len(crypto.load_crl(crypto.FILETYPE_PEM,
+                                      open(crl).read()).get_revoked())
+        print
+        print "index entries=%s, revoked on CRL=%s" % (size + 1, revoked)
+        print "  import into store     %8.3fs (once)" % (times["import"])
+        print "  revoke   openssl %8.3fs   store %8.3fs" % (
+                times["openssl revoke"], times["store revoke"])
+        print "  gencrl   openssl %8.3fs   store %8.3fs" % (
+                times["openssl gencrl"], times["store gencrl"])
+    finally:
+        castore.IssuedCertificate.objects.filter(issuer=issuer).delete()
+        rmtree(dirpath)
+
+
+def run(*args):
+    sizes = [int(a) for a in args] or [100000, 1000000]
+    for size in sizes:
+        bench(size)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+Time building the x5c list and -chain.pem of endpoint certificates the old
+way (concatenate the CA, anchor and endpoint files, read the chain back and
+scan it) against chain_cache, where each file is read once and a chain
+file is only rewritten when it changes.
+
+    python manage.py runscript bench_chain --script-args 2000 50
+
+Arguments are the number of verifications (default 2000) and of distinct
+endpoints they are spread over (default 50), as when the same
+certificates are verified again.
+"""
+
+import os, re, time, tempfile
+from shutil import rmtree
+from OpenSSL import crypto
+from apps.certificates.chaincache import ChainCache
+
+
+def old_chain_keys_in_list(outpath, filenames):
+    """chain_keys_in_list as it was."""
+    with open(outpath, 'w') as outfile:
+        for fname in filenames:
+            with open(fname) as infile:
+                outfile.write(infile.read())
+    f = open(outpath, 'r')
+    certslist_str = f.read()
+    f.close()
+    list_of_certs = re.findall('-----BEGIN CERTIFICATE-----$\n(.*?)\n^-----END CERTIFICATE-----',
+               certslist_str, re.DOTALL|re.MULTILINE)
+    return [c.replace('\n','') for c in list_of_certs]
+
+
+def certificate(path, name):
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+    cert = crypto.X509()
+    cert.get_subject().CN = name
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.gmtime_adj_notAfter(24 * 60 * 60)
+    cert.sign(key, "sha256")
+    with open(path, "w") as f:
+        f.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+    return path
+
+
+def run(*args):
+    count = int(args[0]) if args else 2000
+    endpoints = int(args[1]) if len(args) > 1 else 50
+    dirpath = tempfile.mkdtemp(prefix="bench-chain-")
+    try:
+        ca = certificate(os.path.join(dirpath, "ca.pem"), "ca")
+        anchor = certificate(os.path.join(dirpath, "anchor.pem"), "anchor")
+        leaves = [certificate(os.path.join(dirpath, "%s.pem" % (i)), str(i))
+                  for i in range(endpoints)]
+        jobs = [(os.path.join(dirpath, "%s-chain.pem" % (i % endpoints)),
+                 [ca, anchor, leaves[i % endpoints]]) for i in range(count)]
+        cache = ChainCache()
+        for label, build in (("old", old_chain_keys_in_list),
+                             ("chain_cache", cache.write_chain)):
+            start = time.time()
+            for outpath, files in jobs:
+                build(outpath, files)
+            seconds = time.time() - start
+            print "  %-12s %6.3fs  %8.0f chains/s" % (label, seconds,
+                                                     count / seconds)
+        print "  chain_cache read %s files and wrote %s chains for %s builds" % (
+                cache.loads, cache.writes, count)
+    finally:
+        rmtree(dirpath)
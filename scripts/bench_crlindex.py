@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+Compare revoked serial lookups against a large CRL: the old
+get_revoked_serials (pyOpenSSL load_crl and a list) and crlindex.
+
+    python manage.py runscript bench_crlindex --script-args 1000000 10000
+
+Arguments are the number of CRL entries (default 1000000) and of serials
+to look up, half of them revoked (default 10000). The CRL is signed by
+openssl ca -gencrl over a synthetic index in a temporary directory.
+"""
+
+import os, time, random, tempfile, subprocess
+from shutil import rmtree
+from OpenSSL import crypto
+from apps.certificates import crlindex
+from apps.certificates.serials import format_serial
+from scripts.bench_castore import make_ca
+
+
+def write_index(path, size):
+    f = open(path, "w")
+    for i in xrange(2, size + 2):
+        f.write("R\t301231235959Z\t150101000000Z\t%s\tunknown\t/CN=host%s.bench.example.org\n" % (
+                format_serial(i), i))
+    f.close()
+
+
+def timed(function, *args):
+    start = time.time()
+    result = function(*args)
+    return result, time.time() - start
+
+
+def pyopenssl_serials(path):
+    """What get_revoked_serials used to do."""
+    with open(path, 'r') as _crl_file:
+        crl = "".join(_crl_file.readlines())
+    return [r.get_serial() for r in
+            crypto.load_crl(crypto.FILETYPE_PEM, crl).get_revoked()]
+
+
+def run(*args):
+    size = int(args[0]) if args else 1000000
+    lookups = int(args[1]) if len(args) > 1 else 10000
+    dirpath = tempfile.mkdtemp(prefix="bench-crlindex-")
+    try:
+        key, cert, conf_path = make_ca(dirpath)
+        write_index(os.path.join(dirpath, "index"), size)
+        crl = os.path.join(dirpath, "crl.pem")
+        start = time.time()
+        subprocess.check_call(["openssl", "ca", "-config", conf_path,
+                               "-gencrl", "-out", crl],
+                              stderr=open(os.devnull, "w"))
+        print "%s entry CRL, %s bytes, signed in %.1fs" % (size,
+                os.path.getsize(crl), time.time() - start)
+
+        serials = [format_serial(random.randint(2, size * 2))
+                   for i in xrange(lookups)]
+
+        revoked, load = timed(pyopenssl_serials, crl)
+        found, check = timed(lambda: len([s for s in serials[:100] if s in revoked]))
+        print "  pyOpenSSL list   load %7.2fs   %s lookups %9.4fs (%.1fms each)" % (
+                load, 100, check, check * 10)
+
+        path, build = timed(crlindex.build_index, crl)
+        index, opened = timed(crlindex.CRLIndex, crl)
+        found, check = timed(lambda: len([s for s in serials if index.is_revoked(s)]))
+        print "  crlindex         build %6.2fs   open %.4fs   %s lookups %7.4fs (%.1fus each)" % (
+                build, opened, lookups, check, check * 1e6 / lookups)
+        print "  index file %s bytes, %s of %s serials revoked" % (
+                os.path.getsize(path), found, lookups)
+        index.close()
+    finally:
+        rmtree(dirpath)
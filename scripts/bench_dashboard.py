@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+Time the certificate dashboard, and count its queries, for one user with
+many trust anchors and endpoints, against the dashboard as it was: two
+queries for the anchors, two more per anchor for its endpoints and one
+per endpoint shown for its anchor's serial number.
+
+    python manage.py runscript bench_dashboard --script-args 500 10000 3
+
+Arguments are the number of anchors (default 500), of endpoints spread
+over them (default 10000), and of timed views of each (default 3). One in
+ten anchors and endpoints is revoked. The rows are removed afterwards.
+"""
+
+import time, datetime
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.shortcuts import render_to_response
+from django.template import RequestContext
+from django.test.client import RequestFactory
+from apps.certificates.models import (TrustAnchorCertificate,
+                                      DomainBoundCertificate,
+                                      refresh_presigned_zip_urls)
+from apps.certificates.views import certificate_dashboard
+
+USERNAME = "bench-dashboard"
+
+
+def old_dashboard(request):
+    """certificate_dashboard before it fetched everything at once."""
+    active_cert_list  = []
+    active_tas = TrustAnchorCertificate.objects.filter(owner=request.user,
+                                                       status="good") | \
+                 TrustAnchorCertificate.objects.filter(owner=request.user,
+                                                       status="unverified")
+    for a in active_tas:
+        domain = { 'trust_anchor': a,
+                  'domain_bounds': None
+                  }
+        domain_bounds = DomainBoundCertificate.objects.filter(trust_anchor=a,
+                                                        status="good") | \
+                        DomainBoundCertificate.objects.filter(trust_anchor=a,
+                                                    status="unverified")
+        if domain_bounds:
+            domain['domain_bounds'] = list(domain_bounds)
+        active_cert_list.append(domain)
+    refresh_presigned_zip_urls([d for domain in active_cert_list
+                                for d in domain['domain_bounds'] or ()])
+    revoked_cert_list  = list(TrustAnchorCertificate.objects.filter(
+                                        owner=request.user, status="revoked"))
+    revoked_cert_list.extend(DomainBoundCertificate.objects.filter(
+                                        trust_anchor__owner=request.user,
+                                        status="revoked"))
+    context={ 'active_cert_list': active_cert_list,
+              'revoked_cert_list': revoked_cert_list,
+             }
+    return render_to_response('home/index.html',
+                              RequestContext(request, context,))
+
+
+def populate(user, anchors, endpoints):
+    today = datetime.date.today()
+    common = dict(verified=True, verified_message_sent=True,
+                  expiration_date=today, sha256_digest="x" * 64,
+                  sha1_fingerprint="AB:" * 19 + "AB",
+                  public_cert_status_url="https://rcsp.example.com/x.json",
+                  public_cert_der_url="https://pubcerts.example.com/x.der",
+                  public_cert_pem_url="https://pubcerts.example.com/x.pem",
+                  public_cert_x5c_url="https://pubcerts.example.com/x.json")
+    with transaction.commit_on_success():
+        TrustAnchorCertificate.objects.bulk_create([
+            TrustAnchorCertificate(owner=user,
+                                   status="revoked" if i % 10 == 9 else "good",
+                                   serial_number="A%05X" % (i),
+                                   email="anchor%s.bench.example.org" % (i),
+                                   **common)
+            for i in range(anchors)])
+        ids = list(TrustAnchorCertificate.objects.filter(owner=user).values_list(
+                                                                'id', flat=True))
+        DomainBoundCertificate.objects.bulk_create([
+            DomainBoundCertificate(trust_anchor_id=ids[i % len(ids)],
+                                   status="revoked" if i % 10 == 9 else "good",
+                                   serial_number="E%05X" % (i),
+                                   email="host%s.bench.example.org" % (i),
+                                   **common)
+            for i in range(endpoints)])
+
+
+def timed(view, request, count):
+    connection.use_debug_cursor = True
+    times, queries = [], 0
+    for i in range(count):
+        del connection.queries[:]
+        start = time.time()
+        response = view(request)
+        times.append(time.time() - start)
+        queries = len(connection.queries)
+    connection.use_debug_cursor = None
+    return min(times), queries, len(response.content)
+
+
+def run(*args):
+    anchors = int(args[0]) if args else 500
+    endpoints = int(args[1]) if len(args) > 1 else 10000
+    count = int(args[2]) if len(args) > 2 else 3
+    User.objects.filter(username=USERNAME).delete()
+    user = User.objects.create_user(USERNAME, "bench@example.com", "bench")
+    try:
+        populate(user, anchors, endpoints)
+        request = RequestFactory().get("/")
+        request.user = user
+        print "%s anchors, %s endpoints" % (anchors, endpoints)
+        for label, view in (("before", old_dashboard),
+                            ("now", certificate_dashboard)):
+            seconds, queries, size = timed(view, request, count)
+            print "  %-8s %7.3fs %6s queries (%s bytes)" % (label, seconds,
+                                                           queries, size)
+    finally:
+        with transaction.commit_on_success():
+            DomainBoundCertificate.objects.filter(
+                                    trust_anchor__owner=user).delete()
+            TrustAnchorCertificate.objects.filter(owner=user).delete()
+            user.delete()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+Compare per-certificate wall time of the openssl subprocess chain and the
+in-process engine for endpoint issuance.
+
+    python manage.py runscript bench_issuance --script-args 20 2048
+
+Arguments are the number of certificates per engine (default 10) and the RSA
+key size (default 2048). Certificates are issued under a throw-away trust
+anchor in a temporary directory, but serials and signed-keys copies come from
+the configured CA, so run this against a scratch CA.
+"""
+
+import os, time, tempfile
+from shutil import rmtree
+from django.conf import settings
+from OpenSSL import crypto
+from apps.certificates.cautils import create_endpoint_certificate
+
+
+def make_anchor(dirpath, keysize):
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, keysize)
+    cert = crypto.X509()
+    cert.set_version(2)
+    subj = cert.get_subject()
+    subj.C = "US"
+    subj.ST = "MD"
+    subj.L = "Gaithersburg"
+    subj.O = "NIST"
+    subj.CN = "bench.example.org"
+    subj.emailAddress = "bench.example.org"
+    cert.set_issuer(subj)
+    cert.set_pubkey(key)
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(24 * 60 * 60)
+    cert.add_extensions([crypto.X509Extension("basicConstraints", True,
+                                              "CA:true"),
+                         crypto.X509Extension("subjectKeyIdentifier", False,
+                                              "hash", subject=cert)])
+    cert.sign(key, "sha256")
+
+    private_key_path = os.path.join(dirpath, "bench.example.orgKey.key")
+    public_key_path = os.path.join(dirpath, "bench.example.org.pem")
+    with open(private_key_path, "w") as f:
+        f.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+    with open(public_key_path, "w") as f:
+        f.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+    open(os.path.join(dirpath, "index"), "w").close()
+    return private_key_path, public_key_path
+
+
+def bench(engine, count, keysize, anchor_dir, private_key_path,
+          public_key_path):
+    settings.CA_ISSUANCE_ENGINE = engine
+    timings = []
+    for i in range(count):
+        dns = "%s-%s.bench.example.org" % (engine, i)
+        start = time.time()
+        result = create_endpoint_certificate(common_name = dns,
+                                             email = dns,
+                                             dns = dns,
+                                             anchor_dns = "bench.example.org",
+                                             rsakey = keysize,
+                                             user = "bench",
+                                             private_key_path = private_key_path,
+                                             public_key_path = public_key_path,
+                                             completed_anchor_dir = anchor_dir)
+        timings.append(time.time() - start)
+        if result["status"] != "unverified":
+            print "%s: certificate %s failed: %s" % (engine, i, result["notes"])
+    return timings
+
+
+def report(engine, timings):
+    timings = sorted(timings)
+    print "%-10s n=%-4s mean=%.3fs median=%.3fs min=%.3fs max=%.3fs" % (
+            engine, len(timings), sum(timings) / len(timings),
+            timings[len(timings) / 2], timings[0], timings[-1])
+
+
+def run(*args):
+    count = int(args[0]) if len(args) > 0 else 10
+    keysize = int(args[1]) if len(args) > 1 else 2048
+    original_engine = getattr(settings, "CA_ISSUANCE_ENGINE", "openssl")
+    anchor_dir = tempfile.mkdtemp(prefix="bench-anchor-")
+    try:
+        private_key_path, public_key_path = make_anchor(anchor_dir, 2048)
+        results = {}
+        for engine in ("openssl", "inprocess"):
+            results[engine] = bench(engine, count, keysize, anchor_dir,
+                                    private_key_path, public_key_path)
+        print
+        print "Endpoint issuance, %s certificates, rsa:%s" % (count, keysize)
+        for engine in ("openssl", "inprocess"):
+            report(engine, results[engine])
+        print "speedup (mean) = %.1fx" % (
+                sum(results["openssl"]) / sum(results["inprocess"]))
+    finally:
+        settings.CA_ISSUANCE_ENGINE = original_engine
+        rmtree(anchor_dir)
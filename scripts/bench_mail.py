@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+Compare sending notification mail the old way, a new SMTP connection for
+every message inside the request, with queueing it in the outbox and
+sending the queue in batches over one connection, against the local SMTP
+stand-in (apps/testsupport/smtp.py) taking a fixed time per message.
+
+    python manage.py runscript bench_mail --script-args 200 0.01
+
+Arguments are the number of messages (default 200) and the seconds the
+stand-in takes to accept each (default 0.01).
+"""
+
+import time
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.test.utils import override_settings
+from apps.outbox.models import OutboundEmail, send_queued
+from apps.testsupport.smtp import StandIn, serve, smtp_settings, SMTP_BACKEND
+
+
+def notice(i):
+    return EmailMessage("[DirectCA]A new Domain-Bound Certificate requires verification",
+                        "Certificate %s awaits verification." % (i),
+                        settings.EMAIL_HOST_USER, ["verifier%s@example.com" % (i)])
+
+
+def latencies(send, count):
+    times = []
+    for i in xrange(count):
+        start = time.time()
+        send(notice(i))
+        times.append(time.time() - start)
+    return times
+
+
+def report(label, times):
+    times = sorted(times)
+    print "  %-26s mean %6.2fms  p95 %6.2fms" % (label,
+            1000 * sum(times) / len(times), 1000 * times[int(len(times) * 0.95)])
+
+
+def run(*args):
+    count = int(args[0]) if args else 200
+    StandIn.delay = float(args[1]) if len(args) > 1 else 0.01
+    server = serve()
+    try:
+        with override_settings(EMAIL_BACKEND=SMTP_BACKEND,
+                               **smtp_settings(server)):
+            print "%s messages to a local SMTP stand-in, %.0fms each" % (count,
+                                                        StandIn.delay * 1000)
+            StandIn.connections = 0
+            report("send() in the request", latencies(
+                        lambda m: m.send(), count))
+            print "    %s connections" % (StandIn.connections)
+
+            OutboundEmail.objects.all().delete()
+            StandIn.connections = 0
+            report("queued in the outbox", latencies(
+                        lambda m: get_connection(
+                            "apps.outbox.backends.OutboxBackend").send_messages([m]),
+                        count))
+            start = time.time()
+            sent = 0
+            while True:
+                batch = send_queued()
+                if not sum(batch):
+                    break
+                sent += batch[0]
+            print "    worker sent %s in %.3fs over %s connections" % (sent,
+                        time.time() - start, StandIn.connections)
+            OutboundEmail.objects.all().delete()
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+Load test the OCSP responder.
+
+In process, against a synthetic trust anchor with N endpoint serials (no
+database), first signing every response and then from the cache, both
+straight into the responder and through the Django view:
+
+    python manage.py runscript bench_ocsp --script-args 10000
+
+Over HTTP, against a running server, for serials 1..N of a trust anchor:
+
+    python manage.py runscript bench_ocsp --script-args \\
+        http://127.0.0.1:8000/certificates/ocsp/ anchor.pem 10000 30 8
+
+The HTTP arguments are the URL, the issuing trust anchor's certificate,
+the highest serial, the run time in seconds (default 30) and the number of
+client threads (default 8).
+"""
+
+import os, time, random, tempfile, threading, urllib2
+from shutil import rmtree
+from cryptography import x509
+from cryptography.x509 import ocsp as x509_ocsp
+from cryptography.hazmat.backends import default_backend
+from django.core.urlresolvers import reverse
+from django.test.client import Client
+from apps.certificates.ocsp import Issuer, request_der, responder
+from scripts.bench_castore import make_ca
+
+
+def rate(label, count, seconds):
+    print "  %-28s %8s requests %7.2fs %9.0f/s" % (label, count, seconds,
+                                                  count / seconds)
+
+
+def in_process(count):
+    dirpath = tempfile.mkdtemp(prefix="bench-ocsp-")
+    try:
+        make_ca(dirpath)
+        issuer = Issuer(1, os.path.join(dirpath, "ca.pem"),
+                        os.path.join(dirpath, "ca.key"))
+        responder.issuers, responder.statuses = {}, {}
+        responder.add_issuer(issuer)
+        for serial in range(1, count + 1):
+            responder.set_status(1, "%X" % (serial),
+                                 "revoked" if serial % 100 == 0 else "good", "")
+        # Keep the index above rather than loading the database's.
+        responder.built = time.time()
+        requests = [request_der(issuer.cert, s) for s in range(1, count + 1)]
+
+        client = Client()
+        url = reverse("ocsp", args=("",))
+        def post(der):
+            client.post(url, der, content_type="application/ocsp-request")
+
+        print "%s serials, one worker" % (count)
+        for label, send in (("responder", responder.respond),
+                            ("Django view", post)):
+            responder.responses = {}
+            for phase in ("signing", "cached"):
+                start = time.time()
+                for der in requests:
+                    send(der)
+                rate("%s, %s" % (label, phase), count, time.time() - start)
+    finally:
+        responder.built = None
+        rmtree(dirpath)
+
+
+def over_http(url, issuer_path, highest, seconds, threads):
+    with open(issuer_path) as f:
+        issuer = x509.load_pem_x509_certificate(f.read(), default_backend())
+    deadline = time.time() + seconds
+    counts = {}
+    lock = threading.Lock()
+
+    def client():
+        while time.time() < deadline:
+            req = urllib2.Request(url, request_der(issuer,
+                                            random.randint(1, highest)),
+                                  {"Content-Type": "application/ocsp-request"})
+            try:
+                r = x509_ocsp.load_der_ocsp_response(urllib2.urlopen(req).read())
+                result = str(r.response_status).split(".")[-1]
+                if result == "SUCCESSFUL":
+                    result = str(r.certificate_status).split(".")[-1]
+            except Exception, e:
+                result = e.__class__.__name__
+            with lock:
+                counts[result] = counts.get(result, 0) + 1
+
+    start = time.time()
+    workers = [threading.Thread(target=client) for i in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    rate("%s, %s threads" % (url, threads), sum(counts.values()),
+         time.time() - start)
+    for result, n in sorted(counts.items()):
+        print "    %-12s %s" % (result, n)
+
+
+def run(*args):
+    if args and args[0].startswith("http"):
+        over_http(args[0], args[1], int(args[2]),
+                  int(args[3]) if len(args) > 3 else 30,
+                  int(args[4]) if len(args) > 4 else 8)
+    else:
+        in_process(int(args[0]) if args else 10000)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+Time publishing a verification's six artifacts one after another, as
+save() used to, against the publisher, for one certificate and for a
+batch, with a local S3 stand-in that takes a fixed time per upload; the
+batch again when nothing changed since it was published; and the batch
+through the local storage backend.
+
+    python manage.py runscript bench_publish --script-args 0.05 24
+
+Arguments are the seconds each upload takes (default 0.05) and the number
+of certificates in the batch (default 24).
+"""
+
+import os, time, tempfile
+from shutil import rmtree
+from django.conf import settings
+from django.test.utils import override_settings
+from apps.certificates.fileutils import SimpleS3, s3pool
+from apps.certificates.publisher import Publication, publish_all
+from apps.certificates.manifest import manifest
+from apps.testsupport.s3 import StandIn, serve, connection_settings
+
+ARTIFACTS = (("public_cert_status_url", "%s.json", "rcsp.example.com"),
+             ("public_cert_x5c_url", "x5c/%s-x5c.json", "pubcerts.example.com"),
+             ("public_cert_status_sha1_url", "%s-sha1.json", "rcspsha1.example.com"),
+             ("public_cert_pem_url", "%s.pem", "pubcerts.example.com"),
+             ("public_cert_der_url", "%s.der", "pubcerts.example.com"),
+             ("presigned_zip_url", "%s.zip", "privcerts.example.com"))
+
+
+def publication(serial, path):
+    p = Publication()
+    for field, key, bucket in ARTIFACTS:
+        p.add(field, key % (serial), path, bucket)
+    return p
+
+
+def one_by_one(serial, path):
+    s = SimpleS3()
+    for field, key, bucket in ARTIFACTS:
+        s.store_in_s3(key % (serial), path, bucket=bucket, public=True)
+
+
+def timed(function, *args):
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+
+def run(*args):
+    StandIn.delay = float(args[0]) if args else 0.05
+    count = int(args[1]) if len(args) > 1 else 24
+    dirpath = tempfile.mkdtemp(prefix="bench-publish-")
+    server = serve()
+    path = os.path.join(dirpath, "artifact")
+    with open(path, "w") as f:
+        f.write("x" * 2048)
+    try:
+        with override_settings(USE_S3=True, CA_STORAGE_BACKEND="s3",
+                               CA_STORAGE_DEDUP=False,
+                               AWS_S3_CONNECTION=connection_settings(server)):
+            s3pool.pid = None
+            # Warm the connections and buckets, as a running server has.
+            publication("warm", path).publish()
+            print "%s uploads per certificate, %.0fms each" % (len(ARTIFACTS),
+                                                           StandIn.delay * 1000)
+            print "  one certificate, one by one   %7.3fs" % (
+                    timed(one_by_one, "01", path))
+            print "  one certificate, publisher    %7.3fs" % (
+                    timed(lambda: publication("02", path).publish()))
+            print "  %s certificates, one by one   %7.3fs" % (count,
+                    timed(lambda: [one_by_one("1%s" % (i), path)
+                                   for i in range(count)]))
+            print "  %s certificates, publish_all  %7.3fs (%s threads)" % (count,
+                    timed(lambda: publish_all([publication("2%s" % (i), path)
+                                               for i in range(count)])),
+                    settings.CA_PUBLISH_THREADS)
+        with override_settings(USE_S3=True, CA_STORAGE_BACKEND="s3",
+                               CA_STORAGE_MANIFEST_DIR=os.path.join(dirpath,
+                                                                    "manifest"),
+                               AWS_S3_CONNECTION=connection_settings(server)):
+            publish_all([publication("4%s" % (i), path) for i in range(count)])
+            manifest.reset_stats()
+            print "  %s certificates, unchanged    %7.3fs (%s)" % (count,
+                    timed(lambda: publish_all([publication("4%s" % (i), path)
+                                               for i in range(count)])),
+                    manifest.report())
+        with override_settings(CA_STORAGE_BACKEND="local",
+                               CA_STORAGE_DIR=os.path.join(dirpath, "storage")):
+            print "  %s certificates, local storage %7.3fs" % (count,
+                    timed(lambda: publish_all([publication("3%s" % (i), path)
+                                               for i in range(count)])))
+    finally:
+        s3pool.pid = None
+        server.shutdown()
+        server.server_close()
+        rmtree(dirpath)
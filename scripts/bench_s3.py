@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+Compare per-upload latency to S3 the old way (a new S3Connection and a
+create_bucket for every upload) and through SimpleS3's shared connection
+pool, against the local S3 stand-in (apps/testsupport/s3.py) served over
+HTTPS in this process.
+
+    python manage.py runscript bench_s3 --script-args 500 8
+
+Arguments are the number of public uploads of a small status file
+(default 500), as a verification makes, and the number of threads for a
+last, concurrent run through the pool (default 8).
+"""
+
+import os, ssl, time, tempfile, threading
+from shutil import rmtree
+from boto.s3.connection import S3Connection
+from boto.exception import S3CreateError
+from boto.s3.key import Key
+from django.conf import settings
+from django.test.utils import override_settings
+from apps.certificates.fileutils import SimpleS3, s3pool
+from apps.testsupport.s3 import serve, connection_settings
+
+BUCKET = "rcsp.bench.example.org"
+
+
+def unpooled_upload(key_name, path):
+    """What SimpleS3.store_in_s3 used to do."""
+    conn = S3Connection(settings.AWS_ACCESS_KEY_ID,
+                        settings.AWS_SECRET_ACCESS_KEY,
+                        **settings.AWS_S3_CONNECTION)
+    try:
+        b = conn.create_bucket(BUCKET)
+    except(S3CreateError):
+        b = conn.get_bucket(BUCKET)
+    k = Key(b)
+    k.key = key_name
+    k.set_metadata("Content-Type", "application/json")
+    k.set_contents_from_filename(path)
+    k.set_acl("public-read")
+
+
+def pooled_upload(key_name, path):
+    if not SimpleS3().store_in_s3(key_name, path, bucket=BUCKET, public=True):
+        raise IOError("upload of %s failed" % (key_name))
+
+
+def latencies(upload, count, path, label):
+    times = []
+    for i in xrange(count):
+        start = time.time()
+        upload("%s-%s.json" % (label, i), path)
+        times.append(time.time() - start)
+    return times
+
+
+def report(label, times, wall=None):
+    times = sorted(times)
+    print "  %-22s mean %6.2fms  p50 %6.2fms  p95 %6.2fms%s" % (label,
+            1000 * sum(times) / len(times), 1000 * times[len(times) // 2],
+            1000 * times[int(len(times) * 0.95)],
+            "  %6.0f uploads/s" % (len(times) / wall) if wall else "")
+
+
+def run(*args):
+    count = int(args[0]) if args else 500
+    threads = int(args[1]) if len(args) > 1 else 8
+    dirpath = tempfile.mkdtemp(prefix="bench-s3-")
+    server = serve(dirpath)
+    path = os.path.join(dirpath, "0A.json")
+    with open(path, "w") as f:
+        f.write('{"SerialNumber": "0A", "CertStatus": "good"}')
+    connection = connection_settings(server)
+    # boto's validate_certs=False does not reach httplib's default context;
+    # the stand-in's certificate is self-signed.
+    default_context = ssl._create_default_https_context
+    ssl._create_default_https_context = ssl._create_unverified_context
+    try:
+        with override_settings(AWS_S3_CONNECTION=connection,
+                               AWS_ACCESS_KEY_ID="bench",
+                               AWS_SECRET_ACCESS_KEY="bench"):
+            s3pool.pid = None
+            print "%s uploads to a local S3 stand-in over HTTPS" % (count)
+            report("new connection each",
+                   latencies(unpooled_upload, count, path, "unpooled"))
+            report("pooled",
+                   latencies(pooled_upload, count, path, "pooled"))
+
+            results = []
+            def worker(n):
+                results.extend(latencies(pooled_upload, count // threads,
+                                         path, "thread%s" % (n)))
+            workers = [threading.Thread(target=worker, args=(n,))
+                       for n in range(threads)]
+            start = time.time()
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+            report("pooled, %s threads" % (threads), results,
+                   time.time() - start)
+    finally:
+        ssl._create_default_https_context = default_context
+        server.shutdown()
+        server.server_close()
+        s3pool.pid = None
+        rmtree(dirpath)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+Time SHA-1 plus SHA-256 digests of CRL-sized files the old way (each
+digest reading the whole file into memory) against sha.py's single
+chunked pass, and the growth in peak memory each causes.
+
+    python manage.py runscript bench_sha --script-args 4 16 64
+
+Arguments are file sizes in MB (default 4 16 64). A CRL entry takes about
+40 bytes, so 64MB is a CRL of some 1.6 million revocations.
+"""
+
+import os, time, hashlib, tempfile, resource
+from apps.certificates.sha import digests_from_filepath
+
+
+def whole_file(fp, name):
+    """What sha1_from_filepath and sha256_from_filepath used to do."""
+    f = open(fp, 'r')
+    m = hashlib.new(name)
+    m.update(f.read())
+    f.close()
+    return m.hexdigest()
+
+
+def old_way(fp):
+    return {"sha1": whole_file(fp, "sha1"), "sha256": whole_file(fp, "sha256")}
+
+
+def peak():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def timed(function, fp, repeat=3):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = function(fp)
+        seconds = time.time() - start
+        best = seconds if best is None else min(best, seconds)
+    return best, result
+
+
+def run(*args):
+    sizes = [int(a) for a in args] or [4, 16, 64]
+    fd, fp = tempfile.mkstemp(prefix="bench-sha-", suffix=".crl")
+    os.close(fd)
+    try:
+        print "%6s %22s %22s" % ("MB", "whole file, 2 reads", "sha.py, 1 pass")
+        # Peak memory only grows, so measure the chunked pass first.
+        for size in sizes:
+            with open(fp, "wb") as f:
+                for i in range(size):
+                    f.write(os.urandom(1024 * 1024))
+            before = peak()
+            new, new_digests = timed(digests_from_filepath, fp)
+            new_peak = peak() - before
+            before = peak()
+            old, old_digests = timed(old_way, fp)
+            old_peak = peak() - before
+            assert old_digests == new_digests
+            print "%6s %10.3fs %+7.1fMB %10.3fs %+7.1fMB" % (size, old, old_peak,
+                                                           new, new_peak)
+    finally:
+        os.unlink(fp)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+Time sending text messages in the request, one after another, against
+queueing them and sending the queue from the outbox's thread pool,
+through the fake transport taking a fixed time per message; then the
+queue again with the fake turning away more than a few messages a second.
+
+    python manage.py runscript bench_sms --script-args 100 0.1 10
+
+Arguments are the number of messages (default 100), the seconds each takes
+(default 0.1) and the messages a second the fake accepts in the last run
+(default 10).
+"""
+
+import time
+from django.conf import settings
+from django.test.utils import override_settings
+from apps.accounts.sms_utils import send_sms_twilio
+from apps.outbox.models import OutboundSMS, send_queued_sms
+from apps.outbox.sms import FakeTransport
+
+
+def drain():
+    """Send the queue; returns the seconds it took and the rate limit hits."""
+    start = time.time()
+    postponed = 0
+    while OutboundSMS.objects.filter(status="queued").exists():
+        sent, retried, failed = send_queued_sms()
+        postponed += retried
+        if not sent + retried + failed:
+            time.sleep(0.05)
+    return time.time() - start, postponed
+
+
+def run(*args):
+    count = int(args[0]) if args else 100
+    FakeTransport.delay = float(args[1]) if len(args) > 1 else 0.1
+    limit = int(args[2]) if len(args) > 2 else 10
+    numbers = ["+1555555%04d" % (i) for i in range(count)]
+    OutboundSMS.objects.all().delete()
+    with override_settings(OUTBOX_SMS_TRANSPORT="apps.outbox.sms.FakeTransport",
+                           OUTBOX_SMS_RATE=1000):
+        print "%s messages, %.0fms each" % (count, FakeTransport.delay * 1000)
+        with override_settings(OUTBOX_QUEUE_SMS=False):
+            start = time.time()
+            for to in numbers:
+                send_sms_twilio("Your code is 1234", to)
+            print "  sent in the request       %7.3fs" % (time.time() - start)
+
+        with override_settings(OUTBOX_QUEUE_SMS=True):
+            start = time.time()
+            for to in numbers:
+                send_sms_twilio("Your code is 1234", to)
+            print "  queued in the request     %7.3fs" % (time.time() - start)
+            print "  sent by the worker        %7.3fs (%s threads)" % (drain()[0],
+                                                    settings.OUTBOX_SMS_THREADS)
+
+            FakeTransport.limit = limit
+            for to in numbers:
+                send_sms_twilio("Your code is 1234", to)
+            took, postponed = drain()
+            print "  limited to %s a second    %7.3fs (%s rate limited, all sent)" % (
+                    limit, took, postponed)
+
+        with override_settings(OUTBOX_QUEUE_SMS=True, OUTBOX_SMS_RATE=limit):
+            for to in numbers:
+                send_sms_twilio("Your code is 1234", to)
+            took, postponed = drain()
+            print "  paced at OUTBOX_SMS_RATE  %7.3fs (%s rate limited)" % (
+                    took, postponed)
+    FakeTransport.limit = None
+    OutboundSMS.objects.all().delete()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+Load test the JSON status API in process, against a synthetic status map
+of N certificates (no database): single GETs, then batches of
+CA_STATUS_BATCH_LIMIT serials POSTed, through the Django view.
+
+    python manage.py runscript bench_status --script-args 100000 5
+"""
+
+import json, time, random
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.test.client import Client
+from apps.certificates.cautils import write_verification_message
+from apps.certificates.serials import format_serial
+from apps.certificates.status import Entry, status_map
+
+
+def rate(label, count, seconds):
+    print "  %-28s %8s lookups %7.2fs %9.0f/s" % (label, count, seconds,
+                                                 count / seconds)
+
+
+def run(*args):
+    count = int(args[0]) if args else 100000
+    seconds = int(args[1]) if len(args) > 1 else 5
+    status_map.by_serial, status_map.by_fingerprint = {}, {}
+    for serial in xrange(1, count + 1):
+        s = format_serial(serial)
+        fingerprint = ("%040X" % (serial))
+        status = "revoked" if serial % 100 == 0 else "good"
+        status_map.add(Entry(s, "host%s.bench.example.org" % (serial), status,
+                             fingerprint, write_verification_message(s,
+                                "host%s.bench.example.org" % (serial), status,
+                                fingerprint)))
+    # Keep the map above rather than loading the database's.
+    status_map.built = time.time()
+    client = Client()
+    url = reverse("certificate_status", args=("",))
+    print "%s certificates, one worker" % (count)
+    try:
+        done, start = 0, time.time()
+        while time.time() - start < seconds:
+            client.get(url + format_serial(random.randint(1, count)))
+            done += 1
+        rate("GET, one each", done, time.time() - start)
+
+        done, start = 0, time.time()
+        while time.time() - start < seconds:
+            body = json.dumps({"SerialNumbers": [format_serial(
+                        random.randint(1, count)) for i in
+                        xrange(settings.CA_STATUS_BATCH_LIMIT)]})
+            client.post(url, body, content_type="application/json")
+            done += settings.CA_STATUS_BATCH_LIMIT
+        rate("POST, %s each" % (settings.CA_STATUS_BATCH_LIMIT), done,
+             time.time() - start)
+    finally:
+        status_map.built = None
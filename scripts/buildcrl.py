@@ -2,36 +2,187 @@
 # -*- coding: utf-8 -*-
 # vim: ai ts=4 sts=4 et sw=4
 
-import sys
+"""
+Rebuild and publish the CA's CRL and those of the good trust anchors.
+
+Only CRLs with revocations since they were last published, or close to
+their nextUpdate (CA_CRL_REFRESH_SECONDS), are rebuilt; see CRLState.
+Trust anchor CRLs are signed in a pool of CA_CRL_WORKERS processes and
+uploaded in a pool of CA_CRL_UPLOAD_THREADS threads; a CRL identical to
+the one last uploaded is skipped (manifest.py). An anchor that fails
+is reported and the others carry on. With CA_DELTA_CRLS on, each rebuild
+publishes a delta CRL, or a base CRL and a delta when a base is due; see
+CRLPublication.
+
+    python manage.py runscript buildcrl
+    python manage.py runscript buildcrl --script-args all   # rebuild every CRL
+"""
+
+import sys, time, multiprocessing
+from multiprocessing.pool import ThreadPool
+from datetime import datetime
+from django.conf import settings
+from django.db import connection
 from apps.certificates.models import (AnchorCertificateRevocationList,
                                       TrustAnchorCertificate,
-                                      CertificateRevocationList,)
-
-def buildcrls():
-    
-    
-    #removed any old the crl for the CA.
-    ca_crl = CertificateRevocationList.objects.all().delete()
-    
-    #create the crl for the CA.
-    ca_crl = CertificateRevocationList.objects.create()
-    if ca_crl == "Failed" or ca_crl in ("", None):
-        print "A CRL was NOT created for the CA/RA. URL =  %s" % (ca_crl.url)
+                                      CertificateRevocationList,
+                                      CRLState, CRLPublication)
+from apps.certificates.cautils import (sign_anchor_crl, sign_numbered_crls,
+                                       publish_crl)
+from apps.certificates.castore import deltas_enabled
+from apps.certificates.manifest import manifest
+
+
+def sign(job):
+    """
+    Sign one anchor's CRLs: its full CRL when plan is None, else what
+    CRLPublication.plan() asked for. Runs in a worker process.
+    """
+    trust_anchor, plan = job
+    start = time.time()
+    try:
+        if plan:
+            crls = sign_numbered_crls(trust_anchor, *plan)
+        else:
+            crls = [(None, sign_anchor_crl(trust_anchor))]
+        return trust_anchor, crls, None, time.time() - start
+    except:
+        return trust_anchor, None, str(sys.exc_info()[1]), time.time() - start
+
+
+def upload(crls):
+    start = time.time()
+    try:
+        return [publish_crl(path) for fields, path in crls], None, time.time() - start
+    except:
+        return None, str(sys.exc_info()[1]), time.time() - start
+
+
+def build_anchor_crls(jobs, processes=None, threads=None):
+    """
+    Sign and upload CRLs for jobs, (trust_anchor, plan) pairs as sign()
+    takes, each upload starting as soon as its CRLs are signed. Returns a
+    list of (trust_anchor, crls, urls, error) and a dict of timings.
+    """
+    processes = processes or settings.CA_CRL_WORKERS or multiprocessing.cpu_count()
+    threads = threads or settings.CA_CRL_UPLOAD_THREADS
+    timings = {"sign": 0.0, "upload": 0.0}
+    results, uploads = [], []
+    start = time.time()
+
+    # Each worker process opens its own database connection.
+    connection.close()
+    signers = multiprocessing.Pool(processes)
+    uploaders = ThreadPool(threads)
+    try:
+        for t, crls, error, seconds in signers.imap_unordered(sign, jobs):
+            timings["sign"] += seconds
+            if error:
+                results.append((t, None, None, error))
+            else:
+                uploads.append((t, crls, uploaders.apply_async(upload, (crls,))))
+        timings["signed"] = time.time() - start
+        for t, crls, r in uploads:
+            urls, error, seconds = r.get()
+            timings["upload"] += seconds
+            if not error and "Failed" in urls:
+                error = "upload failed"
+            results.append((t, crls, urls, error))
+    finally:
+        signers.close()
+        uploaders.close()
+        signers.join()
+        uploaders.join()
+    timings["total"] = time.time() - start
+    return results, timings
+
+
+def build_numbered_crls(trust_anchor=None, now=None, force=False):
+    """Build and publish the next base or delta CRL in this process."""
+    state = CRLState.for_anchor(trust_anchor)
+    crls = sign_numbered_crls(trust_anchor,
+                              *CRLPublication.plan(trust_anchor, now, force))
+    urls = [publish_crl(path) for fields, path in crls]
+    if "Failed" in urls:
+        return False
+    CRLPublication.record(trust_anchor, crls, urls, state)
+    return True
+
+
+def buildcrls(force=False, processes=None, threads=None):
+    now = datetime.utcnow()
+    built, skipped, failed = 0, 0, 0
+    deltas = deltas_enabled()
+
+    if force or CRLState.for_anchor().needs_crl(now):
+        try:
+            if deltas:
+                created = build_numbered_crls(None, now, force)
+            else:
+                #removed any old the crl for the CA.
+                ca_crl = CertificateRevocationList.objects.all().delete()
+
+                #create the crl for the CA.
+                ca_crl = CertificateRevocationList.objects.create()
+                created = ca_crl.url not in ("Failed", "", None)
+            if created:
+                print "A CRL was created for the CA/RA."
+                built += 1
+            else:
+                print "A CRL was NOT created for the CA/RA."
+                failed += 1
+        except:
+            print "[CRITICAL ERROR] A CRL was not created for the CA/RA: %s" % (
+                    sys.exc_info()[1],)
+            failed += 1
     else:
-        print "A CRL was created for the CA/RA."
+        skipped += 1
+
     tas = TrustAnchorCertificate.objects.filter(status="good")
-    
+    states = dict((s.trust_anchor_id, s) for s in
+                  CRLState.objects.filter(trust_anchor__status="good"))
+
+    dirty = []
     for t in tas:
-        AnchorCertificateRevocationList.objects.filter(trust_anchor = t).delete()
-        c = AnchorCertificateRevocationList.objects.create(trust_anchor = t)
-        
-        if c.url!="Failed":
-            print "A CRL was created for the Trust Anchor %s" % (c.trust_anchor.dns)
-        else:
-            print  "[CRITICAL ERROR] A CRL was not created for the Trust Anchor %s" % (c.trust_anchor.dns)
-def run():
+        state = states.get(t.id)
+        if not force and state and not state.needs_crl(now):
+            skipped += 1
+            continue
+        # Load the sequence before signing, so revocations made meanwhile
+        # leave the anchor dirty for the next run.
+        states[t.id] = state or CRLState.for_anchor(t)
+        dirty.append(t)
+
+    if dirty:
+        jobs = [(t, CRLPublication.plan(t, now, force) if deltas else None)
+                for t in dirty]
+        results, timings = build_anchor_crls(jobs, processes, threads)
+        for t, crls, urls, error in results:
+            if error:
+                print "[CRITICAL ERROR] A CRL was not created for the Trust Anchor %s: %s" % (
+                        t.dns, error)
+                failed += 1
+                continue
+            if deltas:
+                CRLPublication.record(t, crls, urls, states[t.id])
+            else:
+                AnchorCertificateRevocationList.replace(t, urls[0], states[t.id])
+            built += 1
+        print "Signed %s trust anchor CRLs in %.1fs (%.1fs of signing), " \
+              "uploaded in %.1fs more (%.1fs of uploads)." % (len(dirty),
+                timings["signed"], timings["sign"],
+                timings["total"] - timings["signed"], timings["upload"])
+    return built, skipped, failed
+
+
+def run(*args):
     try:
-        buildcrls()
+        start = time.time()
+        manifest.reset_stats()
+        built, skipped, failed = buildcrls(force="all" in args)
+        print "Built %s CRLs, skipped %s unchanged, %s failed, in %.1fs." % (
+                built, skipped, failed, time.time() - start)
+        print manifest.report()
     except:
         print "Error."
         print sys.exc_info()
@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+Keep the RSA key pool topped up.
+
+    python manage.py runscript fill_keypool              # run forever
+    python manage.py runscript fill_keypool --script-args once
+"""
+
+import sys, time
+from datetime import datetime
+from apps.certificates.keypool import fill, stats
+
+POLL_SECONDS = 5
+
+
+def run(*args):
+    once = "once" in args
+    while True:
+        try:
+            added = fill()
+            if sum(added.values()):
+                print "%s added %s, levels %s" % (datetime.now(), added,
+                                                  stats()["levels"])
+        except:
+            print "Error."
+            print sys.exc_info()
+        if once:
+            break
+        time.sleep(POLL_SECONDS)
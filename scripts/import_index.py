@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+Load openssl index files into the CA state store (CA_STATE_STORE).
+
+    python manage.py runscript import_index --script-args /opt/ca/conf/index
+
+Each index file replaces whatever the store held for that issuer. With no
+arguments the main CA's index and every trust anchor's index are imported.
+"""
+
+import os, sys, time
+from django.conf import settings
+from apps.certificates.castore import import_index, conf_database
+from apps.certificates.cautils import read_conf
+from apps.certificates.models import TrustAnchorCertificate
+
+
+def index_files():
+    paths = [conf_database(read_conf(settings.CA_MAIN_CONF))]
+    for t in TrustAnchorCertificate.objects.exclude(completed_dir_path=""):
+        # As the stubs write it: database = |COMPLETED_ANCHOR_DIR|/index
+        paths.append(t.completed_dir_path + "/index")
+    return paths
+
+
+def run(*args):
+    for path in (args or index_files()):
+        if not os.path.exists(path):
+            print "Skipped %s, no such file." % (path)
+            continue
+        try:
+            start = time.time()
+            count = import_index(path)
+            print "Imported %s records from %s in %.2fs" % (count, path,
+                                                           time.time() - start)
+        except:
+            print "Error importing %s." % (path)
+            print sys.exc_info()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+Run queued certificate issuance jobs (CA_ASYNC_ISSUANCE) in a pool of worker
+processes.
+
+    python manage.py runscript issuance_worker              # run forever
+    python manage.py runscript issuance_worker --script-args once
+"""
+
+import sys, time, multiprocessing
+from datetime import datetime
+from django.conf import settings
+from django.db import connection
+from apps.certificates.models import IssuanceJob
+
+POLL_SECONDS = 1
+
+
+def work(job_id):
+    try:
+        return IssuanceJob.objects.get(id=job_id).run()
+    except:
+        return "error %s" % (sys.exc_info()[1],)
+
+
+def run(*args):
+    once = "once" in args
+    processes = settings.CA_ISSUANCE_WORKERS or multiprocessing.cpu_count()
+
+    # Each worker process opens its own database connection.
+    connection.close()
+    pool = multiprocessing.Pool(processes)
+    running = {}
+    try:
+        while True:
+            try:
+                for job_id, r in running.items():
+                    if r.ready():
+                        del running[job_id]
+                        print "%s job %s %s" % (datetime.now(), job_id, r.get())
+                # However long a job takes, it is alive while we wait on it.
+                IssuanceJob.beat(running.keys())
+                IssuanceJob.requeue_stale(settings.CA_ISSUANCE_JOB_TIMEOUT)
+                while len(running) < processes:
+                    job = IssuanceJob.claim()
+                    if job is None:
+                        break
+                    running[job.id] = pool.apply_async(work, (job.id,))
+            except:
+                print "Error."
+                print sys.exc_info()
+            if once and not running:
+                break
+            time.sleep(POLL_SECONDS)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+Send the mail OutboxBackend queued, a batch per connection, and the text
+messages send_sms_twilio() queued, retrying what fails with backoff.
+
+    python manage.py runscript outbox_worker              # run forever
+    python manage.py runscript outbox_worker --script-args once
+"""
+
+import sys, time
+from datetime import datetime
+from django.conf import settings
+from apps.outbox.models import (OutboundEmail, OutboundSMS, send_queued,
+                                send_queued_sms)
+
+POLL_SECONDS = 1
+
+
+def run(*args):
+    once = "once" in args
+    queues = (("email", OutboundEmail, send_queued, "OUTBOX_BATCH_SIZE"),
+              ("sms", OutboundSMS, send_queued_sms, "OUTBOX_SMS_BATCH_SIZE"))
+    while True:
+        more = False
+        for label, model, send, batch_size in queues:
+            sent = retried = failed = 0
+            try:
+                model.requeue_stale(settings.OUTBOX_SEND_TIMEOUT)
+                sent, retried, failed = send()
+                if sent or retried or failed:
+                    print "%s %s sent %s, retrying %s, failed %s" % (
+                            datetime.now(), label, sent, retried, failed)
+            except:
+                print "Error."
+                print sys.exc_info()
+            # A full batch means there is probably more waiting.
+            more = more or sent + retried + failed >= getattr(settings,
+                                                              batch_size)
+        if not more:
+            if once:
+                break
+            time.sleep(POLL_SECONDS)
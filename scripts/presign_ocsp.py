@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4
+
+"""
+Re-sign the pre-signed OCSP responses (ocspcache.py) that are missing,
+older than CA_OCSP_RESIGN_SECONDS, or do not yet show a revocation, for
+every certificate the responder knows, in a pool of
+CA_OCSP_PRESIGN_WORKERS processes. Prints the cache's age histogram
+before and after. Run it from cron, more often than
+CA_OCSP_RESPONSE_SECONDS - CA_OCSP_RESIGN_SECONDS.
+
+    python manage.py runscript presign_ocsp
+    python manage.py runscript presign_ocsp --script-args all   # re-sign all
+"""
+
+import sys, time, datetime, multiprocessing
+from django.conf import settings
+from cryptography.x509 import ocsp
+from apps.certificates import ocspcache
+from apps.certificates.ocsp import Issuer, responder
+
+# Responses signed per job; each job loads its issuer's key once.
+CHUNK = 500
+
+
+def sign(job):
+    """Sign and store one chunk of an issuer's responses, in a worker."""
+    (id, cert_path, key_path, passphrase), algorithm, statuses, now, \
+        next_update = job
+    start = time.time()
+    try:
+        issuer = Issuer(id, cert_path, key_path, passphrase)
+        for serial, status in statuses:
+            ocspcache.store(id, algorithm, serial,
+                            issuer.respond(algorithm, serial, status, now,
+                                           next_update))
+        return id, len(statuses), None, time.time() - start
+    except:
+        return id, 0, str(sys.exc_info()[1]), time.time() - start
+
+
+def up_to_date(issuer_id, algorithm, serial, status, now):
+    age = ocspcache.age(issuer_id, algorithm, serial, now)
+    if age is None or age > settings.CA_OCSP_RESIGN_SECONDS:
+        return False
+    if status[0] == "revoked":
+        cached = ocspcache.load(issuer_id, algorithm, serial)
+        return bool(cached) and \
+            cached[1].certificate_status == ocsp.OCSPCertStatus.REVOKED
+    return True
+
+
+def plan(force=False):
+    """
+    The jobs sign() takes for every response that needs signing, the
+    number already up to date, and the number without an issuer key here.
+    """
+    responder.build()
+    issuers = dict((i.id, i) for i in responder.issuers.values())
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    next_update = now + datetime.timedelta(
+                                seconds=settings.CA_OCSP_RESPONSE_SECONDS)
+    work, fresh, orphaned = {}, 0, 0
+    started = time.time()
+    for (issuer_id, serial), status in responder.statuses.iteritems():
+        if issuer_id not in issuers:
+            orphaned += 1
+            continue
+        for algorithm in settings.CA_OCSP_PRESIGN_ALGORITHMS:
+            if not force and up_to_date(issuer_id, algorithm, serial, status,
+                                        started):
+                fresh += 1
+            else:
+                work.setdefault((issuer_id, algorithm), []).append(
+                                                            (serial, status))
+    jobs = []
+    for (issuer_id, algorithm), statuses in work.items():
+        i = issuers[issuer_id]
+        for n in range(0, len(statuses), CHUNK):
+            jobs.append(((i.id, i.cert_path, i.key_path, i.passphrase),
+                         algorithm, statuses[n:n + CHUNK], now, next_update))
+    return jobs, fresh, orphaned
+
+
+def presign(force=False, processes=None):
+    """Sign what plan() finds. Returns (signed, fresh, orphaned, errors)."""
+    processes = (processes or settings.CA_OCSP_PRESIGN_WORKERS or
+                 multiprocessing.cpu_count())
+    jobs, fresh, orphaned = plan(force)
+    signed, errors = 0, []
+    if jobs:
+        pool = multiprocessing.Pool(processes)
+        try:
+            for id, count, error, seconds in pool.imap_unordered(sign, jobs):
+                signed += count
+                if error:
+                    errors.append((id, error))
+        finally:
+            pool.close()
+            pool.join()
+    return signed, fresh, orphaned, errors
+
+
+def print_histogram(title):
+    print title
+    for label, count in zip(ocspcache.bucket_labels(),
+                            ocspcache.cache_histogram()):
+        print "  %-8s %s" % (label, count)
+
+
+def run(*args):
+    force = "all" in args
+    print_histogram("Cached responses by age, before:")
+    start = time.time()
+    signed, fresh, orphaned, errors = presign(force)
+    print "Signed %s responses in %.1fs; %s were up to date, %s have no issuer key here." % (
+            signed, time.time() - start, fresh, orphaned)
+    for id, error in errors:
+        print "[CRITICAL ERROR] Responses for issuer %s were not signed: %s" % (
+                id, error)
+    print_histogram("Cached responses by age, after:")
@@ -161,6 +161,7 @@ INSTALLED_APPS = (
     'apps.accounts',
     'apps.certificates',
     'apps.home',
+    'apps.outbox',
     'django.contrib.markup',
     'django_extensions',
     
@@ -203,9 +204,28 @@ LOGGING = {
 EMAIL_HOST_USER = 'vcert@example.com'
 HOSTNAME_URL = 'http://127.0.0.1:8000'
 EMAIL_BACKEND = 'django_ses.SESBackend'
+
+# Queue outgoing mail instead of sending it during the request: set
+# EMAIL_BACKEND to 'apps.outbox.backends.OutboxBackend' and run
+# `python manage.py runscript outbox_worker`, which sends the queue through
+# OUTBOX_EMAIL_BACKEND, up to OUTBOX_BATCH_SIZE messages per connection. A
+# message that fails is retried OUTBOX_RETRY_SECONDS later, doubling the wait
+# each time, up to OUTBOX_MAX_ATTEMPTS tries; one left sending longer than
+# OUTBOX_SEND_TIMEOUT seconds is queued again. The same message to the same
+# people queued again within OUTBOX_DEDUPE_SECONDS of being sent is dropped.
+OUTBOX_EMAIL_BACKEND  = 'django_ses.SESBackend'
+OUTBOX_BATCH_SIZE     = 100
+OUTBOX_RETRY_SECONDS  = 60
+OUTBOX_MAX_ATTEMPTS   = 6
+OUTBOX_SEND_TIMEOUT   = 600
+OUTBOX_DEDUPE_SECONDS = 600
 AWS_ACCESS_KEY_ID = ''
 AWS_SECRET_ACCESS_KEY = ''
 
+# Extra S3Connection arguments, e.g. host, port and calling_format for an
+# S3-compatible store other than Amazon's.
+AWS_S3_CONNECTION = {}
+
 # Default S3 bucket for filwe upload utility.
 AWS_BUCKET =''
 
@@ -219,6 +239,18 @@ TWILIO_API_BASE = "https://api.twilio.com/2010-04-01"
 TWILIO_SID = ""
 TWILIO_AUTH_TOKEN = ""
 TWILIO_API_VERSION = '2010-04-01'
+
+# Text messages. send_sms_twilio() queues them for the outbox worker when
+# OUTBOX_QUEUE_SMS is on, and otherwise sends them at once. Either way they
+# go through OUTBOX_SMS_TRANSPORT, one per process ('apps.outbox.sms.
+# FakeTransport' sends nothing, for testing). The worker sends up to
+# OUTBOX_SMS_BATCH_SIZE at a time from OUTBOX_SMS_THREADS threads, no faster
+# than OUTBOX_SMS_RATE a second, and retries failures like mail.
+OUTBOX_QUEUE_SMS      = False
+OUTBOX_SMS_TRANSPORT  = 'apps.outbox.sms.TwilioTransport'
+OUTBOX_SMS_BATCH_SIZE = 100
+OUTBOX_SMS_THREADS    = 4
+OUTBOX_SMS_RATE       = 1
 SMS_LOGIN_TIMEOUT_MIN = 10
 
 
@@ -245,13 +277,123 @@ CA_MAIN_CONF    = os.path.join( CA_CONF_DIR , "ca.example.com.cnf")
 
 CA_VERIFIER_EMAIL = "verifier@example.com"
 
+# How endpoint certificates are built. "openssl" shells out to openssl, sed
+# and zip. "inprocess" builds the same files with pyOpenSSL/cryptography.
+CA_ISSUANCE_ENGINE = "openssl"
+
+# Pre-generated RSA keys, refilled by `python manage.py runscript fill_keypool`.
+# CA_KEYPOOL_SIZES is the number of keys to keep per key size. Keys are
+# encrypted at rest with CA_KEYPOOL_PASSWORD.
+CA_KEYPOOL_ENABLED  = False
+CA_KEYPOOL_DIR      = os.path.join( CA_BASE_DIR, 'keypool/' )
+CA_KEYPOOL_SIZES    = {2048: 20, 4096: 20}
+CA_KEYPOOL_LOW_WATER = 5
+CA_KEYPOOL_PASSWORD = SECRET_KEY
+
+# Each process reserves this many serials at a time from CA_CONF_DIR/serial
+# (see apps/certificates/serials.py). Unused serials in a block are skipped.
+CA_SERIAL_BLOCK_SIZE = 10
+
+# Keep issued/revoked certificates in the database (IssuedCertificate) and
+# revoke and build CRLs from it rather than with openssl ca, which rescans
+# the flat index files every time. Import the existing index files first with
+# `python manage.py runscript import_index --script-args <index> ...`.
+CA_STATE_STORE = False
+
+# Issue new certificates in the background. save() only queues an
+# IssuanceJob; `python manage.py runscript issuance_worker` runs them with
+# CA_ISSUANCE_WORKERS processes (None = one per core). A job that raises is
+# retried up to CA_ISSUANCE_MAX_ATTEMPTS times. The worker running a job
+# marks it alive every second; one it has not for CA_ISSUANCE_JOB_TIMEOUT
+# seconds is assumed to have lost its worker and is queued again.
+CA_ASYNC_ISSUANCE       = False
+CA_ISSUANCE_WORKERS     = None
+CA_ISSUANCE_MAX_ATTEMPTS = 3
+CA_ISSUANCE_JOB_TIMEOUT = 600
+
 
 #depricated - iInore and liekly to  be removed in future versions.
 CRL_FILENAME = "global-crl.pem"
 
+# buildcrl only rebuilds CRLs with new revocations, or whose nextUpdate is
+# within this many seconds. Keep it longer than the interval buildcrl runs at.
+CA_CRL_REFRESH_SECONDS = 24 * 60 * 60
+
+# buildcrl signs trust anchor CRLs in CA_CRL_WORKERS processes (None: one per
+# CPU) and uploads them in CA_CRL_UPLOAD_THREADS threads.
+CA_CRL_WORKERS = None
+CA_CRL_UPLOAD_THREADS = 8
+
+# With CA_STATE_STORE on, publish numbered base CRLs (where the full CRLs
+# went) every CA_BASE_CRL_SECONDS and, in between, delta CRLs of what was
+# revoked since, valid for CA_DELTA_CRL_SECONDS, under <name>-delta.
+CA_DELTA_CRLS = False
+CA_BASE_CRL_SECONDS = 7 * 24 * 60 * 60
+CA_DELTA_CRL_SECONDS = 2 * 24 * 60 * 60
+
+# The OCSP responder (certificates/ocsp/) signs responses valid for
+# CA_OCSP_RESPONSE_SECONDS and serves them from cache until then. Its status
+# index is reloaded from the database every CA_OCSP_INDEX_SECONDS; saves in
+# the same process update it at once.
+CA_OCSP_RESPONSE_SECONDS = 60 * 60
+CA_OCSP_INDEX_SECONDS = 5 * 60
+
+# Keep signed OCSP responses in CA_OCSP_CACHE_DIR, shared by every process.
+# scripts/presign_ocsp.py (run from cron more often than
+# CA_OCSP_RESPONSE_SECONDS - CA_OCSP_RESIGN_SECONDS) re-signs those older
+# than CA_OCSP_RESIGN_SECONDS for CA_OCSP_PRESIGN_ALGORITHMS in
+# CA_OCSP_PRESIGN_WORKERS processes (None for one per CPU); revocations
+# re-sign at once.
+CA_OCSP_CACHE_ENABLED = False
+CA_OCSP_CACHE_DIR = os.path.join( CA_BASE_DIR, 'ocsp/' )
+CA_OCSP_RESIGN_SECONDS = 30 * 60
+CA_OCSP_PRESIGN_ALGORITHMS = ("sha1",)
+CA_OCSP_PRESIGN_WORKERS = None
+
+# The JSON status API (certificates/status/) answers from a map of every
+# issued certificate, reloaded every CA_STATUS_INDEX_SECONDS. A POST may ask
+# for up to CA_STATUS_BATCH_LIMIT certificates. Responses may be cached for
+# a tenth of the time since their newest ThisUpdate, at most
+# CA_STATUS_MAX_AGE seconds.
+CA_STATUS_INDEX_SECONDS = 5 * 60
+CA_STATUS_BATCH_LIMIT = 1000
+CA_STATUS_MAX_AGE = 60 * 60
+
 
 #Publish items to S3.  If false the behavior is disabled.
 USE_S3              = True
+
+# Where published items go: "s3" (while USE_S3 is on) or "local", which
+# keeps them under CA_STORAGE_DIR, one copy of each distinct content, served
+# at CA_STORAGE_URL. Set CA_STORAGE_SENDFILE to "X-Sendfile" (Apache,
+# lighttpd) or "X-Accel-Redirect" (nginx, with an internal location at
+# CA_STORAGE_SENDFILE_PREFIX aliased to CA_STORAGE_DIR) to let the web
+# server send the files.
+CA_STORAGE_BACKEND = "s3"
+CA_STORAGE_DIR = os.path.join( CA_BASE_DIR, 'storage/' )
+CA_STORAGE_URL = HOSTNAME_URL + "/certificates/files/"
+CA_STORAGE_SENDFILE = None
+CA_STORAGE_SENDFILE_PREFIX = "/storage-internal/"
+CA_STORAGE_MAX_AGE = 5 * 60
+
+# With CA_STORAGE_DEDUP on, the S3 backend skips uploading content that it
+# last uploaded to the same key, as recorded in CA_STORAGE_MANIFEST_DIR,
+# until the record is CA_STORAGE_MANIFEST_SECONDS old.
+CA_STORAGE_DEDUP = True
+CA_STORAGE_MANIFEST_DIR = os.path.join( CA_BASE_DIR, 'manifest/' )
+CA_STORAGE_MANIFEST_SECONDS = 7 * 24 * 60 * 60
+
+# Presigned URLs for private zips are valid for CA_PRESIGNED_URL_SECONDS and
+# reused until CA_PRESIGNED_URL_MARGIN seconds before they expire.
+CA_PRESIGNED_URL_SECONDS = 7 * 24 * 60 * 60
+CA_PRESIGNED_URL_MARGIN = 24 * 60 * 60
+
+# A certificate's artifacts are uploaded together in CA_PUBLISH_THREADS
+# threads per process, each upload tried CA_PUBLISH_RETRIES more times,
+# CA_PUBLISH_RETRY_SECONDS apart (then twice that, ...), if it fails.
+CA_PUBLISH_THREADS = 8
+CA_PUBLISH_RETRIES = 2
+CA_PUBLISH_RETRY_SECONDS = 1
 # Send outbound emails such as #verification notification and more
 SEND_CA_EMAIL       = True
 